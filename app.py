@@ -1,34 +1,35 @@
 import streamlit as st
 import os
-import json
+import contextlib
 import logging
-import re
-from typing import List, Dict, Any, Tuple
+import time
+from typing import List, Dict, Any, Callable, Iterable
 from dotenv import load_dotenv
 from openai import OpenAI
 from pinecone import Pinecone
 from pymongo import MongoClient
+from vector_index import LocalVectorIndex, LOCAL_INDEX_DIR
+from pipeline import (
+    LLM_MODEL, LLM_TEMPERATURE, VECTOR_BACKEND, LOCAL_INDEX_MODE, PINECONE_INDEX_NAME_DOCS, PINECONE_INDEX_NAME_LEGIS,
+    MONGO_DB_NAME, MONGO_COLLECTION_NAME_DOCS, MONGO_COLLECTION_NAME_LEGIS, PINECONE_QUERY_TIMEOUT_SECONDS,
+    MONGO_FETCH_TIMEOUT_SECONDS, OPENAI_REQUEST_TIMEOUT_SECONDS, RetrievalError, StreamingSanitizer, Step,
+    answer_steps, build_messages, perform_step, register_cache_metrics, run_steps,
+)
+from metrics import STAGE_SECONDS, TOKENS_STREAMED, start_http_server, start_file_writer
 
 # --- 1. Configuration and Initialization ---
+# Retrieval, caching and the question flow are in pipeline.py, shared with the async service; this module is the Streamlit UI
 load_dotenv()
 
-# --- Application Constants ---
-EMBEDDING_MODEL = "text-embedding-ada-002"
-LLM_MODEL = "gpt-4o-mini"
-TOP_K = 8 # Number of top results to retrieve from each Pinecone index
-
-# Pinecone Index Names (from your build scripts)
-PINECONE_INDEX_NAME_DOCS = os.getenv("PINECONE_INDEX_NAME_ATO", "ato-legal-database")
-PINECONE_INDEX_NAME_LEGIS = os.getenv("PINECONE_INDEX_NAME_LEG", "ato-rag-app")
-
-# MongoDB Database and Collection Names
-MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "ato_data")
-MONGO_COLLECTION_NAME_DOCS = os.getenv("MONGO_COLLECTION_NAME_ATO", "documents")
-MONGO_COLLECTION_NAME_LEGIS = os.getenv("MONGO_COLLECTION_NAME_LEG", "legislation")
+# Streaming render coalescing: redraw at most every RENDER_INTERVAL_MS, or sooner after RENDER_MAX_CHARS new characters
+RENDER_INTERVAL_MS = int(os.getenv("RENDER_INTERVAL_MS", "100"))
+RENDER_MAX_CHARS = int(os.getenv("RENDER_MAX_CHARS", "400"))
 
+# Metrics export in Prometheus text format (see metrics.py): METRICS_PORT serves /metrics locally, METRICS_FILE is rewritten periodically
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_FILE = os.getenv("METRICS_FILE", "")
 
 # --- Set up logging ---
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 # --- 3. Client and Resource Initialization ---
@@ -36,7 +37,8 @@ logger = logging.getLogger(__name__)
 def get_mongo_client():
     """Initialize and return MongoDB client."""
     try:
-        client = MongoClient(os.getenv("MONGO_URI"), serverSelectionTimeoutMS=5000)
+        client = MongoClient(os.getenv("MONGO_URI"), serverSelectionTimeoutMS=5000,
+                             socketTimeoutMS=int(MONGO_FETCH_TIMEOUT_SECONDS * 1000))
         client.admin.command('ping')
         logger.info("MongoDB connection successful.")
         return client
@@ -49,7 +51,7 @@ def get_mongo_client():
 def get_pinecone_client():
     """Initialize and return Pinecone client."""
     try:
-        pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+        pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"), timeout=PINECONE_QUERY_TIMEOUT_SECONDS)
         logger.info("Pinecone connection successful.")
         return pc
     except Exception as e:
@@ -57,11 +59,25 @@ def get_pinecone_client():
         st.error("Fatal: Could not connect to the vector index.")
         st.stop()
 
+@st.cache_resource
+def get_vector_index(index_name: str) -> Any:
+    """Return a queryable vector index for the configured backend."""
+    if VECTOR_BACKEND != "local":
+        return get_pinecone_client().Index(index_name)
+    try:
+        index = LocalVectorIndex(os.path.join(LOCAL_INDEX_DIR, index_name), mode=LOCAL_INDEX_MODE)
+        logger.info(f"Loaded local vector index {index_name} ({len(index.ids)} vectors, {LOCAL_INDEX_MODE} mode).")
+        return index
+    except Exception as e:
+        logger.error(f"Loading local vector index {index_name} failed: {e}")
+        st.error("Fatal: Could not load the local vector index.")
+        st.stop()
+
 @st.cache_resource
 def get_openai_client():
     """Initialize and return OpenAI client."""
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=OPENAI_REQUEST_TIMEOUT_SECONDS)
         logger.info("OpenAI client initialized.")
         return client
     except Exception as e:
@@ -69,143 +85,144 @@ def get_openai_client():
         st.error("Fatal: Could not connect to OpenAI.")
         st.stop()
 
-# --- 4. Core Application Logic ---
+class RenderScheduler:
+    """Decides when a streamed response should be redrawn, coalescing deltas between renders."""
+
+    def __init__(self, interval_ms: int = RENDER_INTERVAL_MS, max_chars: int = RENDER_MAX_CHARS):
+        self.interval = interval_ms / 1000
+        self.max_chars = max_chars
+        self.renders = 0
+        self._last_render = float("-inf")
+        self._unrendered_chars = 0
+
+    def due(self, new_chars: int) -> bool:
+        """Record new_chars more characters and return True if a render should happen now."""
+        self._unrendered_chars += new_chars
+        now = time.monotonic()
+        if now - self._last_render < self.interval and self._unrendered_chars < self.max_chars:
+            return False
+        self._last_render = now
+        self._unrendered_chars = 0
+        self.renders += 1
+        return True
+
+def render_stream(deltas: Iterable[str], placeholder: Any) -> str:
+    """Render streamed deltas into the placeholder as sanitized markdown and return the final text."""
+    sanitizer = StreamingSanitizer()
+    scheduler = RenderScheduler()
+    generation_started = time.perf_counter()
+    first_token_seen = False
+    for delta in deltas:
+        if not first_token_seen:
+            STAGE_SECONDS.observe(time.perf_counter() - generation_started, stage="first_token")
+            first_token_seen = True
+        TOKENS_STREAMED.inc()
+        sanitizer.feed(delta)
+        if scheduler.due(len(delta)):
+            placeholder.markdown(sanitizer.text() + "▌", unsafe_allow_html=True)
+
+    # Final flush always renders the complete response
+    final_text = sanitizer.text()
+    placeholder.markdown(final_text, unsafe_allow_html=True)
+    STAGE_SECONDS.observe(time.perf_counter() - generation_started, stage="generation")
+    return final_text
 
-def sanitize_response(text: str) -> str:
-    """Cleans the AI's response to fix common formatting and concatenation issues."""
-    # Remove markdown code blocks and backticks
-    text = re.sub(r'```[\s\S]*?```', '', text) # Remove entire code blocks
-    text = text.replace('`', '') # Remove inline code backticks
-
-    # Add space between numbers/commas and letters (e.g., "1000dollars" -> "1000 dollars")
-    text = re.sub(r'([,\d]+)([a-zA-Z])', r'\1 \2', text)
-    # Add space between numbers/commas and parentheses (e.g., "100(a)" -> "100 (a)")
-    text = re.sub(r'([,\d]+)([\(\)])', r'\1 \2', text)
-    return text
-
-def retrieve_context(query: str, pinecone_index_docs: Any, pinecone_index_legis: Any, 
-                     mongo_collection_docs: Any, mongo_collection_legis: Any, 
-                     openai_client: OpenAI) -> Tuple[str, List[Dict[str, Any]]]:
-    """Retrieve relevant context from multiple Pinecone indexes and MongoDB collections."""
-    if not query: return "", []
-
-    try:
-        query_embedding = openai_client.embeddings.create(input=[query], model=EMBEDDING_MODEL).data[0].embedding
-        
-        # --- Query both Pinecone indexes ---
-        logger.info(f"Querying Pinecone index: {PINECONE_INDEX_NAME_DOCS}") 
-        results_docs = pinecone_index_docs.query(vector=query_embedding, top_k=TOP_K, include_metadata=False)
-        
-        logger.info(f"Querying Pinecone index: {PINECONE_INDEX_NAME_LEGIS}") 
-        results_legis = pinecone_index_legis.query(vector=query_embedding, top_k=TOP_K, include_metadata=False)
-
-        # --- Combine and sort results ---
-        combined_matches = []
-        if results_docs and results_docs.get('matches'):
-            for match in results_docs['matches']:
-                match['source_type'] = 'document' 
-                combined_matches.append(match)
-        if results_legis and results_legis.get('matches'):
-            for match in results_legis['matches']:
-                match['source_type'] = 'legislation' 
-                combined_matches.append(match)
-        
-        # Sort by score in descending order and take top_k overall
-        combined_matches.sort(key=lambda x: x['score'], reverse=True)
-        
-        # Get unique IDs from the top_k combined matches
-        unique_result_ids = []
-        seen_ids = set()
-        for match in combined_matches:
-            if match['id'] not in seen_ids:
-                unique_result_ids.append({'id': match['id'], 'source_type': match['source_type']})
-                seen_ids.add(match['id'])
-            if len(unique_result_ids) >= TOP_K: 
-                break
-
-        if not unique_result_ids: return "", []
-
-        # --- Fetch full text from respective MongoDB collections ---
-        formatted_context = ""
-        raw_context_for_display = []
-        
-        # Separate IDs by source type to fetch efficiently
-        doc_ids_to_fetch = [item['id'] for item in unique_result_ids if item['source_type'] == 'document']
-        legis_ids_to_fetch = [item['id'] for item in unique_result_ids if item['source_type'] == 'legislation']
-
-        mongo_results = []
-        if doc_ids_to_fetch:
-            mongo_results.extend(list(mongo_collection_docs.find({"_id": {"$in": doc_ids_to_fetch}})))
-        if legis_ids_to_fetch:
-            mongo_results.extend(list(mongo_collection_legis.find({"_id": {"$in": legis_ids_to_fetch}})))
-
-        # Create a dictionary for faster lookup by _id
-        mongo_docs_map = {doc['_id']: doc for doc in mongo_results}
-
-        # Reconstruct context in order of relevance (from unique_result_ids)
-        for item in unique_result_ids:
-            doc = mongo_docs_map.get(item['id'])
-            if doc:
-                title = doc.get('title', 'Untitled')
-                text_snippet = doc.get('text', 'No text available')
-                
-                # Determine URL/Source Identifier based on type
-                if item['source_type'] == 'document':
-                    url_or_source = doc.get('url', 'No URL available')
-                    source_display_name = "Document"
-                elif item['source_type'] == 'legislation':
-                    url_or_source = doc.get('title', 'No Title') 
-                    source_display_name = "Legislation"
+@st.cache_resource
+def start_metrics_exporter() -> None:
+    """Start the configured metrics exporters once per process."""
+    register_cache_metrics()
+    if METRICS_PORT:
+        try:
+            start_http_server(METRICS_PORT)
+        except OSError as e:
+            logger.warning(f"Metrics endpoint not started on port {METRICS_PORT}: {e}")
+    if METRICS_FILE:
+        start_file_writer(METRICS_FILE)
+
+def render_sources(raw_context: List[Dict[str, Any]]) -> None:
+    """Show the retrieved sources, or a warning that there were none, in an expander."""
+    if raw_context:
+        with st.expander("Search Details: Reviewing Sources", expanded=False):
+            st.markdown("**Retrieved Sources:**")
+            for doc in raw_context:
+                if doc.get('source_type') == 'Document':
+                    link_text = f"[{doc.get('title', 'N/A')}]({doc.get('link_or_id', '#')})"
+                elif doc.get('source_type') == 'Legislation':
+                    link_text = doc.get('link_or_id', 'N/A')
                 else:
-                    url_or_source = 'N/A'
-                    source_display_name = "Unknown"
-
-                formatted_context += f"---\nSource Type: {source_display_name}\nTitle: {title}\nLink/ID: {url_or_source}\nText: {text_snippet}\n---\n\n"
-                raw_context_for_display.append({
-                    "title": title,
-                    "link_or_id": url_or_source,
-                    "source_type": source_display_name
-                })
-        
-        return formatted_context, raw_context_for_display
-
-    except Exception as e:
-        logger.error(f"Error during context retrieval: {e}")
-        st.warning(f"Error searching the database: {e}")
-        return "", []
-
+                    link_text = doc.get('title', 'N/A')
+
+                st.markdown(f"- **{doc.get('source_type', 'Unknown')}:** {link_text}")
+    else:
+        with st.expander("Search Details", expanded=True):
+            st.warning("Could not find any relevant documents in the database for this query.")
+
+def answer_question(prompt: str, resources: Dict[str, Any], placeholder: Any,
+                    show_sources: Callable[[List[Dict[str, Any]]], None] = lambda raw_context: None,
+                    status: Callable[[str], Any] = lambda text: contextlib.nullcontext()) -> str:
+    """Answer one chat question into placeholder and return the text to keep in the message history.
+
+    Runs pipeline.answer_steps, joined with any identical question in flight, in the
+    calling thread; shared with the load generator and the benchmark. show_sources gets
+    the retrieved sources before the answer renders, and status wraps the slow steps
+    (main() passes st.spinner).
+    """
+    with contextlib.ExitStack() as status_stack:
+        def handle(step: Step) -> Any:
+            kind = step[0]
+            if kind == "status":
+                status_stack.close()
+                if step[1]:
+                    status_stack.enter_context(status(step[1]))
+            elif kind == "sources":
+                show_sources(step[1])
+            elif kind == "reply":
+                _, text, reply_kind = step
+                if reply_kind == "tax_engine":
+                    text = text.replace("$", "\\$")  # Dollar amounts, not LaTeX delimiters, in st.markdown
+                placeholder.markdown(text, unsafe_allow_html=reply_kind == "answer_cache")
+                return text
+            elif kind == "generate":
+                _, question, context, openai_client, flight = step
+                stream = openai_client.chat.completions.create(model=LLM_MODEL, messages=build_messages(question, context),
+                                                               temperature=LLM_TEMPERATURE, stream=True)
+                deltas = (chunk.choices[0].delta.content for chunk in stream
+                          if chunk.choices and chunk.choices[0].delta.content is not None)
+                return render_stream(flight.relay(deltas) if flight is not None else deltas, placeholder)
+            elif kind == "follow":
+                return render_stream(step[1].follow(), placeholder)
+            else:
+                return perform_step(step)
+
+        return run_steps(answer_steps(prompt, resources, single_flight=True), handle)
+
+# Shown in the welcome message; the load generator (loadgen.py) also draws on them
+SAMPLE_QUESTIONS = [
+    "What are the common tax deductions available for individuals in Australia?",
+    "What is the primary purpose of the global minimum tax (Pillar Two)",
+    "What is the fixed ratio test within thin capitalization rules, and what are its key components?",
+    "What happens if a company does not lodge a tax return on time?",
+]
+
+WELCOME_MESSAGE = """
+<div class="welcome-message">
+    <h4>Important Information:</h4>
+    <ul>
+        <li>All data is sourced from official ATO documentation and Australian legal databases.</li>
+        <li>This tool provides only general information and is not to be considered professional tax advice.</li>
+        <li>The LLM used is a general guidance model and hence accuracy may not be perfect.</li>
+        <li>Resident income tax, Medicare levy and low income tax offset calculations are exact for the years in its tax tables; other calculations are not supported yet.</li>
+    </ul>
+    <h4>Sample Questions:</h4>
+    <ul>
+""" + "".join(f"        <li>{question}</li>\n" for question in SAMPLE_QUESTIONS) + """    </ul>
+    <hr style="margin-top: 20px; margin-bottom: 20px; border-color: #e0e0e0;">
+    <p>How can I help you today?</p>
+</div>
+"""
 
 # --- 5. Streamlit User Interface ---
 def main():
-    SYSTEM_PROMPT = """
-You are TaxAUmate, an expert AI assistant specializing in Australian Taxation Office (ATO) matters and Australian Legal Database. Your primary function is to provide accurate, factual, and helpful information based *only* on the provided context documents. You must operate under the following strict guidelines:
-
-**Guideline 1: Scope of Knowledge & Disclaimers**
-- Your knowledge is strictly limited to the information contained in the provided context.
-- If the user asks a question that requires information not present in the context, you MUST state: "I could not find specific information about this in my knowledge base. For the most accurate details, please refer to the official ATO website."
-- You are an information provider, NOT a financial advisor. For any query that asks for advice, opinions, recommendations, or "should I" type questions, you MUST respond with the following disclaimer and nothing else:
-  "I cannot provide financial advice or personal recommendations. My purpose is to supply factual information based on ATO documents. For personalized financial or tax advice, please consult a registered tax agent or a licensed financial adviser."
-
-**Guideline 2: Answering and Formatting**
-- When the query is within scope and the context contains relevant information, provide a direct and comprehensive answer.
-- Synthesize information from multiple sources in the context to create a cohesive response.
-- **CRITICAL FORMATTING RULE:** Present ALL information, including step-by-step calculations, as standard text, paragraphs, and bullet points. **DO NOT use Markdown code blocks (```) or inline code backticks (`) for any reason.** All text, especially numbers and calculations, must render in the standard user-facing font.
-- **Improved Tax Rate Handling:** If the user asks for "latest income tax rates" or similar without specifying a financial year, assume they are asking about the **most recently available financial year** in your context documents (e.g., if you have 2024-25 and 2025-26, and 2025-26 is described as "upcoming" or "current," prioritize it; otherwise, use the latest *completed* year). You MUST state this assumption in your response (e.g., "Assuming the 2025-2026 financial year based on the information available to me...").
-- **Crucially, every piece of information or claim you make must be followed by an inline citation**, like this: (Source: [Title of Document](URL/Source Identifier)).
-
-**Guideline 3: Citing Sources**
-- At the end of your entire response, include a "Sources" section.
-- List all the unique documents you cited in your response as a bulleted list, with each item formatted as: `[Title of Document](URL/Source Identifier)`.
-- If the source is legislation, use the Source Identifier (e.g., "TR_2012/5") if a URL is not available.
-
-**Workflow:**
-1.  Analyze the user's query.
-2.  Determine if it's a request for factual information that can be answered from the context.
-3.  If it's a request for advice or is out-of-scope, provide the disclaimer.
-4.  If it's a valid query, synthesize an answer from the provided context, following all formatting rules and citing sources inline.
-5.  Conclude with a list of all sources used.
-""" 
-
     st.set_page_config(
         page_title="TaxAUmate",
         layout="wide",
@@ -343,46 +360,34 @@ You are TaxAUmate, an expert AI assistant specializing in Australian Taxation Of
     """, unsafe_allow_html=True)
 
     mongo_client = get_mongo_client()
-    pinecone_client = get_pinecone_client()
     openai_client = get_openai_client()
 
-    if not (mongo_client and pinecone_client and openai_client):
+    if not (mongo_client and openai_client):
         st.error("Application cannot start due to failed service connections.")
         st.stop()
 
+    start_metrics_exporter()
+
     db = mongo_client[MONGO_DB_NAME]
     
     # Initialize both MongoDB collections
     mongo_collection_docs = db[MONGO_COLLECTION_NAME_DOCS]
     mongo_collection_legis = db[MONGO_COLLECTION_NAME_LEGIS]
     
-    # Initialize both Pinecone index objects
-    pinecone_index_docs = pinecone_client.Index(PINECONE_INDEX_NAME_DOCS)
-    pinecone_index_legis = pinecone_client.Index(PINECONE_INDEX_NAME_LEGIS)
+    # Initialize both vector index objects (Pinecone or local, per VECTOR_BACKEND)
+    pinecone_index_docs = get_vector_index(PINECONE_INDEX_NAME_DOCS)
+    pinecone_index_legis = get_vector_index(PINECONE_INDEX_NAME_LEGIS)
+    resources = {
+        "pinecone_index_docs": pinecone_index_docs,
+        "pinecone_index_legis": pinecone_index_legis,
+        "mongo_collection_docs": mongo_collection_docs,
+        "mongo_collection_legis": mongo_collection_legis,
+        "openai_client": openai_client,
+    }
 
 
     if "messages" not in st.session_state:
-        welcome_message = """
-        <div class="welcome-message">
-            <h4>Important Information:</h4>
-            <ul>
-                <li>All data is sourced from official ATO documentation and Australian legal databases.</li>
-                <li>This tool provides only general information and is not to be considered professional tax advice.</li>
-                <li>The LLM used is a general guidance model and hence accuracy may not be perfect.</li>
-                <li>This prototype model has limited features and does not perform accurate calculations yet.</li>
-            </ul>
-            <h4>Sample Questions:</h4>
-            <ul>
-                <li>What are the common tax deductions available for individuals in Australia?</li>
-                <li>What is the primary purpose of the global minimum tax (Pillar Two)</li>
-                <li>What is the fixed ratio test within thin capitalization rules, and what are its key components?</li>
-                <li>What happens if a company does not lodge a tax return on time?</li>
-            </ul>
-            <hr style="margin-top: 20px; margin-bottom: 20px; border-color: #e0e0e0;">
-            <p>How can I help you today?</p>
-        </div>
-        """
-        st.session_state.messages = [{"role": "assistant", "content": welcome_message}]
+        st.session_state.messages = [{"role": "assistant", "content": WELCOME_MESSAGE}]
 
     st.markdown("""
     <div style="display: flex; align-items: center; margin-bottom: 1.5rem;">
@@ -403,53 +408,23 @@ You are TaxAUmate, an expert AI assistant specializing in Australian Taxation Of
             st.markdown(prompt)
 
         with st.chat_message("assistant"):
-            with st.spinner("Searching the ATO knowledge base..."):
-                context, raw_context = retrieve_context(
-                    prompt, 
-                    pinecone_index_docs, 
-                    pinecone_index_legis, 
-                    mongo_collection_docs, 
-                    mongo_collection_legis, 
-                    openai_client
-                )
-                if raw_context:
-                    with st.expander("Search Details: Reviewing Sources", expanded=False):
-                        st.markdown("**Retrieved Sources:**")
-                        for doc in raw_context:
-                            if doc.get('source_type') == 'Document':
-                                link_text = f"[{doc.get('title', 'N/A')}]({doc.get('link_or_id', '#')})"
-                            elif doc.get('source_type') == 'Legislation':
-                                link_text = doc.get('link_or_id', 'N/A')
-                            else:
-                                link_text = doc.get('title', 'N/A')
-
-                            st.markdown(f"- **{doc.get('source_type', 'Unknown')}:** {link_text}")
-                else:
-                    with st.expander("Search Details", expanded=True):
-                        st.warning("Could not find any relevant documents in the database for this query.")
-
-            with st.spinner("Synthesizing information and generating response..."):
-                try:
-                    messages_for_api = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": f"CONTEXT:\n{context}\n\nQUESTION:\n{prompt}"}]
-                    stream = openai_client.chat.completions.create(model=LLM_MODEL, messages=messages_for_api, temperature=0.1, stream=True)
-                    
-                    full_response = ""
-                    placeholder = st.empty()
-                    for chunk in stream:
-                        if chunk.choices[0].delta.content is not None:
-                            full_response += chunk.choices[0].delta.content
-                            placeholder.markdown(sanitize_response(full_response) + "▌", unsafe_allow_html=True)
-                    
-                    sanitized_final_response = sanitize_response(full_response)
-                    placeholder.markdown(sanitized_final_response, unsafe_allow_html=True)
-                    
-                    st.session_state.messages.append({"role": "assistant", "content": sanitized_final_response})
-
-                except Exception as e:
-                    logger.error(f"Error during OpenAI API call: {e}")
-                    error_message = "I apologize, but I encountered an error. Please try rephrasing your question."
-                    st.error(error_message)
-                    st.session_state.messages.append({"role": "assistant", "content": error_message})
+            sources_area = st.container()
+            placeholder = st.empty()
+
+            def show_sources(raw_context: List[Dict[str, Any]]) -> None:
+                with sources_area:
+                    render_sources(raw_context)
+
+            try:
+                answer = answer_question(prompt, resources, placeholder, show_sources=show_sources, status=st.spinner)
+            except RetrievalError as e:
+                st.warning(str(e))
+                answer = "I apologize, but I couldn't search the knowledge base just now. Please try again."
+                st.error(answer)
+            except Exception:
+                answer = "I apologize, but I encountered an error. Please try rephrasing your question."
+                st.error(answer)
+            st.session_state.messages.append({"role": "assistant", "content": answer})
 
     st.markdown("""
     <div style="margin-top: 50px; padding-top: 20px; border-top: 1px solid #e0e0e0; text-align: center; font-size: 12px; color: #6c757d;">
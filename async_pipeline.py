@@ -0,0 +1,271 @@
+"""Asyncio driver for the TaxAUmate question flow in pipeline.py.
+
+retrieve_context_async() and answer_question_async() run the same steps as
+pipeline.retrieve_context and app.answer_question, awaiting only the I/O, so one
+event loop can serve many overlapping conversations instead of tying up a
+thread per question. Clients may be the native async ones (AsyncOpenAI,
+Pinecone's AsyncIndex, pymongo's AsyncMongoClient) or any stand-in exposing
+the same methods; synchronous methods (e.g. LocalVectorIndex.query) and the
+pipeline's blocking work (version file checks, token counting) run in a worker
+thread so they never block the loop. Nothing here imports Streamlit.
+"""
+import asyncio
+import inspect
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional, Tuple
+
+from openai import AsyncOpenAI
+
+from pipeline import (
+    EMBEDDING_MODEL, LLM_MODEL, LLM_TEMPERATURE, CHUNK_PROJECTION, EMBEDDING_REQUEST_TIMEOUT_SECONDS,
+    PINECONE_QUERY_TIMEOUT_SECONDS, MONGO_FETCH_TIMEOUT_SECONDS, OPENAI_REQUEST_TIMEOUT_SECONDS,
+    PINECONE_INDEX_NAME_DOCS, PINECONE_INDEX_NAME_LEGIS, MONGO_DB_NAME, MONGO_COLLECTION_NAME_DOCS, MONGO_COLLECTION_NAME_LEGIS,
+    VECTOR_BACKEND, LOCAL_INDEX_MODE, Step, Steps, StreamingSanitizer,
+    normalize_query, get_embedding_cache, get_embedding_store, get_chunk_cache, build_messages,
+    answer_steps, retrieval_steps,
+)
+from metrics import STAGE_SECONDS, ERRORS, TOKENS_STREAMED, time_stage
+from vector_index import LocalVectorIndex, LOCAL_INDEX_DIR
+
+logger = logging.getLogger(__name__)
+
+
+async def _call(method: Any, *args, **kwargs) -> Any:
+    """Await an async method, or run a blocking one in a worker thread."""
+    if inspect.iscoroutinefunction(method):
+        return await method(*args, **kwargs)
+    result = await asyncio.to_thread(method, *args, **kwargs)
+    return await result if inspect.isawaitable(result) else result
+
+
+async def fan_out_async(tasks: Dict[str, Awaitable[Any]], timeout: float, stage: str = "fan_out") -> Dict[str, Any]:
+    """Await named tasks concurrently; tasks that fail or miss the timeout come back as None.
+
+    As in pipeline.fan_out, each task's duration is recorded under the stage with its name
+    as target, and the whole fan-out under target "all".
+    """
+    async def timed(name: str, task: Awaitable[Any]) -> Any:
+        start = time.perf_counter()
+        try:
+            return await task
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage, target=name)
+
+    with time_stage(stage, "all"):
+        futures = {name: asyncio.ensure_future(timed(name, task)) for name, task in tasks.items()}
+        _, pending = await asyncio.wait(futures.values(), timeout=timeout)
+
+    results = {}
+    for name, future in futures.items():
+        if future in pending:
+            future.cancel()
+            logger.warning(f"{name} did not respond within {timeout}s; continuing without it.")
+            ERRORS.inc(stage=stage, target=name, kind="timeout")
+            results[name] = None
+        elif future.exception() is not None:
+            logger.error(f"{name} failed: {future.exception()}")
+            ERRORS.inc(stage=stage, target=name, kind="exception")
+            results[name] = None
+        else:
+            results[name] = future.result()
+    return results
+
+
+async def embed_query_async(query: str, openai_client: AsyncOpenAI) -> List[float]:
+    """Async counterpart of pipeline.embed_query, sharing its memory cache and disk store."""
+    cache = get_embedding_cache()
+    embedding = cache.get(query)
+    if embedding is not None:
+        return embedding
+
+    store = get_embedding_store()
+    key = normalize_query(query)
+    if store is not None:
+        try:
+            embedding = await asyncio.to_thread(store.get, key, EMBEDDING_MODEL)
+        except Exception as e:
+            logger.warning(f"Embedding store read failed: {e}")
+
+    if embedding is None:
+        with time_stage("embed"):
+            response = await _call(openai_client.embeddings.create, input=[query], model=EMBEDDING_MODEL,
+                                   timeout=EMBEDDING_REQUEST_TIMEOUT_SECONDS)
+        embedding = response.data[0].embedding
+        if store is not None:
+            try:
+                await asyncio.to_thread(store.put, key, embedding, EMBEDDING_MODEL)
+            except Exception as e:
+                logger.warning(f"Embedding store write failed: {e}")
+
+    cache.put(query, embedding)
+    return embedding
+
+
+async def fetch_chunks_async(collection: Any, collection_name: str, ids: List[Any],
+                             stamp: Optional[Tuple[Tuple[str, str], ...]] = None) -> List[Dict[str, Any]]:
+    """Async counterpart of pipeline.fetch_chunks, sharing its chunk cache."""
+    if not ids:
+        return []
+    cache = get_chunk_cache()
+    cached = cache.get_many(collection_name, ids, stamp)
+    missing_ids = [doc_id for doc_id in ids if doc_id not in cached]
+    fetched = []
+    if missing_ids:
+        cursor = collection.find({"_id": {"$in": missing_ids}}, projection=CHUNK_PROJECTION, batch_size=len(missing_ids))
+        if inspect.iscoroutinefunction(getattr(cursor, "to_list", None)):
+            fetched = await cursor.to_list(None)
+        else:
+            fetched = await asyncio.to_thread(list, cursor)
+    cache.put_many(collection_name, fetched, stamp)
+    return list(cached.values()) + fetched
+
+
+async def perform_step_async(step: Step) -> Any:
+    """Async counterpart of pipeline.perform_step: await the I/O, run blocking calls in a worker thread."""
+    kind = step[0]
+    if kind == "embed":
+        return await embed_query_async(*step[1:])
+    if kind == "fetch":
+        return await fetch_chunks_async(*step[1:])
+    if kind == "call":
+        return await _call(*step[1:])
+    if kind == "fan_out":
+        tasks, timeout, stage = step[1:]
+        return await fan_out_async({name: perform_step_async(task) for name, task in tasks.items()}, timeout, stage)
+    raise ValueError(f"Unknown step {kind!r}")
+
+
+async def run_steps_async(steps: Steps) -> Any:
+    """Async counterpart of pipeline.run_steps, for steps that perform_step_async handles."""
+    result = error = None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as done:
+            return done.value
+        result = error = None
+        try:
+            result = await perform_step_async(step)
+        except BaseException as e:
+            error = e
+
+
+async def retrieve_context_async(query: str, pinecone_index_docs: Any, pinecone_index_legis: Any,
+                                 mongo_collection_docs: Any, mongo_collection_legis: Any,
+                                 openai_client: AsyncOpenAI,
+                                 timings: Optional[Dict[str, float]] = None) -> Tuple[str, List[Dict[str, Any]]]:
+    """Async counterpart of pipeline.retrieve_context with the same arguments and return value.
+
+    If a timings dict is given, per-stage durations in seconds are recorded into it.
+    """
+    return await run_steps_async(retrieval_steps(query, pinecone_index_docs, pinecone_index_legis,
+                                                 mongo_collection_docs, mongo_collection_legis, openai_client, timings))
+
+
+async def stream_answer_async(prompt: str, context: str, openai_client: AsyncOpenAI) -> AsyncIterator[str]:
+    """Yield the raw text deltas of the streamed completion for a question and its context."""
+    stream = await _call(openai_client.chat.completions.create, model=LLM_MODEL, messages=build_messages(prompt, context),
+                         temperature=LLM_TEMPERATURE, stream=True)
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content is not None:
+            yield chunk.choices[0].delta.content
+
+
+async def answer_question_async(question: str, resources: Dict[str, Any],
+                                timings: Optional[Dict[str, float]] = None) -> AsyncIterator[Tuple[str, Any]]:
+    """Run pipeline.answer_steps for one question, as main() does, yielding events as they happen.
+
+    Yields ("sources", raw_context), then ("token", text) with each new piece of the
+    sanitized answer, then ("answer", sanitized_full_answer). If a timings dict is
+    given, per-stage durations in seconds are recorded into it.
+    """
+    steps = answer_steps(question, resources, timings=timings)
+    sources_sent = False
+    result = error = None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as done:
+            yield "answer", done.value
+            return
+        result = error = None
+        kind = step[0]
+        try:
+            if kind == "status":
+                pass
+            elif kind == "sources":
+                sources_sent = True
+                yield "sources", step[1]
+            elif kind == "reply":
+                if not sources_sent:
+                    sources_sent = True
+                    yield "sources", []
+                yield "token", step[1]
+                result = step[1]
+            elif kind == "generate":
+                _, prompt, context, openai_client, _ = step
+                sanitizer = StreamingSanitizer()
+                sent = 0
+                generation_started = time.perf_counter()
+                first_token_seen = False
+                async for delta in stream_answer_async(prompt, context, openai_client):
+                    if not first_token_seen:
+                        first_token_seen = True
+                        elapsed = time.perf_counter() - generation_started
+                        STAGE_SECONDS.observe(elapsed, stage="first_token")
+                        if timings is not None:
+                            timings["first_token"] = elapsed
+                    TOKENS_STREAMED.inc()
+                    sanitizer.feed(delta)
+                    stable = sanitizer.stable_text()
+                    if len(stable) > sent:
+                        yield "token", stable[sent:]
+                        sent = len(stable)
+                result = sanitizer.text()
+                STAGE_SECONDS.observe(time.perf_counter() - generation_started, stage="generation")
+                if len(result) > sent:
+                    yield "token", result[sent:]
+            else:
+                result = await perform_step_async(step)
+        except BaseException as e:
+            error = e
+
+
+async def create_async_resources() -> Dict[str, Any]:
+    """Create the async clients, keyed by retrieve_context_async's parameter names."""
+    from pinecone import PineconeAsyncio
+    from pymongo import AsyncMongoClient
+
+    mongo_client = AsyncMongoClient(os.getenv("MONGO_URI"), serverSelectionTimeoutMS=5000,
+                                    socketTimeoutMS=int(MONGO_FETCH_TIMEOUT_SECONDS * 1000))
+    db = mongo_client[MONGO_DB_NAME]
+    resources: Dict[str, Any] = {
+        "mongo_collection_docs": db[MONGO_COLLECTION_NAME_DOCS],
+        "mongo_collection_legis": db[MONGO_COLLECTION_NAME_LEGIS],
+        "openai_client": AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=OPENAI_REQUEST_TIMEOUT_SECONDS),
+        "_closers": [mongo_client.close],
+    }
+
+    if VECTOR_BACKEND == "local":
+        for key, name in (("pinecone_index_docs", PINECONE_INDEX_NAME_DOCS), ("pinecone_index_legis", PINECONE_INDEX_NAME_LEGIS)):
+            resources[key] = LocalVectorIndex(os.path.join(LOCAL_INDEX_DIR, name), mode=LOCAL_INDEX_MODE)
+    else:
+        pinecone_client = PineconeAsyncio(api_key=os.getenv("PINECONE_API_KEY"), timeout=PINECONE_QUERY_TIMEOUT_SECONDS)
+        for key, name in (("pinecone_index_docs", PINECONE_INDEX_NAME_DOCS), ("pinecone_index_legis", PINECONE_INDEX_NAME_LEGIS)):
+            description = await pinecone_client.describe_index(name)
+            resources[key] = pinecone_client.IndexAsyncio(host=description.host)
+            resources["_closers"].append(resources[key].close)
+        resources["_closers"].append(pinecone_client.close)
+    resources["_closers"].append(resources["openai_client"].close)
+    return resources
+
+
+async def close_async_resources(resources: Dict[str, Any]) -> None:
+    """Close every client opened by create_async_resources."""
+    for close in resources.get("_closers", []):
+        try:
+            await _call(close)
+        except Exception as e:
+            logger.warning(f"Error while closing client: {e}")
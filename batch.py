@@ -0,0 +1,113 @@
+"""Batch question answering over a JSONL file, using the same pipeline as the app.
+
+Each input line is {"id": "...", "question": "..."} ("id" defaults to the line
+number). Each output line holds the answer, sources and per-stage timings in
+seconds, written as soon as the item finishes. Items already answered in the
+output file are skipped, so an interrupted run resumes where it stopped.
+
+Usage:
+    python batch.py questions.jsonl answers.jsonl --concurrency 16
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, Iterator, Set, Tuple
+
+from async_pipeline import answer_question_async, create_async_resources, close_async_resources
+
+logger = logging.getLogger(__name__)
+
+
+def read_questions(path: str) -> Iterator[Tuple[str, str]]:
+    """Yield (id, question) pairs from a JSONL file, skipping blank lines."""
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            yield str(item.get("id", line_number)), item["question"]
+
+
+def completed_ids(path: str) -> Set[str]:
+    """Return the ids that already have an answer (not an error) in the output file."""
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by an interrupted run is redone
+            if "error" not in record:
+                done.add(record["id"])
+    return done
+
+
+async def answer_one(item_id: str, question: str, resources: Dict[str, Any]) -> Dict[str, Any]:
+    """Answer one question and return its output record."""
+    record: Dict[str, Any] = {"id": item_id, "question": question}
+    timings: Dict[str, float] = {}
+    try:
+        async for event, data in answer_question_async(question, resources, timings=timings):
+            if event == "sources":
+                record["sources"] = data
+            elif event == "answer":
+                record["answer"] = data
+    except Exception as e:
+        logger.error(f"Question {item_id} failed: {e}")
+        record["error"] = str(e)
+    record["timings"] = {stage: round(seconds, 4) for stage, seconds in timings.items()}
+    return record
+
+
+async def run_batch(input_path: str, output_path: str, concurrency: int) -> int:
+    """Answer every unfinished question with at most `concurrency` in flight; return the number processed."""
+    done = completed_ids(output_path)
+    pending = ((item_id, question) for item_id, question in read_questions(input_path) if item_id not in done)
+    if done:
+        logger.info(f"Resuming: {len(done)} questions already answered.")
+
+    resources = await create_async_resources()
+    processed = 0
+    try:
+        with open(output_path, "a", encoding="utf-8") as out:
+            if out.tell() > 0:
+                # Terminate a line left half-written by an interrupted run
+                with open(output_path, "rb") as existing:
+                    existing.seek(-1, os.SEEK_END)
+                    if existing.read(1) != b"\n":
+                        out.write("\n")
+
+            async def worker() -> None:
+                nonlocal processed
+                for item_id, question in pending:
+                    record = await answer_one(item_id, question, resources)
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                    processed += 1
+                    if processed % 100 == 0:
+                        logger.info(f"Processed {processed} questions...")
+
+            # Workers share one generator, so each question is taken exactly once
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        await close_async_resources(resources)
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions with the TaxAUmate pipeline.")
+    parser.add_argument("input", help="JSONL file with a 'question' (and optional 'id') per line")
+    parser.add_argument("output", help="JSONL file to append answers to; existing answers are skipped")
+    parser.add_argument("--concurrency", type=int, default=8, help="Questions in flight at once (default: %(default)s)")
+    args = parser.parse_args()
+
+    processed = asyncio.run(run_batch(args.input, args.output, args.concurrency))
+    logger.info(f"Batch finished: {processed} questions answered.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+"""Offline latency benchmark for the retrieval and answer pipeline.
+
+Runs the app's own code (main()'s question flow in app.answer_question, or the
+async pipeline) against in-process stand-ins for OpenAI, the two vector indexes
+and the two MongoDB collections. Each stand-in sleeps for a latency drawn from
+its own distribution, so no network access or API keys are needed and a fixed
+seed makes runs comparable across changes. The report gives p50/p95/p99 for
+every stage recorded in metrics.STAGE_SECONDS and for each question end to end.
+
+Latencies are given in milliseconds as MEDIAN or MEDIAN:P99 and drawn from a
+log-normal distribution with that median and 99th percentile. App settings
+(caches, batching window, inline metadata...) are read from the environment as
+usual, e.g. EMBEDDING_BATCH_WINDOW_MS=0 python bench.py.
+
+Usage:
+    python bench.py --iterations 200
+    python bench.py --pipeline async --concurrency 16 --search-latency 40:200 --json results.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import numpy as np
+
+import app
+import pipeline
+from async_pipeline import answer_question_async
+from metrics import STAGE_SECONDS
+from vector_index import encode_chunk_metadata
+
+Z_99 = 2.3263  # Standard normal 99th percentile
+
+WORDS = ("tax", "income", "deduction", "GST", "company", "trust", "residency", "capital", "gains", "ruling",
+         "offset", "superannuation", "lodgment", "penalty", "depreciation", "thin", "capitalisation", "Pillar",
+         "Two", "fringe", "benefits", "withholding", "dividend", "franking", "loss", "carry-forward")
+
+ANSWER_TEXT = (
+    "Under **section 8-1** of the *Income Tax Assessment Act 1997*, you can deduct a loss or outgoing "
+    "to the extent it is incurred in gaining or producing your assessable income [Source: Deductions]. "
+    "Key points:\n\n1. The expense must have a sufficient connection to earning income.\n"
+    "2. Private or domestic expenses are not deductible; see TR 2020/1.\n"
+    "3. Capital expenses may instead be depreciated under Division 40.\n\n"
+)
+
+
+class Latency:
+    """Log-normal latency distribution with a given median and 99th percentile, in milliseconds."""
+
+    def __init__(self, median_ms: float, p99_ms: Optional[float] = None, seed: int = 0):
+        self.median = median_ms / 1000
+        p99 = (p99_ms if p99_ms is not None else median_ms) / 1000
+        self.sigma = math.log(p99 / self.median) / Z_99 if self.median > 0 and p99 > self.median else 0.0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec: str, seed: int = 0) -> "Latency":
+        median, _, p99 = spec.partition(":")
+        return cls(float(median), float(p99) if p99 else None, seed)
+
+    def sample(self) -> float:
+        """Return one latency in seconds."""
+        if self.sigma == 0.0:
+            return self.median
+        with self._lock:
+            return self.median * math.exp(self._random.gauss(0.0, self.sigma))
+
+    def sleep(self) -> None:
+        time.sleep(self.sample())
+
+    async def sleep_async(self) -> None:
+        await asyncio.sleep(self.sample())
+
+
+def _chunk(content: str) -> Any:
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=content))])
+
+
+class FakeOpenAI:
+    """Embeddings and streamed chat completions with injected latency, in the OpenAI client's shape.
+
+    Embeddings are derived from a hash of the text, so repeated questions embed identically.
+    """
+
+    def __init__(self, dimension: int, embed_latency: Latency, first_token_latency: Latency,
+                 token_latency: Latency, answer_tokens: int, asynchronous: bool = False):
+        self.dimension = dimension
+        self.embed_latency = embed_latency
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        text = (ANSWER_TEXT * (answer_tokens * 4 // len(ANSWER_TEXT) + 1))[:answer_tokens * 4]
+        self.tokens = [text[i:i + 4] for i in range(0, len(text), 4)]
+        if asynchronous:
+            self.embeddings = types.SimpleNamespace(create=self._embed_async)
+            self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._complete_async))
+        else:
+            self.embeddings = types.SimpleNamespace(create=self._embed)
+            self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._complete))
+
+    def vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimension)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _embedding_response(self, texts: List[str]) -> Any:
+        return types.SimpleNamespace(data=[types.SimpleNamespace(index=i, embedding=self.vector(text))
+                                           for i, text in enumerate(texts)])
+
+    def _embed(self, input: List[str], model: str, **kwargs) -> Any:
+        self.embed_latency.sleep()
+        return self._embedding_response(input)
+
+    async def _embed_async(self, input: List[str], model: str, **kwargs) -> Any:
+        await self.embed_latency.sleep_async()
+        return self._embedding_response(input)
+
+    def _complete(self, **kwargs) -> Iterator[Any]:
+        def stream() -> Iterator[Any]:
+            self.first_token_latency.sleep()
+            for i, token in enumerate(self.tokens):
+                if i:
+                    self.token_latency.sleep()
+                yield _chunk(token)
+        return stream()
+
+    async def _complete_async(self, **kwargs) -> AsyncIterator[Any]:
+        async def stream() -> AsyncIterator[Any]:
+            await self.first_token_latency.sleep_async()
+            for i, token in enumerate(self.tokens):
+                if i:
+                    await self.token_latency.sleep_async()
+                yield _chunk(token)
+        return stream()
+
+
+class Corpus:
+    """Synthetic chunks for one index/collection pair: unit vectors plus title, url and text."""
+
+    def __init__(self, prefix: str, size: int, dimension: int, chunk_words: int, seed: int):
+        rng = np.random.default_rng(seed)
+        vectors = rng.standard_normal((size, dimension)).astype(np.float32)
+        self.vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.ids = [f"{prefix}-{i}" for i in range(size)]
+        words = np.array(WORDS)
+        self.docs = {
+            doc_id: {"_id": doc_id, "title": f"{prefix.title()} {i}", "url": f"https://example.invalid/{prefix}/{i}",
+                     "text": " ".join(rng.choice(words, chunk_words))}
+            for i, doc_id in enumerate(self.ids)
+        }
+
+
+class FakeVectorIndex:
+    """Exact search over a Corpus with injected latency, returning Pinecone-shaped results."""
+
+    def __init__(self, corpus: Corpus, latency: Latency):
+        self.corpus = corpus
+        self.latency = latency
+
+    def _search(self, vector: List[float], top_k: int, include_metadata: bool) -> Dict[str, Any]:
+        scores = self.corpus.vectors @ np.asarray(vector, dtype=np.float32)
+        top = np.argpartition(-scores, min(top_k, len(scores) - 1))[:top_k]
+        matches = []
+        for i in top[np.argsort(-scores[top])]:
+            match = {"id": self.corpus.ids[i], "score": float(scores[i])}
+            if include_metadata:
+                match["metadata"] = encode_chunk_metadata(self.corpus.docs[self.corpus.ids[i]])
+            matches.append(match)
+        return {"matches": matches}
+
+    def query(self, vector: List[float], top_k: int, include_metadata: bool = False, **kwargs) -> Dict[str, Any]:
+        self.latency.sleep()
+        return self._search(vector, top_k, include_metadata)
+
+
+class FakeAsyncVectorIndex(FakeVectorIndex):
+    async def query(self, vector: List[float], top_k: int, include_metadata: bool = False, **kwargs) -> Dict[str, Any]:
+        await self.latency.sleep_async()
+        return self._search(vector, top_k, include_metadata)
+
+
+class FakeCollection:
+    """MongoDB collection stand-in answering {'_id': {'$in': [...]}} finds with injected latency."""
+
+    def __init__(self, corpus: Corpus, latency: Latency):
+        self.corpus = corpus
+        self.latency = latency
+
+    def _matching(self, query: Dict[str, Any], projection: Optional[Dict[str, int]]) -> List[Dict[str, Any]]:
+        docs = [self.corpus.docs[doc_id] for doc_id in query["_id"]["$in"] if doc_id in self.corpus.docs]
+        if projection:
+            return [{key: value for key, value in doc.items() if key == "_id" or key in projection} for doc in docs]
+        return [dict(doc) for doc in docs]
+
+    def find(self, query: Dict[str, Any], projection: Optional[Dict[str, int]] = None, **kwargs) -> List[Dict[str, Any]]:
+        self.latency.sleep()
+        return self._matching(query, projection)
+
+
+class _AsyncCursor:
+    def __init__(self, collection: "FakeAsyncCollection", docs: List[Dict[str, Any]]):
+        self.collection = collection
+        self.docs = docs
+
+    async def to_list(self, length: Optional[int] = None) -> List[Dict[str, Any]]:
+        await self.collection.latency.sleep_async()
+        return self.docs
+
+
+class FakeAsyncCollection(FakeCollection):
+    def find(self, query: Dict[str, Any], projection: Optional[Dict[str, int]] = None, **kwargs) -> _AsyncCursor:
+        return _AsyncCursor(self, self._matching(query, projection))
+
+
+class FakePlaceholder:
+    """Stands in for st.empty(), counting renders and the time spent in them."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.renders = 0
+
+    def markdown(self, body: str, unsafe_allow_html: bool = False) -> None:
+        self.latency.sleep()
+        self.renders += 1
+
+
+def make_questions(count: int, repeat_ratio: float, seed: int) -> List[str]:
+    """Return synthetic questions; roughly repeat_ratio of them repeat an earlier one."""
+    rng = random.Random(seed)
+    questions: List[str] = []
+    for _ in range(count):
+        if questions and rng.random() < repeat_ratio:
+            questions.append(rng.choice(questions))
+        else:
+            questions.append("What are the " + " ".join(rng.choices(WORDS, k=6)) + " rules?")
+    return questions
+
+
+def percentile_report(samples: Dict[str, List[float]]) -> Dict[str, Dict[str, float]]:
+    """Summarise each stage's samples (seconds) as count, mean and p50/p95/p99 in milliseconds."""
+    report = {}
+    for stage, values in sorted(samples.items()):
+        data = np.asarray(values) * 1000
+        p50, p95, p99 = np.percentile(data, [50, 95, 99])
+        report[stage] = {"count": len(values), "mean_ms": float(data.mean()),
+                         "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+    return report
+
+
+def add_fake_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the options that shape the fakes (latencies, corpus, answers) to a parser."""
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--embed-latency", default="80:300", help="Embedding call, MEDIAN[:P99] ms (default: %(default)s)")
+    parser.add_argument("--search-latency", default="40:150", help="Each vector index query (default: %(default)s)")
+    parser.add_argument("--fetch-latency", default="10:60", help="Each MongoDB find (default: %(default)s)")
+    parser.add_argument("--first-token-latency", default="500:1500", help="Chat completion time to first token (default: %(default)s)")
+    parser.add_argument("--token-latency", default="15:60", help="Gap between streamed tokens (default: %(default)s)")
+    parser.add_argument("--render-latency", default="0", help="Each placeholder render, sync pipeline only (default: %(default)s)")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="Tokens per streamed answer (default: %(default)s)")
+    parser.add_argument("--corpus-size", type=int, default=5000, help="Chunks per index (default: %(default)s)")
+    parser.add_argument("--dimension", type=int, default=256, help="Embedding dimension (default: %(default)s)")
+    parser.add_argument("--chunk-words", type=int, default=300, help="Words per chunk (default: %(default)s)")
+
+
+def build_fakes(args: argparse.Namespace, asynchronous: bool = False) -> Dict[str, Any]:
+    """Return fake clients keyed by retrieve_context's parameter names."""
+    latency = lambda spec, offset: Latency.parse(spec, args.seed + offset)
+    index_type = FakeAsyncVectorIndex if asynchronous else FakeVectorIndex
+    collection_type = FakeAsyncCollection if asynchronous else FakeCollection
+    docs = Corpus("document", args.corpus_size, args.dimension, args.chunk_words, args.seed + 10)
+    legis = Corpus("legislation", args.corpus_size, args.dimension, args.chunk_words, args.seed + 11)
+    return {
+        "pinecone_index_docs": index_type(docs, latency(args.search_latency, 4)),
+        "pinecone_index_legis": index_type(legis, latency(args.search_latency, 5)),
+        "mongo_collection_docs": collection_type(docs, latency(args.fetch_latency, 6)),
+        "mongo_collection_legis": collection_type(legis, latency(args.fetch_latency, 7)),
+        "openai_client": FakeOpenAI(args.dimension, latency(args.embed_latency, 1), latency(args.first_token_latency, 2),
+                                    latency(args.token_latency, 3), args.answer_tokens, asynchronous),
+    }
+
+
+def disable_intent_audit() -> None:
+    """Keep synthetic questions out of the production intent audit log."""
+    pipeline.get_intent_audit_log().path = ""
+
+
+def quiet_app_logs() -> None:
+    """Drop the app's per-question INFO lines, which would swamp the report."""
+    logging.getLogger(app.__name__).setLevel(logging.WARNING)
+    logging.getLogger(pipeline.__name__).setLevel(logging.WARNING)
+    logging.getLogger("async_pipeline").setLevel(logging.WARNING)
+    logging.getLogger("intent").setLevel(logging.WARNING)
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        disable_intent_audit()
+        self.retrieval_args = build_fakes(args, asynchronous=args.pipeline == "async")
+        self.render_latency = Latency.parse(args.render_latency, args.seed + 8)
+        self.samples: Dict[str, List[float]] = {}
+        self.renders: List[int] = []
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def _on_stage(self, seconds: float, labels: Dict[str, str]) -> None:
+        target = labels.get("target")
+        self.record(f"{labels['stage']}[{target}]" if target else labels["stage"], seconds)
+
+    def answer_sync(self, question: str) -> None:
+        """One question through main()'s flow (app.answer_question), rendering into a fake placeholder."""
+        started = time.perf_counter()
+        placeholder = FakePlaceholder(self.render_latency)
+        app.answer_question(question, self.retrieval_args, placeholder)
+        with self._lock:
+            self.renders.append(placeholder.renders)
+        self.record("end_to_end", time.perf_counter() - started)
+
+    async def answer_async(self, question: str) -> None:
+        started = time.perf_counter()
+        async for _ in answer_question_async(question, self.retrieval_args):
+            pass
+        self.record("end_to_end", time.perf_counter() - started)
+
+    def run(self) -> Dict[str, Any]:
+        questions = make_questions(self.args.warmup + self.args.iterations, self.args.repeat_ratio, self.args.seed)
+        warmup, measured = questions[:self.args.warmup], questions[self.args.warmup:]
+        self._execute(warmup)
+        self.samples.clear()
+        self.renders.clear()
+
+        STAGE_SECONDS.add_listener(self._on_stage)
+        started = time.perf_counter()
+        try:
+            self._execute(measured)
+        finally:
+            STAGE_SECONDS.remove_listener(self._on_stage)
+        wall_seconds = time.perf_counter() - started
+
+        return {
+            "config": vars(self.args),
+            "wall_seconds": wall_seconds,
+            "questions_per_second": len(measured) / wall_seconds if wall_seconds else 0.0,
+            "mean_renders_per_answer": float(np.mean(self.renders)) if self.renders else None,
+            "stages": percentile_report(self.samples),
+        }
+
+    def _execute(self, questions: List[str]) -> None:
+        if self.args.pipeline == "async":
+            asyncio.run(self._execute_async(questions))
+        else:
+            with ThreadPoolExecutor(max_workers=self.args.concurrency, thread_name_prefix="bench") as executor:
+                list(executor.map(self.answer_sync, questions))
+
+    async def _execute_async(self, questions: List[str]) -> None:
+        pending = iter(questions)
+
+        async def worker() -> None:
+            for question in pending:
+                await self.answer_async(question)
+
+        # Workers share one iterator, so each question is taken exactly once
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+
+
+def print_report(result: Dict[str, Any]) -> None:
+    print(f"{'stage':<36} {'count':>6} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}   (ms)")
+    for stage, row in result["stages"].items():
+        print(f"{stage:<36} {row['count']:>6} {row['mean_ms']:>9.1f} {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f}")
+    print(f"\n{result['questions_per_second']:.1f} questions/s over {result['wall_seconds']:.1f}s")
+    if result["mean_renders_per_answer"] is not None:
+        print(f"{result['mean_renders_per_answer']:.1f} renders per answer")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the TaxAUmate pipeline against in-process fakes with injected latency.")
+    parser.add_argument("--pipeline", choices=("sync", "async"), default="sync",
+                        help="sync: main()'s question flow and render loop; async: async_pipeline (default: %(default)s)")
+    parser.add_argument("--iterations", type=int, default=200, help="Measured questions (default: %(default)s)")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured questions run first (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Questions in flight at once (default: %(default)s)")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="Share of questions that repeat an earlier one (default: %(default)s)")
+    add_fake_arguments(parser)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's per-question log lines")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        quiet_app_logs()
+
+    result = Benchmark(args).run()
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
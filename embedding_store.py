@@ -0,0 +1,228 @@
+"""Disk-backed query embedding store shared by all app processes on a host.
+
+Entries live in a SQLite database (key -> row number) next to a flat float32
+matrix file that readers memory-map. SQLite's write lock serialises writers
+across processes, so appends to the matrix never interleave. Compaction writes
+a new matrix file named after the next generation and commits the renumbered
+rows together with that generation, so a reader always pairs row numbers with
+the file they index.
+
+Usage:
+    python embedding_store.py stats
+    python embedding_store.py compact [--max-age-days N]
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", ".embedding_store")
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """Persistent (model, normalized query) -> embedding store backed by SQLite and a memory-mapped matrix."""
+
+    def __init__(self, directory: str = EMBEDDING_STORE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.db_path = os.path.join(directory, "embeddings.sqlite3")
+        self._local = threading.local()
+        self._map_lock = threading.Lock()
+        self._matrix: Optional[np.memmap] = None
+        self._matrix_generation = -1
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, key TEXT NOT NULL, row INTEGER NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (model, key))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('generation', 0)")
+        matrix_path = self._matrix_path(self._meta(conn, "generation"))
+        if not os.path.exists(matrix_path):
+            open(matrix_path, "ab").close()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's SQLite connection (connections are not shared across threads)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _meta(self, conn: sqlite3.Connection, name: str) -> Optional[int]:
+        row = conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _matrix_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"embeddings.{generation}.f32")
+
+    @staticmethod
+    def _rows_on_disk(path: str, dim: int) -> int:
+        try:
+            return os.path.getsize(path) // (dim * 4)
+        except FileNotFoundError:
+            return 0
+
+    def _mapped_row(self, row: int, dim: int, generation: int) -> Optional[np.ndarray]:
+        """Read one row, remapping the matrix file if it grew or was compacted since it was mapped."""
+        with self._map_lock:
+            matrix = self._matrix
+            if matrix is None or generation != self._matrix_generation or row >= matrix.shape[0]:
+                path = self._matrix_path(generation)
+                rows = self._rows_on_disk(path, dim)
+                if row >= rows:
+                    return None
+                try:
+                    matrix = np.memmap(path, dtype="<f4", mode="r", shape=(rows, dim))
+                except FileNotFoundError:
+                    return None  # Compacted away since the lookup; the caller retries
+                self._matrix = matrix
+                self._matrix_generation = generation
+            return np.array(matrix[row])
+
+    def get(self, key: str, model: str) -> Optional[List[float]]:
+        """Return the stored embedding for a normalized query key, or None."""
+        conn = self._connect()
+        for _ in range(3):
+            found = conn.execute(
+                "SELECT e.row, d.value, g.value FROM embeddings e "
+                "JOIN meta d ON d.name = 'dim' JOIN meta g ON g.name = 'generation' "
+                "WHERE e.model = ? AND e.key = ?",
+                (model, key),
+            ).fetchone()
+            if found is None:
+                return None
+            row, dim, generation = found
+            vector = self._mapped_row(row, dim, generation)
+            # A compaction between the lookup and the read renumbers rows; retry if that happened.
+            if self._meta(conn, "generation") == generation:
+                return vector.tolist() if vector is not None else None
+        return None
+
+    def put(self, key: str, embedding: List[float], model: str) -> None:
+        """Append an embedding to the matrix and record its row; safe to call from many processes."""
+        vector = np.asarray(embedding, dtype="<f4")
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM embeddings WHERE model = ? AND key = ?", (model, key)).fetchone():
+                conn.execute("COMMIT")
+                return
+            dim = self._meta(conn, "dim")
+            if dim is None:
+                dim = vector.shape[0]
+                conn.execute("INSERT INTO meta (name, value) VALUES ('dim', ?)", (dim,))
+            elif dim != vector.shape[0]:
+                logger.warning(f"Embedding store expects dimension {dim}, got {vector.shape[0]}; not storing.")
+                conn.execute("ROLLBACK")
+                return
+            matrix_path = self._matrix_path(self._meta(conn, "generation"))
+            if not os.path.exists(matrix_path):
+                open(matrix_path, "ab").close()
+            with open(matrix_path, "r+b") as f:
+                # Drop any partial row left behind by a writer that crashed mid-append.
+                row = self._rows_on_disk(matrix_path, dim)
+                f.truncate(row * dim * 4)
+                f.seek(row * dim * 4)
+                f.write(vector.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            conn.execute(
+                "INSERT INTO embeddings (model, key, row, created_at) VALUES (?, ?, ?, ?)",
+                (model, key, row, time.time()),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def compact(self, max_age_seconds: Optional[float] = None) -> Dict[str, int]:
+        """Drop expired entries and rewrite the matrix so it only holds live rows."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        new_path = None
+        try:
+            removed = 0
+            if max_age_seconds is not None:
+                removed = conn.execute(
+                    "DELETE FROM embeddings WHERE created_at < ?", (time.time() - max_age_seconds,)
+                ).rowcount
+            dim = self._meta(conn, "dim")
+            generation = self._meta(conn, "generation")
+            live = conn.execute("SELECT rowid, row FROM embeddings ORDER BY row").fetchall()
+            old_path = self._matrix_path(generation)
+            old_rows = self._rows_on_disk(old_path, dim) if dim is not None else 0
+            # Entries pointing past the end of the matrix can never be read back
+            lost = [rowid for rowid, row in live if row >= old_rows]
+            conn.executemany("DELETE FROM embeddings WHERE rowid = ?", [(rowid,) for rowid in lost])
+            removed += len(lost)
+            live = [(rowid, row) for rowid, row in live if row < old_rows]
+            if dim is None or len(live) == old_rows:
+                # Every row in the matrix is live: nothing to reclaim
+                conn.execute("COMMIT")
+                return {"removed": removed, "live": len(live)}
+
+            # Readers take the generation from the same query as the row number, so the new file
+            # is only used once the renumbered rows and the new generation are committed together.
+            new_path = self._matrix_path(generation + 1)
+            with open(new_path, "wb") as f:
+                if live:
+                    old = np.memmap(old_path, dtype="<f4", mode="r", shape=(old_rows, dim))
+                    for new_row, (rowid, old_row) in enumerate(live):
+                        f.write(np.asarray(old[old_row], dtype="<f4").tobytes())
+                        conn.execute("UPDATE embeddings SET row = ? WHERE rowid = ?", (new_row, rowid))
+                    del old
+                f.flush()
+                os.fsync(f.fileno())
+            conn.execute("UPDATE meta SET value = ? WHERE name = 'generation'", (generation + 1,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            if new_path is not None and os.path.exists(new_path):
+                os.remove(new_path)
+            raise
+        # Processes that already mapped the old file keep their mapping; new lookups use the new file
+        os.remove(old_path)
+        conn.execute("VACUUM")
+        return {"removed": removed, "live": len(live)}
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of live entries and the rows held in the matrix file."""
+        conn = self._connect()
+        dim = self._meta(conn, "dim")
+        entries = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        matrix_rows = self._rows_on_disk(self._matrix_path(self._meta(conn, "generation")), dim) if dim else 0
+        return {"entries": entries, "matrix_rows": matrix_rows, "dim": dim or 0}
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Maintain the on-disk query embedding store.")
+    parser.add_argument("--dir", default=EMBEDDING_STORE_DIR, help="Store directory (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Show entry and matrix row counts")
+    compact_parser = subparsers.add_parser("compact", help="Drop expired entries and reclaim matrix space")
+    compact_parser.add_argument("--max-age-days", type=float, default=None, help="Remove entries older than this")
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.dir)
+    if args.command == "compact":
+        max_age = args.max_age_days * 86400 if args.max_age_days is not None else None
+        result = store.compact(max_age)
+        logger.info(f"Compaction finished: removed {result['removed']} entries, {result['live']} live rows.")
+    print(store.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Exact-match lookup of the rulings, sections and divisions a question cites.
+
+Identifiers are extracted from chunk titles in both MongoDB collections and
+normalized ("TR_2012/5" and "tr 2012/5" both become "TR 2012/5", "SECT 820.90"
+and "section 820-90(1)" become "s 820-90", "Division 7A" becomes "div 7A"). The
+index maps each identifier to its chunks' _ids, in collection order, and is
+written to IDENTIFIER_INDEX_FILE together with the collections' published
+versions (see kb_versions.py); the app ignores an index built from older
+content.
+
+Usage:
+    python identifiers.py build
+    python identifiers.py lookup "What does TR 2012/5 say about s 820-90?"
+"""
+import argparse
+import json
+import logging
+import os
+import re
+from typing import Any, Dict, List, Tuple
+
+from kb_versions import version_stamp
+
+IDENTIFIER_INDEX_FILE = os.getenv("IDENTIFIER_INDEX_FILE", "identifier_index.json")
+
+logger = logging.getLogger(__name__)
+
+# ATO rulings and determinations: TR 2012/5, TR_2012/5, TD 93/92, TR 2012/D5, PS LA 2011/27, ATO ID 2010/123
+RULING = re.compile(
+    r"(?<![\w/])(PS\s?LA|ATO\s?ID|GSTR|GSTD|FBTR|WETR|CGTD|PCG|LCR|CLR|MTR|SGR|SGD|TPA|TR|TD|CR|PR|MT|TA|LI)"
+    r"[\s_]*(\d{4}|\d{2})\s*/\s*(D?\d{1,4})\b", re.IGNORECASE)
+# Sections: s 820-90, ss 8-1(1), section 109D, SECT 820.90 (AustLII titles)
+SECTION = re.compile(r"(?<!['’\w])(?:sections?|sect|sec|ss|s)\.?\s*(\d{1,4}[A-Z]{0,3})(?:[-.](\d{1,4}[A-Z]{0,3}))?(?![\w.-]*\d)",
+                     re.IGNORECASE)
+# Divisions and subdivisions: Division 7A, Div 293, Subdivision 328-D
+DIVISION = re.compile(r"\b(sub)?div(?:ision)?\.?\s*(\d{1,4}[A-Z]{0,2}(?:-[A-Z]{1,2})?)\b", re.IGNORECASE)
+# Parts: Part IVA, Part 3-1 (a lone numeral like "part I" is too likely to be prose)
+PART = re.compile(r"\b(?i:part)\s+([IVX]{2,}(?:AA|A|B|C)?|[IVX](?:AA|A|B|C)|\d{1,2}-\d{1,2})\b")
+
+
+def extract_identifiers(text: str) -> List[str]:
+    """Return the normalized identifiers cited in text, in order of first appearance."""
+    found: List[Tuple[int, str]] = []
+    for match in RULING.finditer(text):
+        prefix = re.sub(r"\s", "", match.group(1).upper()).replace("PSLA", "PS LA").replace("ATOID", "ATO ID")
+        number = match.group(3).upper()
+        number = f"D{int(number[1:])}" if number.startswith("D") else str(int(number))
+        found.append((match.start(), f"{prefix} {match.group(2)}/{number}"))
+    for match in SECTION.finditer(text):
+        section = match.group(1).upper() + (f"-{match.group(2).upper()}" if match.group(2) else "")
+        found.append((match.start(), f"s {section}"))
+    for match in DIVISION.finditer(text):
+        kind = "subdiv" if match.group(1) else "div"
+        found.append((match.start(), f"{kind} {match.group(2).upper()}"))
+    for match in PART.finditer(text):
+        found.append((match.start(), f"part {match.group(1)}"))
+
+    identifiers: List[str] = []
+    for _, identifier in sorted(found):
+        if identifier not in identifiers:
+            identifiers.append(identifier)
+    return identifiers
+
+
+class IdentifierIndex:
+    """Maps normalized identifiers to the (source_type, _id) of the chunks titled with them."""
+
+    def __init__(self, identifiers: Dict[str, List[Tuple[str, Any]]], stamp: Tuple[Tuple[str, str], ...]):
+        self.identifiers = identifiers
+        self.stamp = stamp
+
+    @classmethod
+    def load(cls, path: str = IDENTIFIER_INDEX_FILE) -> "IdentifierIndex":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        identifiers = {key: [(source_type, doc_id) for source_type, doc_id in chunks] for key, chunks in data["identifiers"].items()}
+        return cls(identifiers, tuple(tuple(pair) for pair in data["stamp"]))
+
+    def save(self, path: str = IDENTIFIER_INDEX_FILE) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"stamp": self.stamp, "identifiers": self.identifiers}, f)
+        os.replace(tmp_path, path)
+
+    def is_current(self, *collection_names: str) -> bool:
+        """Return True if the index was built from the currently published versions of the collections."""
+        return self.stamp == version_stamp(*collection_names)
+
+    def lookup(self, identifiers: List[str]) -> List[Dict[str, Any]]:
+        """Return {'id', 'source_type'} items for every chunk of the given identifiers, without duplicates."""
+        items = []
+        seen = set()
+        for identifier in identifiers:
+            for source_type, doc_id in self.identifiers.get(identifier, []):
+                if doc_id not in seen:
+                    items.append({'id': doc_id, 'source_type': source_type})
+                    seen.add(doc_id)
+        return items
+
+
+def build_index(collections: Dict[str, Tuple[str, Any]]) -> IdentifierIndex:
+    """Index the identifiers in every chunk title of the given {source_type: (collection_name, collection)}."""
+    identifiers: Dict[str, List[Tuple[str, Any]]] = {}
+    for source_type, (collection_name, collection) in collections.items():
+        count = 0
+        for doc in collection.find({}, {"title": 1}):
+            for identifier in extract_identifiers(doc.get("title", "")):
+                identifiers.setdefault(identifier, []).append((source_type, doc["_id"]))
+            count += 1
+        logger.info(f"Read {count} chunk titles from {collection_name}.")
+    names = [collection_name for collection_name, _ in collections.values()]
+    return IdentifierIndex(identifiers, version_stamp(*names))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Build or query the exact-match index of cited rulings and sections.")
+    parser.add_argument("--file", default=IDENTIFIER_INDEX_FILE, help="Index file (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Index the chunk titles of both MongoDB collections")
+    lookup_parser = subparsers.add_parser("lookup", help="Show the identifiers in a question and the chunks they match")
+    lookup_parser.add_argument("question")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        from dotenv import load_dotenv
+        from pymongo import MongoClient
+
+        load_dotenv()
+        database = MongoClient(os.getenv("MONGO_URI"))[os.getenv("MONGO_DB_NAME", "ato_data")]
+        docs_name = os.getenv("MONGO_COLLECTION_NAME_ATO", "documents")
+        legis_name = os.getenv("MONGO_COLLECTION_NAME_LEG", "legislation")
+        index = build_index({"document": (docs_name, database[docs_name]), "legislation": (legis_name, database[legis_name])})
+        index.save(args.file)
+        logger.info(f"Saved {len(index.identifiers)} identifiers to {args.file}.")
+    elif args.command == "lookup":
+        identifiers = extract_identifiers(args.question)
+        print(f"Identifiers: {', '.join(identifiers) or 'none'}")
+        if identifiers and os.path.exists(args.file):
+            index = IdentifierIndex.load(args.file)
+            for identifier in identifiers:
+                print(f"{identifier}: {len(index.identifiers.get(identifier, []))} chunks")
+
+
+if __name__ == "__main__":
+    main()
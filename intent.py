@@ -0,0 +1,364 @@
+"""Local advice-intent classifier for questions the assistant must not answer.
+
+The system prompt tells the model to answer any request for advice, opinions or
+recommendations ("should I ...") with a fixed disclaimer. This classifier spots
+those questions on the CPU before retrieval, so the app can show the disclaimer
+without paying for an embedding, vector searches, document fetches and a
+completion.
+
+A logistic regression over hashed word unigrams and bigrams, plus a few
+hand-written rule features, gives an advice probability. Only scores at or above
+INTENT_ADVICE_THRESHOLD take the fast path; everything else goes through the
+normal pipeline, where the model still applies the disclaimer itself. Setting
+INTENT_AUDIT_LOG records fast-path decisions and those within
+INTENT_AUDIT_MARGIN of the threshold, so precision can be reviewed; a
+background thread writes the file and rotates it at INTENT_AUDIT_MAX_BYTES.
+
+The model is trained from the built-in seed examples unless INTENT_MODEL_FILE
+exists; `train` adds labelled examples from a JSONL file and writes that file.
+
+Usage:
+    python intent.py classify "Should I sell my shares before 30 June?"
+    python intent.py train labelled.jsonl       # lines of {"question": "...", "advice": true|false}
+    python intent.py audit intent_audit.jsonl   # precision of reviewed decisions
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INTENT_MODEL_FILE = os.getenv("INTENT_MODEL_FILE", "intent_model.json")
+# Opt-in: the audit log stores question text
+INTENT_AUDIT_LOG = os.getenv("INTENT_AUDIT_LOG", "")
+# Scores this far below the threshold are recorded too, so near misses can be labelled
+INTENT_AUDIT_MARGIN = float(os.getenv("INTENT_AUDIT_MARGIN", "0.2"))
+# The log is renamed to <path>.1 (replacing the previous one) once it reaches this size
+INTENT_AUDIT_MAX_BYTES = int(os.getenv("INTENT_AUDIT_MAX_BYTES", str(10 * 1024 * 1024)))
+# High on purpose: a false positive withholds a factual answer, a false negative only costs one normal request
+INTENT_ADVICE_THRESHOLD = float(os.getenv("INTENT_ADVICE_THRESHOLD", "0.9"))
+
+ADVICE_DISCLAIMER = ("I cannot provide financial advice or personal recommendations. My purpose is to supply factual "
+                     "information based on ATO documents. For personalized financial or tax advice, please consult a "
+                     "registered tax agent or a licensed financial adviser.")
+
+FEATURE_DIMENSION = 2 ** 16
+
+# Hand-written cues, given to the model as extra features so it learns how much to trust each
+RULES = {
+    "should_i": re.compile(r"\bshould (i|we|my|our)\b"),
+    "recommend": re.compile(r"\b(recommend|recommendation|advise|advice|suggest)\w*\b"),
+    "better_for_me": re.compile(r"\b(better|best|worth|wise|smart|good idea)\b.*\b(i|me|my|we|us|our)\b"
+                                r"|\b(i|me|my|we|us|our)\b.*\b(better|best|worth it|wise|smart|good idea)\b"),
+    "opinion": re.compile(r"\b(do you think|in your opinion|what would you|would you)\b"),
+    "when_how_should": re.compile(r"\b(when|where|how|by when) should\b"),
+    "factual_opening": re.compile(r"^(what (is|are|does|was|were)|how (is|are|does|do)|define|explain|when (is|are|does|do)|"
+                                  r"who (is|are|can)|which (form|section|ruling))\b"),
+}
+
+# (question, is_advice) pairs the default model is trained on
+SEED_EXAMPLES = [
+    ("Should I sell my shares before the end of the financial year?", True),
+    ("Should I set up a family trust for my business?", True),
+    ("Should I salary sacrifice into super this year?", True),
+    ("Should we register for GST now or wait?", True),
+    ("Should my company pay dividends or keep the profits?", True),
+    ("Should I buy an investment property to reduce my tax?", True),
+    ("Should I claim the fixed rate or the actual cost method for working from home?", True),
+    ("Should I convert my sole trader business into a company?", True),
+    ("Should I take a lump sum or an income stream from my super?", True),
+    ("Should I negatively gear an apartment?", True),
+    ("Is it worth setting up a self managed super fund for me?", True),
+    ("Is it better for me to lease or buy a work car?", True),
+    ("Is it a good idea to prepay my interest before June 30?", True),
+    ("Is it smart for us to split income with my spouse through a trust?", True),
+    ("Would it be wise for me to sell my crypto now?", True),
+    ("What is the best structure for my small business?", True),
+    ("What is the best way for me to minimise my tax?", True),
+    ("Which super fund do you recommend?", True),
+    ("Can you recommend a tax strategy for my rental properties?", True),
+    ("Can you advise me on whether to sell my house?", True),
+    ("Please advise whether I should restructure my business", True),
+    ("What do you suggest I do with my tax refund?", True),
+    ("How should I invest my inheritance to pay less tax?", True),
+    ("Do you think I should make extra super contributions?", True),
+    ("In your opinion is a discretionary trust worth it for me?", True),
+    ("What would you do with a capital gain this year?", True),
+    ("Would you buy shares or property for tax reasons?", True),
+    ("Which is better for me, a company or a trust?", True),
+    ("Is it better to pay off my mortgage or put money into super?", True),
+    ("Am I better off claiming depreciation or an immediate write-off?", True),
+    ("Give me your recommendation on salary packaging a car", True),
+    ("What should I do to reduce my capital gains tax bill?", True),
+    ("Is now a good time for me to sell my investment property?", True),
+    ("Should our partnership become a company?", True),
+    ("Should I move overseas to stop being an Australian tax resident?", True),
+    ("Recommend the most tax effective way to pay myself from my company", True),
+    ("Tell me whether I should contribute to my spouse's super", True),
+    ("Is it worth it for me to get a tax agent?", True),
+    ("What investment should I make before 30 June?", True),
+    ("Would you advise me to claim my home office?", True),
+    ("What is the tax-free threshold for residents?", False),
+    ("What are the income tax rates for 2024-25?", False),
+    ("How is capital gains tax calculated on shares?", False),
+    ("How does the CGT main residence exemption work?", False),
+    ("What is the GST registration turnover threshold?", False),
+    ("When is the due date for lodging an individual tax return?", False),
+    ("When should I lodge my tax return if I use a tax agent?", False),
+    ("How should I report foreign income in my return?", False),
+    ("Where should I record my car expenses in my tax return?", False),
+    ("By when should a company pay its PAYG instalments?", False),
+    ("What should be included in assessable income?", False),
+    ("What records should a business keep for GST?", False),
+    ("Can I claim working from home expenses?", False),
+    ("Can I claim a deduction for a laptop used for work?", False),
+    ("Are donations to registered charities deductible?", False),
+    ("What is the concessional contributions cap?", False),
+    ("What is Division 7A?", False),
+    ("Explain the thin capitalisation fixed ratio test", False),
+    ("Define a base rate entity", False),
+    ("What is the primary purpose of the global minimum tax (Pillar Two)", False),
+    ("What happens if a company does not lodge a tax return on time?", False),
+    ("What are the common tax deductions available for individuals in Australia?", False),
+    ("What is the fixed ratio test within thin capitalization rules, and what are its key components?", False),
+    ("How are franking credits refunded to individuals?", False),
+    ("How is a trust's net income taxed?", False),
+    ("What are the residency tests for individuals?", False),
+    ("Who is eligible for the low income tax offset?", False),
+    ("Which form do I use to apply for an ABN?", False),
+    ("Which section of the ITAA 1997 covers general deductions?", False),
+    ("What does TR 2021/1 say about deductions?", False),
+    ("How do I calculate depreciation using the diminishing value method?", False),
+    ("What is the Medicare levy surcharge threshold for families?", False),
+    ("Is superannuation taxed when I withdraw it after 60?", False),
+    ("Is GST charged on fresh food?", False),
+    ("Is a gift from overseas family taxable income?", False),
+    ("Do I need to pay tax on a hobby income?", False),
+    ("Do companies pay tax on dividends they receive?", False),
+    ("What are the penalties for late lodgment?", False),
+    ("How long should I keep my tax records?", False),
+    ("What is the small business instant asset write-off limit?", False),
+    ("What is the best known definition of a permanent establishment?", False),
+    ("Which ruling explains the best practice for transfer pricing documentation?", False),
+    ("Are there better ways the ATO lets individuals pay a tax debt, such as payment plans?", False),
+    ("What is the difference between a company and a trust for tax purposes?", False),
+    ("How does negative gearing work?", False),
+    ("What are the tax consequences of selling shares within 12 months?", False),
+    ("What are the rules for claiming a car under the cents per km method?", False),
+    ("When does fringe benefits tax apply to a car?", False),
+    ("What is the 50% CGT discount and who can use it?", False),
+    ("What are the work test rules for super contributions?", False),
+]
+
+
+def _features(question: str) -> Tuple[List[int], List[str]]:
+    """Return the hashed feature indexes for a question and the names of the rules it matches."""
+    text = question.lower().strip()
+    words = re.findall(r"[a-z0-9']+", text)
+    tokens = [f"w:{word}" for word in words] + [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+    if words:
+        tokens.append(f"first:{words[0]}")
+    matched = [name for name, pattern in RULES.items() if pattern.search(text)]
+    tokens += [f"rule:{name}" for name in matched]
+    indexes = sorted({zlib.crc32(token.encode("utf-8")) % FEATURE_DIMENSION for token in tokens})
+    return indexes, matched
+
+
+class IntentClassifier:
+    """Logistic regression over hashed n-gram and rule features."""
+
+    def __init__(self, weights: Dict[int, float], bias: float, threshold: float = INTENT_ADVICE_THRESHOLD):
+        self.weights = weights
+        self.bias = bias
+        self.threshold = threshold
+
+    @classmethod
+    def train(cls, examples: Iterable[Tuple[str, bool]], epochs: int = 400, learning_rate: float = 0.5,
+              l2: float = 1e-3, threshold: float = INTENT_ADVICE_THRESHOLD) -> "IntentClassifier":
+        examples = list(examples)
+        matrix = np.zeros((len(examples), FEATURE_DIMENSION), dtype=np.float32)
+        for row, (question, _) in enumerate(examples):
+            matrix[row, _features(question)[0]] = 1.0
+        labels = np.array([1.0 if advice else 0.0 for _, advice in examples], dtype=np.float32)
+        used = np.flatnonzero(matrix.any(axis=0))
+        matrix = matrix[:, used]
+
+        weights = np.zeros(len(used), dtype=np.float32)
+        bias = 0.0
+        for _ in range(epochs):
+            probabilities = 1.0 / (1.0 + np.exp(-(matrix @ weights + bias)))
+            error = probabilities - labels
+            weights -= learning_rate * (matrix.T @ error / len(examples) + l2 * weights)
+            bias -= learning_rate * float(error.mean())
+        return cls({int(index): float(weight) for index, weight in zip(used, weights)}, bias, threshold)
+
+    @classmethod
+    def load(cls, path: str, threshold: float = INTENT_ADVICE_THRESHOLD) -> "IntentClassifier":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls({int(index): weight for index, weight in data["weights"].items()}, data["bias"], threshold)
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".intent_model.")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"bias": self.bias, "weights": {str(index): weight for index, weight in self.weights.items()}}, f)
+        os.replace(tmp_path, path)
+
+    def score(self, question: str) -> Tuple[float, List[str]]:
+        """Return the advice probability for a question and the rules it matched."""
+        indexes, matched = _features(question)
+        logit = self.bias + sum(self.weights.get(index, 0.0) for index in indexes)
+        return 1.0 / (1.0 + math.exp(-max(min(logit, 50.0), -50.0))), matched
+
+    def classify(self, question: str) -> Dict[str, Any]:
+        """Return {'advice', 'score', 'rules'}; 'advice' is True only for a confident match."""
+        probability, matched = self.score(question)
+        return {"advice": probability >= self.threshold, "score": round(probability, 4), "rules": matched}
+
+
+def load_classifier(path: str = INTENT_MODEL_FILE) -> IntentClassifier:
+    """Load the trained model file, or train one from the seed examples if there is none."""
+    if os.path.exists(path):
+        return IntentClassifier.load(path)
+    return IntentClassifier.train(SEED_EXAMPLES)
+
+
+class AuditLog:
+    """Records fast-path and near-threshold decisions so fast-path precision can be reviewed later.
+
+    record() only enqueues; a daemon thread appends the JSON lines and rotates the
+    file, so the request thread and the event loop never block on disk I/O.
+    """
+
+    def __init__(self, path: str = INTENT_AUDIT_LOG, threshold: float = INTENT_ADVICE_THRESHOLD,
+                 margin: float = INTENT_AUDIT_MARGIN, max_bytes: int = INTENT_AUDIT_MAX_BYTES):
+        self.path = path
+        self.min_score = threshold - margin
+        self.max_bytes = max_bytes
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._writer = None
+
+    def record(self, question: str, decision: Dict[str, Any]) -> None:
+        logger.info(f"Intent: advice={decision['advice']} score={decision['score']} rules={decision['rules']}")
+        if not self.path or not (decision["advice"] or decision["score"] >= self.min_score):
+            return
+        self._queue.put(json.dumps({"time": time.time(), "question": question, **decision}))
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_forever, name="intent-audit", daemon=True)
+                    self._writer.start()
+
+    def _write_forever(self) -> None:
+        while True:
+            lines = [self._queue.get()]
+            while not self._queue.empty():
+                lines.append(self._queue.get_nowait())
+            path = self.path
+            if not path:
+                continue
+            try:
+                if self.max_bytes and os.path.exists(path) and os.path.getsize(path) >= self.max_bytes:
+                    os.replace(path, path + ".1")
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write("".join(line + "\n" for line in lines))
+            except OSError as e:
+                logger.warning(f"Writing the intent audit log failed: {e}")
+
+
+def read_labelled(path: str) -> List[Tuple[str, bool]]:
+    """Read {"question", "advice"} lines from a JSONL file."""
+    with open(path, encoding="utf-8") as f:
+        return [(item["question"], bool(item["advice"])) for item in map(json.loads, filter(str.strip, f))]
+
+
+def cross_validate(examples: List[Tuple[str, bool]], folds: int = 5, threshold: float = INTENT_ADVICE_THRESHOLD) -> Dict[str, float]:
+    """Return precision and recall of confident advice predictions over k folds."""
+    true_positive = false_positive = false_negative = 0
+    for fold in range(folds):
+        train = [example for i, example in enumerate(examples) if i % folds != fold]
+        test = [example for i, example in enumerate(examples) if i % folds == fold]
+        classifier = IntentClassifier.train(train, threshold=threshold)
+        for question, advice in test:
+            predicted = classifier.classify(question)["advice"]
+            true_positive += predicted and advice
+            false_positive += predicted and not advice
+            false_negative += advice and not predicted
+    return {
+        "precision": true_positive / (true_positive + false_positive) if true_positive + false_positive else 1.0,
+        "recall": true_positive / (true_positive + false_negative) if true_positive + false_negative else 0.0,
+    }
+
+
+def audit(path: str) -> Dict[str, Any]:
+    """Summarise an audit log; records a reviewer has given a boolean "label" count towards precision.
+
+    Labelled near-threshold records that the fast path let through show the advice
+    questions it missed.
+    """
+    decisions = reviewed = correct = 0
+    fast_path = near_threshold = reviewed_near = missed = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "advice" not in record:
+                continue
+            decisions += 1
+            labelled = isinstance(record.get("label"), bool)
+            if record["advice"]:
+                fast_path += 1
+                if labelled:
+                    reviewed += 1
+                    correct += record["label"]
+            else:
+                near_threshold += 1
+                if labelled:
+                    reviewed_near += 1
+                    missed += record["label"]
+    return {"decisions": decisions, "fast_path": fast_path, "reviewed_fast_path": reviewed,
+            "precision": correct / reviewed if reviewed else None,
+            "near_threshold": near_threshold, "reviewed_near_threshold": reviewed_near, "missed_advice": missed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify, train or audit the advice-intent fast path.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    classify_parser = subparsers.add_parser("classify", help="Score questions")
+    classify_parser.add_argument("questions", nargs="+")
+    train_parser = subparsers.add_parser("train", help="Train on the seed examples plus a labelled JSONL file")
+    train_parser.add_argument("labelled", nargs="?", help='JSONL lines of {"question": "...", "advice": true|false}')
+    train_parser.add_argument("--out", default=INTENT_MODEL_FILE)
+    audit_parser = subparsers.add_parser("audit", help="Summarise the decisions in an audit log")
+    audit_parser.add_argument("log", nargs="?", default=INTENT_AUDIT_LOG or "intent_audit.jsonl")
+    args = parser.parse_args()
+
+    if args.command == "classify":
+        classifier = load_classifier()
+        for question in args.questions:
+            print(json.dumps({"question": question, **classifier.classify(question)}))
+    elif args.command == "train":
+        examples = SEED_EXAMPLES + (read_labelled(args.labelled) if args.labelled else [])
+        print(json.dumps({"examples": len(examples), **cross_validate(examples)}))
+        IntentClassifier.train(examples).save(args.out)
+    else:
+        print(json.dumps(audit(args.log)))
+
+
+if __name__ == "__main__":
+    main()
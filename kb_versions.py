@@ -0,0 +1,74 @@
+"""Version stamps for the published Pinecone indexes and MongoDB collections.
+
+The index builder records a new version for every index or collection it
+rewrites; the app folds these stamps into its cache keys, so retrieval and
+answer caches drop stale entries as soon as new content is published.
+
+Usage:
+    python kb_versions.py show
+    python kb_versions.py publish ato-rag-app 2025-07-01
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, Tuple
+
+KB_VERSIONS_FILE = os.getenv("KB_VERSIONS_FILE", "kb_versions.json")
+# Used for any index or collection without a published version
+KNOWLEDGE_BASE_VERSION = os.getenv("KNOWLEDGE_BASE_VERSION", "1")
+
+_lock = threading.Lock()
+_cached: Tuple[Tuple[str, int, int], Dict[str, str]] = (("", -1, -1), {})
+
+
+def read_versions(path: str = KB_VERSIONS_FILE) -> Dict[str, str]:
+    """Return the published versions, re-reading the file only when it changes."""
+    global _cached
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    # publish() replaces the file, so the inode changes even within one mtime tick
+    file_id = (path, stat.st_ino, stat.st_mtime_ns)
+    with _lock:
+        if file_id != _cached[0]:
+            with open(path, encoding="utf-8") as f:
+                _cached = (file_id, json.load(f))
+        return dict(_cached[1])
+
+
+def version_stamp(*names: str) -> Tuple[Tuple[str, str], ...]:
+    """Return (name, version) pairs for the given indexes/collections, for use in cache keys."""
+    versions = read_versions()
+    return tuple((name, str(versions.get(name, KNOWLEDGE_BASE_VERSION))) for name in names)
+
+
+def publish(name: str, version: str, path: str = KB_VERSIONS_FILE) -> None:
+    """Record a new version for one index or collection (atomic replace of the versions file)."""
+    versions = read_versions(path)
+    versions[name] = version
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".kb_versions.")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(versions, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show or publish knowledge base version stamps.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("show", help="Print the published versions")
+    publish_parser = subparsers.add_parser("publish", help="Record a new version for an index or collection")
+    publish_parser.add_argument("name", help="Pinecone index or MongoDB collection name")
+    publish_parser.add_argument("version")
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        publish(args.name, args.version)
+    print(json.dumps(read_versions(), indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
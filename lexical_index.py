@@ -0,0 +1,192 @@
+"""Local BM25 index over the chunk text of both MongoDB collections.
+
+Dense search can miss exact terms ("fixed ratio test", "$20,000", "820-90"); this
+index finds them, and the app fuses its ranking with the vector results. The
+index lives in one directory:
+    terms.json    vocabulary, sorted; term i's postings are rows offsets[i]:offsets[i + 1]
+    offsets.npy   int64 start of each term's postings
+    postings.npy  int32 chunk row of each posting, highest weight first (memory-mapped)
+    weights.npy   float32 BM25 weight of each posting (memory-mapped)
+    ids.json      [source_type, _id] of each chunk row
+    meta.json     parameters and the collection versions it was built from
+
+BM25 weights depend only on the chunk and the corpus, so they are computed at
+build time and a query just sums the postings of its terms. Only the
+LEXICAL_MAX_POSTINGS highest weights of each term are read: for a term found in
+most chunks ("tax") the rest barely move the top results, and this keeps a
+query within a few milliseconds however common its words are.
+
+Usage:
+    python lexical_index.py build
+    python lexical_index.py query "fixed ratio test"
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from kb_versions import version_stamp
+from vector_index import LOCAL_INDEX_DIR
+
+LEXICAL_INDEX_DIR = os.getenv("LEXICAL_INDEX_DIR", os.path.join(LOCAL_INDEX_DIR, "bm25"))
+LEXICAL_MAX_POSTINGS = int(os.getenv("LEXICAL_MAX_POSTINGS", "20000"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+logger = logging.getLogger(__name__)
+
+# Numbers keep their separators ("820-90", "2012/5", "8.1") except thousands commas ("20,000" -> "20000")
+TOKEN = re.compile(r"\d+(?:[,.\-/]\d+)*[a-z]*|[a-z]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i if in into is it its my of on or our so "
+    "such that the their them then there these they this to was we were what when where which who will with "
+    "would you your".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase terms of text, without stopwords."""
+    tokens = []
+    for token in TOKEN.findall(text.lower()):
+        if token[0].isdigit():
+            token = re.sub(r"(?<=\d),(?=\d{3}\b)", "", token)
+        if token not in STOPWORDS:
+            tokens.append(token)
+    return tokens
+
+
+class LexicalIndex:
+    """BM25 search over memory-mapped postings with precomputed weights."""
+
+    def __init__(self, path: str = LEXICAL_INDEX_DIR):
+        self.path = path
+        with open(os.path.join(path, "terms.json"), encoding="utf-8") as f:
+            self.term_ids = {term: i for i, term in enumerate(json.load(f))}
+        with open(os.path.join(path, "ids.json"), encoding="utf-8") as f:
+            self.ids: List[Tuple[str, Any]] = [tuple(pair) for pair in json.load(f)]
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.stamp = tuple(tuple(pair) for pair in meta["stamp"])
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.postings = np.load(os.path.join(path, "postings.npy"), mmap_mode="r")
+        self.weights = np.load(os.path.join(path, "weights.npy"), mmap_mode="r")
+
+    def is_current(self, *collection_names: str) -> bool:
+        """Return True if the index was built from the currently published versions of the collections."""
+        return self.stamp == version_stamp(*collection_names)
+
+    def query(self, text: str, top_k: int) -> List[Dict[str, Any]]:
+        """Return up to top_k {'id', 'source_type', 'score'} items for the chunks that best match text."""
+        term_ids = [self.term_ids[term] for term in dict.fromkeys(tokenize(text)) if term in self.term_ids]
+        if not term_ids or top_k <= 0:
+            return []
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term_id in term_ids:
+            start = self.offsets[term_id]
+            end = min(self.offsets[term_id + 1], start + LEXICAL_MAX_POSTINGS)
+            # A chunk appears at most once in a term's postings, so plain fancy-index addition is safe
+            scores[self.postings[start:end]] += self.weights[start:end]
+        rows = np.flatnonzero(scores)
+        if len(rows) > top_k:
+            rows = rows[np.argpartition(-scores[rows], top_k - 1)[:top_k]]
+        rows = rows[np.argsort(-scores[rows], kind="stable")]
+        return [{'id': self.ids[row][1], 'source_type': self.ids[row][0], 'score': float(scores[row])} for row in rows]
+
+
+def build_index(chunks: Iterable[Tuple[str, Any, str]], path: str, stamp: Tuple[Tuple[str, str], ...]) -> int:
+    """Write the index for (source_type, _id, text) chunks to path and return the number of chunks."""
+    ids: List[Tuple[str, Any]] = []
+    lengths: List[int] = []
+    term_postings: Dict[str, List[Tuple[int, int]]] = {}
+    for source_type, doc_id, text in chunks:
+        row = len(ids)
+        tokens = tokenize(text)
+        ids.append((source_type, doc_id))
+        lengths.append(len(tokens))
+        for term, count in Counter(tokens).items():
+            term_postings.setdefault(term, []).append((row, count))
+
+    count = len(ids)
+    average_length = (sum(lengths) / count) if count else 0.0
+    lengths_array = np.asarray(lengths, dtype=np.float32)
+    terms = sorted(term_postings)
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    postings = np.empty(sum(len(rows) for rows in term_postings.values()), dtype=np.int32)
+    weights = np.empty(len(postings), dtype=np.float32)
+    position = 0
+    for i, term in enumerate(terms):
+        rows, counts = zip(*term_postings[term])
+        rows = np.asarray(rows, dtype=np.int32)
+        counts = np.asarray(counts, dtype=np.float32)
+        idf = math.log(1 + (count - len(rows) + 0.5) / (len(rows) + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths_array[rows] / (average_length or 1.0))
+        term_weights = idf * counts * (BM25_K1 + 1) / (counts + norm)
+        order = np.argsort(-term_weights, kind="stable")
+        postings[position:position + len(rows)] = rows[order]
+        weights[position:position + len(rows)] = term_weights[order]
+        position += len(rows)
+        offsets[i + 1] = position
+
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "terms.json"), "w", encoding="utf-8") as f:
+        json.dump(terms, f)
+    with open(os.path.join(path, "ids.json"), "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "postings.npy"), postings)
+    np.save(os.path.join(path, "weights.npy"), weights)
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"k1": BM25_K1, "b": BM25_B, "average_length": average_length, "stamp": stamp}, f)
+    return count
+
+
+def read_collections(collections: Dict[str, Tuple[str, Any]]) -> Iterable[Tuple[str, Any, str]]:
+    """Yield (source_type, _id, text) for every chunk of the given {source_type: (collection_name, collection)}."""
+    for source_type, (collection_name, collection) in collections.items():
+        count = 0
+        for doc in collection.find({}, {"text": 1}):
+            yield source_type, doc["_id"], doc.get("text", "")
+            count += 1
+        logger.info(f"Read {count} chunks from {collection_name}.")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Build or query the local BM25 index of chunk text.")
+    parser.add_argument("--dir", default=LEXICAL_INDEX_DIR, help="Index directory (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="Index the chunk text of both MongoDB collections")
+    query_parser = subparsers.add_parser("query", help="Show the best matching chunks for a question")
+    query_parser.add_argument("question")
+    query_parser.add_argument("--top-k", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        from dotenv import load_dotenv
+        from pymongo import MongoClient
+
+        load_dotenv()
+        database = MongoClient(os.getenv("MONGO_URI"))[os.getenv("MONGO_DB_NAME", "ato_data")]
+        docs_name = os.getenv("MONGO_COLLECTION_NAME_ATO", "documents")
+        legis_name = os.getenv("MONGO_COLLECTION_NAME_LEG", "legislation")
+        collections = {"document": (docs_name, database[docs_name]), "legislation": (legis_name, database[legis_name])}
+        count = build_index(read_collections(collections), args.dir, version_stamp(docs_name, legis_name))
+        logger.info(f"Saved a BM25 index of {count} chunks to {args.dir}.")
+    elif args.command == "query":
+        index = LexicalIndex(args.dir)
+        started = time.perf_counter()
+        matches = index.query(args.question, args.top_k)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for match in matches:
+            print(f"{match['score']:8.3f}  {match['source_type']:<11} {match['id']}")
+        print(f"{len(matches)} matches in {elapsed_ms:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""Load generator that simulates many concurrent TaxAUmate chat sessions.
+
+Runs in steps of increasing concurrent users. Each user holds a conversation:
+it asks a question from the question mix, waits for the streamed answer,
+thinks for a while and asks again, then starts a new session after --turns
+questions. For every step the report gives throughput, first-token and answer
+latency percentiles, the error rate, the size of each session's message history
+(what st.session_state.messages holds) and process memory. It also names the
+step where the system saturated: throughput stopped growing, errors appeared or
+p95 answer latency passed the SLO.
+
+Targets:
+    inprocess  main()'s question flow (app.answer_question) without the Streamlit UI:
+               advice fast path, tax engine, single-flight, retrieval, answer cache and
+               the render loop. Uses bench.py's
+               latency-injecting fakes, or the configured services with --live.
+    http       a running service.py replica via POST /answer/stream.
+
+Usage:
+    python loadgen.py --users 1,2,4,8,16,32 --step-seconds 60
+    python loadgen.py --target http --url http://127.0.0.1:8000 --users 8,16,32,64
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import threading
+import time
+import urllib.request
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import app
+from batch import read_questions
+from bench import FakePlaceholder, Latency, add_fake_arguments, build_fakes, disable_intent_audit, quiet_app_logs
+
+logger = logging.getLogger(__name__)
+
+# Everyday questions that make up the rest of the default mix, alongside the welcome-message samples
+QUESTION_MIX = [
+    "Can I claim working from home expenses?",
+    "How is capital gains tax calculated on the sale of an investment property?",
+    "What is the tax-free threshold for Australian residents?",
+    "When is the GST registration threshold reached for a small business?",
+    "How do franking credits work for individual shareholders?",
+    "What are the residency tests for individuals?",
+    "Can I deduct the cost of a laptop used for work?",
+    "What records do I need to keep for car expenses?",
+    "How does the Medicare levy surcharge apply?",
+    "What are the concessional contribution caps for superannuation?",
+    "How are fringe benefits taxed for employers?",
+    "What is the main residence exemption for capital gains?",
+    "When do I need to lodge a business activity statement?",
+    "How are trust distributions to minors taxed?",
+    "What is Division 7A and when does it apply to private company loans?",
+    "Are gifts and donations tax deductible?",
+]
+
+# Appended to make a question novel, so it misses the retrieval and answer caches like a fresh user question would
+QUALIFIERS = ["for a sole trader", "for the {year} income year", "if my taxable income is ${amount:,}",
+              "for a company with turnover of ${amount:,}", "for a non-resident", "in my first year of business"]
+
+
+class QuestionMix:
+    """Draws questions: the welcome-message samples with the given share, otherwise the general pool.
+
+    A novel_share of the questions get a random qualifier so they are unlikely to repeat.
+    """
+
+    def __init__(self, pool: List[str], sample_share: float, novel_share: float):
+        self.pool = pool
+        self.sample_share = sample_share
+        self.novel_share = novel_share
+
+    def pick(self, rng: random.Random) -> str:
+        question = rng.choice(app.SAMPLE_QUESTIONS) if rng.random() < self.sample_share else rng.choice(self.pool)
+        if rng.random() < self.novel_share:
+            qualifier = rng.choice(QUALIFIERS).format(year=f"{rng.randint(2015, 2025)}-{rng.randint(16, 26)}",
+                                                      amount=rng.randrange(10_000, 5_000_000, 1_000))
+            question = f"{question.rstrip('?')} {qualifier}?"
+        return question
+
+
+class TimingPlaceholder(FakePlaceholder):
+    """Notes when the first render reaches the (simulated) browser."""
+
+    def __init__(self, latency: Latency, started: float):
+        super().__init__(latency)
+        self.started = started
+        self.first_render: Optional[float] = None
+
+    def markdown(self, body: str, unsafe_allow_html: bool = False) -> None:
+        super().markdown(body, unsafe_allow_html)
+        if self.first_render is None:
+            self.first_render = time.perf_counter() - self.started
+
+
+class HeadlessSession:
+    """One simulated Streamlit session running main()'s question flow without the UI."""
+
+    def __init__(self, resources: Dict[str, Any], render_latency: Latency):
+        self.resources = resources
+        self.render_latency = render_latency
+        self.messages: List[Dict[str, str]] = [{"role": "assistant", "content": app.WELCOME_MESSAGE}]
+
+    def ask(self, prompt: str) -> Tuple[Optional[float], float, bool]:
+        """Ask one question; return (seconds to first render, seconds to full answer, succeeded)."""
+        started = time.perf_counter()
+        placeholder = TimingPlaceholder(self.render_latency, started)
+        self.messages.append({"role": "user", "content": prompt})
+        try:
+            answer = app.answer_question(prompt, self.resources, placeholder)
+            succeeded = True
+        except Exception as e:
+            logger.error(f"Simulated session failed: {e}")
+            answer = "I apologize, but I encountered an error."
+            succeeded = False
+        self.messages.append({"role": "assistant", "content": answer})
+        return placeholder.first_render, time.perf_counter() - started, succeeded
+
+    def history_bytes(self) -> int:
+        return len(json.dumps(self.messages).encode("utf-8"))
+
+
+class HttpSession:
+    """One simulated client of service.py's streaming endpoint, keeping its history client-side."""
+
+    def __init__(self, url: str, timeout: float):
+        self.url = url.rstrip("/") + "/answer/stream"
+        self.timeout = timeout
+        self.messages: List[Dict[str, str]] = [{"role": "assistant", "content": app.WELCOME_MESSAGE}]
+
+    def ask(self, prompt: str) -> Tuple[Optional[float], float, bool]:
+        started = time.perf_counter()
+        first_token = None
+        answer = []
+        ok = False
+        self.messages.append({"role": "user", "content": prompt})
+        request = urllib.request.Request(self.url, data=json.dumps({"question": prompt}).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                event = None
+                for raw_line in response:
+                    line = raw_line.decode("utf-8").rstrip("\n")
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: ") and event == "token":
+                        if first_token is None:
+                            first_token = time.perf_counter() - started
+                        answer.append(json.loads(line[len("data: "):])["text"])
+                    elif line.startswith("data: ") and event in ("done", "error"):
+                        ok = event == "done"
+                        break
+        except Exception as e:
+            logger.error(f"Request failed: {e}")
+        self.messages.append({"role": "assistant", "content": "".join(answer)})
+        return first_token, time.perf_counter() - started, ok
+
+    def history_bytes(self) -> int:
+        return len(json.dumps(self.messages).encode("utf-8"))
+
+
+def rss_bytes() -> int:
+    """Current resident set size of this process (peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.mix = QuestionMix(self._question_pool(), args.sample_share, args.novel_share)
+        self.render_latency = Latency.parse(args.render_latency, args.seed + 8)
+        self.resources: Dict[str, Any] = {}
+        if args.target == "inprocess":
+            disable_intent_audit()
+            self.resources = live_resources() if args.live else build_fakes(args)
+
+    def _question_pool(self) -> List[str]:
+        if self.args.questions:
+            return [question for _, question in read_questions(self.args.questions)]
+        return QUESTION_MIX
+
+    def new_session(self) -> Any:
+        if self.args.target == "http":
+            return HttpSession(self.args.url, self.args.timeout)
+        return HeadlessSession(self.resources, self.render_latency)
+
+    def run_step(self, users: int) -> Dict[str, Any]:
+        """Run `users` concurrent conversations for step_seconds and summarise what completed."""
+        deadline = time.perf_counter() + self.args.step_seconds
+        stop = threading.Event()
+        lock = threading.Lock()
+        first_tokens: List[float] = []
+        totals: List[float] = []
+        errors = 0
+        history_sizes: List[int] = []
+        rss_before = rss_bytes()
+
+        def user(index: int) -> None:
+            nonlocal errors
+            rng = random.Random(self.args.seed * 100003 + users * 1009 + index)
+            while not stop.is_set():
+                session = self.new_session()
+                for _ in range(self.args.turns):
+                    first_token, total, ok = session.ask(self.mix.pick(rng))
+                    if time.perf_counter() > deadline:
+                        break  # Finished after the step ended; not counted
+                    with lock:
+                        totals.append(total)
+                        if first_token is not None:
+                            first_tokens.append(first_token)
+                        errors += 0 if ok else 1
+                    if stop.wait(rng.expovariate(1 / self.args.think_seconds) if self.args.think_seconds > 0 else 0):
+                        break
+                with lock:
+                    history_sizes.append(session.history_bytes())
+
+        threads = [threading.Thread(target=user, args=(i,), name=f"user-{i}", daemon=True) for i in range(users)]
+        for thread in threads:
+            thread.start()
+        time.sleep(self.args.step_seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        completed = len(totals)
+        return {
+            "users": users,
+            "completed": completed,
+            "throughput_per_second": completed / self.args.step_seconds,
+            "error_rate": errors / completed if completed else 0.0,
+            "first_token_seconds": _percentiles(first_tokens),
+            "answer_seconds": _percentiles(totals),
+            "history_bytes_mean": float(np.mean(history_sizes)) if history_sizes else 0.0,
+            "history_bytes_max": max(history_sizes, default=0),
+            "rss_bytes": rss_bytes(),
+            "rss_growth_bytes": rss_bytes() - rss_before,
+        }
+
+    def saturated(self, step: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Return why this step counts as saturated, or None."""
+        if step["error_rate"] > self.args.max_error_rate:
+            return f"error rate {step['error_rate']:.1%}"
+        p95 = step["answer_seconds"]["p95"]
+        if p95 is not None and p95 > self.args.slo_seconds:
+            return f"p95 answer latency {p95:.1f}s over the {self.args.slo_seconds:g}s SLO"
+        if previous and step["throughput_per_second"] < previous["throughput_per_second"] * (1 + self.args.min_gain):
+            return f"throughput grew less than {self.args.min_gain:.0%} over {previous['users']} users"
+        return None
+
+    def run(self) -> Dict[str, Any]:
+        steps: List[Dict[str, Any]] = []
+        saturation = None
+        print_header()
+        for users in self.args.users:
+            step = self.run_step(users)
+            reason = self.saturated(step, steps[-1] if steps else None)
+            steps.append(step)
+            print_step(step)
+            if reason:
+                saturation = {"users": users, "reason": reason}
+                break
+        return {"config": vars(self.args), "steps": steps, "saturation": saturation}
+
+
+def live_resources() -> Dict[str, Any]:
+    """Return the configured service clients, keyed by retrieve_context's parameter names."""
+    db = app.get_mongo_client()[app.MONGO_DB_NAME]
+    return {
+        "pinecone_index_docs": app.get_vector_index(app.PINECONE_INDEX_NAME_DOCS),
+        "pinecone_index_legis": app.get_vector_index(app.PINECONE_INDEX_NAME_LEGIS),
+        "mongo_collection_docs": db[app.MONGO_COLLECTION_NAME_DOCS],
+        "mongo_collection_legis": db[app.MONGO_COLLECTION_NAME_LEGIS],
+        "openai_client": app.get_openai_client(),
+    }
+
+
+def _fmt(seconds: Optional[float]) -> str:
+    return f"{seconds:7.2f}" if seconds is not None else "      -"
+
+
+def print_header() -> None:
+    print(f"{'users':>5} {'done':>6} {'q/s':>7} {'err':>6} {'ttft50':>7} {'ttft95':>7} "
+          f"{'ans50':>7} {'ans95':>7} {'ans99':>7} {'histKB':>7} {'rssMB':>7}   (seconds)")
+
+
+def print_step(step: Dict[str, Any]) -> None:
+    first, total = step["first_token_seconds"], step["answer_seconds"]
+    print(f"{step['users']:>5} {step['completed']:>6} {step['throughput_per_second']:>7.2f} {step['error_rate']:>6.1%} "
+          f"{_fmt(first['p50'])} {_fmt(first['p95'])} {_fmt(total['p50'])} {_fmt(total['p95'])} {_fmt(total['p99'])} "
+          f"{step['history_bytes_mean'] / 1024:>7.1f} {step['rss_bytes'] / 2**20:>7.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent TaxAUmate chat sessions and find the saturation point.")
+    parser.add_argument("--target", choices=("inprocess", "http"), default="inprocess")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="service.py base URL for --target http")
+    parser.add_argument("--live", action="store_true", help="In-process target: use the configured services instead of fakes")
+    parser.add_argument("--users", type=lambda value: [int(n) for n in value.split(",")], default=[1, 2, 4, 8, 16, 32],
+                        help="Comma-separated concurrent users per step (default: 1,2,4,8,16,32)")
+    parser.add_argument("--step-seconds", type=float, default=60.0, help="Duration of each step (default: %(default)s)")
+    parser.add_argument("--turns", type=int, default=5, help="Questions per session before starting a new one (default: %(default)s)")
+    parser.add_argument("--think-seconds", type=float, default=5.0, help="Mean pause between questions (default: %(default)s)")
+    parser.add_argument("--questions", help="JSONL file of questions (batch.py format) to use instead of the built-in mix")
+    parser.add_argument("--sample-share", type=float, default=0.3,
+                        help="Share of questions taken from the welcome-message samples (default: %(default)s)")
+    parser.add_argument("--novel-share", type=float, default=0.5,
+                        help="Share of questions made unique so they miss the caches (default: %(default)s)")
+    parser.add_argument("--slo-seconds", type=float, default=15.0, help="p95 answer latency treated as saturation (default: %(default)s)")
+    parser.add_argument("--max-error-rate", type=float, default=0.01, help="Error rate treated as saturation (default: %(default)s)")
+    parser.add_argument("--min-gain", type=float, default=0.1,
+                        help="Throughput gain per step below which the system counts as saturated (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="HTTP request timeout (default: %(default)s)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's per-question log lines")
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.verbose:
+        quiet_app_logs()
+
+    result = LoadTest(args).run()
+    saturation = result["saturation"]
+    if saturation:
+        print(f"\nSaturated at {saturation['users']} users: {saturation['reason']}.")
+    else:
+        print(f"\nNot saturated up to {args.users[-1]} users.")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""Process-local latency histograms and counters in Prometheus text format.
+
+Stages of the request path record durations into STAGE_SECONDS. render()
+produces the exposition text, which can be served on a local port
+(start_http_server) or written periodically to a file for node_exporter's
+textfile collector (start_file_writer).
+"""
+import contextlib
+import http.server
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {}  # bucket counts..., +Inf count, sum
+        self._listeners: List[Callable[[float, Dict[str, str]], None]] = []
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+        for listener in self._listeners:
+            listener(value, dict(zip(self.label_names, key)))
+
+    def add_listener(self, listener: Callable[[float, Dict[str, str]], None]) -> None:
+        """Also pass every raw observation to listener(value, labels), e.g. to compute exact percentiles."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[float, Dict[str, str]], None]) -> None:
+        self._listeners.remove(listener)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    labels = _format_labels(self.label_names, key, 'le="%g"' % bound)
+                    lines.append(f"{self.name}_bucket{labels} {_format_value(count)}")
+                labels = _format_labels(self.label_names, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(series[-1])}")
+        return lines
+
+
+class Registry:
+    """Holds metrics, plus caches whose own hit/miss counters are reported at render time."""
+
+    def __init__(self):
+        self._metrics: List[object] = []
+        self._caches: Dict[str, Callable[[], Dict[str, int]]] = {}
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_cache(self, name: str, get_stats: Callable[[], Dict[str, int]]) -> None:
+        """Report a cache's stats() ({'hits', 'misses', 'size'}) under the given cache label."""
+        self._caches[name] = get_stats
+
+    def _render_caches(self) -> List[str]:
+        stats = {}
+        for name, get_stats in self._caches.items():
+            try:
+                stats[name] = get_stats()
+            except Exception as e:
+                logger.warning(f"Reading stats for cache {name} failed: {e}")
+        if not stats:
+            return []
+        lines = ["# HELP taxaumate_cache_requests_total Cache lookups by result.",
+                 "# TYPE taxaumate_cache_requests_total counter"]
+        for name, values in stats.items():
+            lines.append(f'taxaumate_cache_requests_total{{cache="{name}",result="hit"}} {values["hits"]}')
+            lines.append(f'taxaumate_cache_requests_total{{cache="{name}",result="miss"}} {values["misses"]}')
+        lines += ["# HELP taxaumate_cache_entries Entries currently held by each cache.",
+                  "# TYPE taxaumate_cache_entries gauge"]
+        for name, values in stats.items():
+            lines.append(f'taxaumate_cache_entries{{cache="{name}"}} {values["size"]}')
+        return lines
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        lines.extend(self._render_caches())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "taxaumate_stage_duration_seconds", "Duration of each request stage.", ["stage", "target"])
+ERRORS = REGISTRY.counter("taxaumate_errors_total", "Failed or timed-out calls by stage.", ["stage", "target", "kind"])
+TOKENS_STREAMED = REGISTRY.counter("taxaumate_tokens_streamed_total", "Completion deltas streamed to users.")
+INTENT_DECISIONS = REGISTRY.counter("taxaumate_intent_decisions_total", "Advice-intent classifications by outcome.", ["decision"])
+WEAK_RETRIEVALS = REGISTRY.counter("taxaumate_weak_retrievals_total", "Questions whose best match scored below the relevance threshold.")
+IDENTIFIER_LOOKUPS = REGISTRY.counter(
+    "taxaumate_identifier_lookups_total", "Questions whose cited identifiers matched indexed chunks, by how the chunks were used.", ["mode"])
+TAX_ENGINE_ANSWERS = REGISTRY.counter("taxaumate_tax_engine_answers_total", "Questions answered by the deterministic tax engine.")
+CONTEXT_TOKENS = REGISTRY.histogram(
+    "taxaumate_context_tokens", "Prompt tokens of retrieved context per question.",
+    buckets=(250, 500, 1000, 2000, 4000, 6000, 8000, 12000, 16000, 32000))
+
+
+@contextlib.contextmanager
+def time_stage(stage: str, target: str = "") -> Iterator[None]:
+    """Record how long the block takes in STAGE_SECONDS."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage, target=target)
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+    """Serve /metrics on a background thread."""
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def start_file_writer(path: str, interval_seconds: float = 15.0) -> threading.Thread:
+    """Rewrite the metrics file atomically every interval_seconds on a background thread."""
+    def write_forever() -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        while True:
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics.")
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(REGISTRY.render())
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.warning(f"Writing metrics file failed: {e}")
+            time.sleep(interval_seconds)
+
+    thread = threading.Thread(target=write_forever, name="metrics-file", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,1397 @@
+"""Streamlit-free core of the TaxAUmate question flow, shared by app.py and async_pipeline.py.
+
+Configuration, the process-wide caches, retrieval and context assembly live here.
+retrieval_steps() and answer_steps() are the question flow, written once as
+generators that yield each I/O step they need and are sent its result back.
+run_steps() performs the steps in the calling thread (the Streamlit app, the
+benchmark and the load generator); async_pipeline.py awaits them instead,
+running anything blocking in a worker thread.
+
+Steps every driver performs:
+    ("embed", query, openai_client)                     -> the query embedding
+    ("fetch", collection, collection_name, ids, stamp)  -> the chunks for ids
+    ("call", function, *args)                           -> function(*args); blocking work, e.g. os.stat or tiktoken
+    ("fan_out", {name: step}, timeout, stage)           -> {name: result, or None if it failed or timed out}
+Steps answer_steps() leaves to its driver, which shows the answer:
+    ("status", text or None)  ("sources", raw_context)  ("reply", text, kind)
+    ("generate", question, context, openai_client, flight)  ("follow", flight)
+"""
+import contextlib
+import functools
+import hashlib
+import inspect
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Generator, Iterator, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from openai import OpenAI
+
+from embedding_store import EmbeddingStore
+from identifiers import IdentifierIndex, IDENTIFIER_INDEX_FILE, extract_identifiers
+from intent import ADVICE_DISCLAIMER, AuditLog, IntentClassifier, load_classifier
+from kb_versions import version_stamp
+from lexical_index import LexicalIndex, LEXICAL_INDEX_DIR
+from metrics import REGISTRY, STAGE_SECONDS, ERRORS, CONTEXT_TOKENS, INTENT_DECISIONS, WEAK_RETRIEVALS, TAX_ENGINE_ANSWERS, IDENTIFIER_LOOKUPS, time_stage
+from tax_engine import TaxEngine, TAX_DATA_DIR
+from vector_index import decode_chunk_metadata
+
+load_dotenv()
+
+# --- Application Constants ---
+EMBEDDING_MODEL = "text-embedding-ada-002"
+LLM_MODEL = "gpt-4o-mini"
+LLM_TEMPERATURE = 0.1
+TOP_K = 8 # Number of top results to retrieve from each Pinecone index
+
+# Concurrent retrieval; the timeouts also bound each Pinecone and MongoDB request, so abandoned calls free their threads
+RETRIEVAL_MAX_WORKERS = int(os.getenv("RETRIEVAL_MAX_WORKERS", "16"))
+PINECONE_QUERY_TIMEOUT_SECONDS = float(os.getenv("PINECONE_QUERY_TIMEOUT_SECONDS", "5"))
+MONGO_FETCH_TIMEOUT_SECONDS = float(os.getenv("MONGO_FETCH_TIMEOUT_SECONDS", "5"))
+# Per-request timeout for other OpenAI calls, e.g. each read of a streamed completion (the client's default is 600s)
+OPENAI_REQUEST_TIMEOUT_SECONDS = float(os.getenv("OPENAI_REQUEST_TIMEOUT_SECONDS", "60"))
+# Only the fields used to build the context are transferred from MongoDB
+CHUNK_PROJECTION = {"title": 1, "text": 1, "url": 1}
+
+# Retrieval result cache, keyed by a quantized query embedding and the published knowledge base versions (see kb_versions.py)
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "1024"))
+RETRIEVAL_CACHE_TTL_SECONDS = float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "3600"))
+RETRIEVAL_CACHE_QUANTUM = float(os.getenv("RETRIEVAL_CACHE_QUANTUM", "0.001"))
+
+# Hot-chunk cache in front of the MongoDB fetches, bounded by entry count and total UTF-8 text size
+CHUNK_CACHE_MAX_ENTRIES = int(os.getenv("CHUNK_CACHE_MAX_ENTRIES", "5000"))
+CHUNK_CACHE_MAX_BYTES = int(os.getenv("CHUNK_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Semantic answer cache: reuse a stored answer for a near-identical question that retrieved the same sources
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.97"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+
+# Single-flight: sessions asking an identical question while it is being answered follow the first one's answer
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+SINGLE_FLIGHT_WAIT_SECONDS = float(os.getenv("SINGLE_FLIGHT_WAIT_SECONDS", "120"))
+
+# Advice fast path: questions the local classifier confidently reads as requests for advice get the disclaimer directly
+ADVICE_FAST_PATH_ENABLED = os.getenv("ADVICE_FAST_PATH_ENABLED", "true").lower() == "true"
+
+# Tax engine: resident rate, Medicare levy and offset questions it can parse are calculated from tax_data/ without the LLM
+TAX_ENGINE_ENABLED = os.getenv("TAX_ENGINE_ENABLED", "true").lower() == "true"
+
+# Identifier lookup (see identifiers.py): chunks titled with a ruling or section the question cites are fetched directly,
+# skipping embedding and vector search when they number at most IDENTIFIER_DIRECT_MAX_CHUNKS; otherwise the first
+# IDENTIFIER_SEED_CHUNKS of them lead the vector results
+IDENTIFIER_LOOKUP_ENABLED = os.getenv("IDENTIFIER_LOOKUP_ENABLED", "true").lower() == "true"
+IDENTIFIER_DIRECT_MAX_CHUNKS = int(os.getenv("IDENTIFIER_DIRECT_MAX_CHUNKS", str(TOP_K)))
+IDENTIFIER_SEED_CHUNKS = int(os.getenv("IDENTIFIER_SEED_CHUNKS", "3"))
+
+# Hybrid search (see lexical_index.py): a local BM25 index is searched alongside the vector indexes and the two
+# rankings are fused by reciprocal rank; RRF_K damps how much the top few ranks of either list dominate
+LEXICAL_SEARCH_ENABLED = os.getenv("LEXICAL_SEARCH_ENABLED", "true").lower() == "true"
+LEXICAL_INDEX_NAME = "bm25"  # Search target name in logs and metrics
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# Weak retrievals: if no match scores at least RELEVANCE_THRESHOLD, the not-found message is shown without an LLM call
+# (0 disables; tune the value for the embedding model with tune_relevance.py)
+RELEVANCE_THRESHOLD = float(os.getenv("RELEVANCE_THRESHOLD", "0"))
+
+# Context assembly: chunks are added in relevance order until CONTEXT_TOKEN_BUDGET prompt tokens are used (0 = no limit)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")  # gpt-4o family; counts are estimated without tiktoken
+
+# Query embedding cache (shared by all sessions in this process)
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "2048"))
+EMBEDDING_CACHE_TTL_SECONDS = float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "86400"))
+# Micro-batching of embedding calls: under load, queries arriving within the window share one request (0 disables)
+EMBEDDING_BATCH_WINDOW_MS = int(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "20"))
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "64"))
+# Batches sent at once, so one slow request cannot hold up every session's embedding
+EMBEDDING_BATCH_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_BATCH_MAX_IN_FLIGHT", "4"))
+# Per-request timeout for embedding calls (the OpenAI client's default is 600s)
+EMBEDDING_REQUEST_TIMEOUT_SECONDS = float(os.getenv("EMBEDDING_REQUEST_TIMEOUT_SECONDS", "10"))
+# Persistent embedding store shared by all replicas on this host (see embedding_store.py)
+USE_EMBEDDING_STORE = os.getenv("USE_EMBEDDING_STORE", "false").lower() == "true"
+
+# Pinecone Index Names (from your build scripts)
+PINECONE_INDEX_NAME_DOCS = os.getenv("PINECONE_INDEX_NAME_ATO", "ato-legal-database")
+PINECONE_INDEX_NAME_LEGIS = os.getenv("PINECONE_INDEX_NAME_LEG", "ato-rag-app")
+
+# Vector search backend: "pinecone" (default) or "local" (see vector_index.py)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone").lower()
+LOCAL_INDEX_MODE = os.getenv("LOCAL_INDEX_MODE", "exact") # "exact" or "hnsw"
+# Read chunk title/text/url from vector metadata and only fall back to MongoDB for chunks stored without text
+INLINE_CHUNK_METADATA = os.getenv("INLINE_CHUNK_METADATA", "false").lower() == "true"
+
+# MongoDB Database and Collection Names
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "ato_data")
+MONGO_COLLECTION_NAME_DOCS = os.getenv("MONGO_COLLECTION_NAME_ATO", "documents")
+MONGO_COLLECTION_NAME_LEGIS = os.getenv("MONGO_COLLECTION_NAME_LEG", "legislation")
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+def shared_resource(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Create func's value once per process and set of arguments, like st.cache_resource without Streamlit.
+
+    As there, parameters whose names start with an underscore are not part of the key.
+    """
+    hashed = [not name.startswith("_") for name in inspect.signature(func).parameters]
+    values: Dict[Tuple[Any, ...], Any] = {}
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper(*args: Any) -> Any:
+        key = tuple(arg for arg, is_hashed in zip(args, hashed) if is_hashed)
+        with lock:
+            if key not in values:
+                values[key] = func(*args)
+            return values[key]
+    wrapper.clear = values.clear
+    return wrapper
+
+@shared_resource
+def get_retrieval_executor() -> ThreadPoolExecutor:
+    """Return the thread pool shared by all sessions for concurrent retrieval calls."""
+    return ThreadPoolExecutor(max_workers=RETRIEVAL_MAX_WORKERS, thread_name_prefix="retrieval")
+
+def fan_out(tasks: Dict[str, Callable[[], Any]], timeout: float, stage: str = "fan_out") -> Dict[str, Any]:
+    """Run named tasks concurrently; tasks that fail or miss the timeout come back as None.
+
+    A task's timeout starts when a pool thread picks it up, so time spent queued behind
+    other sessions' calls does not count against it; a task still queued after timeout is
+    cancelled. A running task that overruns is abandoned, and keeps its thread until the
+    client's own request timeout ends the call. Each task's duration is recorded under
+    the stage with its name as target, and the whole fan-out under target "all".
+    """
+    started: Dict[str, float] = {}
+
+    def timed(name: str, task: Callable[[], Any]) -> Any:
+        started[name] = time.monotonic()
+        with time_stage(stage, name):
+            return task()
+
+    executor = get_retrieval_executor()
+    timed_out: Dict[str, str] = {}
+    with time_stage(stage, "all"):
+        submitted = time.monotonic()
+        futures = {name: executor.submit(timed, name, task) for name, task in tasks.items()}
+        pending = dict(futures)
+        while pending:
+            now = time.monotonic()
+            for name, future in list(pending.items()):
+                if future.done():
+                    del pending[name]
+                elif name in started:
+                    if now >= started[name] + timeout:
+                        timed_out[name] = "respond"
+                        del pending[name]
+                elif now >= submitted + timeout:
+                    if future.cancel():
+                        timed_out[name] = "start"
+                        del pending[name]
+                    else:
+                        started.setdefault(name, now)  # Picked up just now; it gets its full timeout
+            if pending:
+                deadlines = [started[name] if name in started else submitted for name in pending]
+                wait(pending.values(), timeout=max(0.0, min(deadlines) + timeout - time.monotonic()), return_when=FIRST_COMPLETED)
+
+    results = {}
+    for name, future in futures.items():
+        if name in timed_out:
+            logger.warning(f"{name} did not {timed_out[name]} within {timeout}s; continuing without it.")
+            ERRORS.inc(stage=stage, target=name, kind="timeout")
+            results[name] = None
+        elif future.exception() is not None:
+            logger.error(f"{name} failed: {future.exception()}")
+            ERRORS.inc(stage=stage, target=name, kind="exception")
+            results[name] = None
+        else:
+            results[name] = future.result()
+    return results
+
+# --- Caching ---
+
+def normalize_query(query: str) -> str:
+    """Normalize query text for use as a cache key (case and whitespace insensitive)."""
+    return " ".join(query.split()).casefold()
+
+def knowledge_base_stamp() -> Tuple[Tuple[str, str], ...]:
+    """Return the published versions of both vector indexes and both MongoDB collections."""
+    return version_stamp(PINECONE_INDEX_NAME_DOCS, PINECONE_INDEX_NAME_LEGIS,
+                         MONGO_COLLECTION_NAME_DOCS, MONGO_COLLECTION_NAME_LEGIS)
+
+class LRUTTLCache:
+    """Thread-safe LRU cache with a per-entry TTL and hit/miss counters."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Optional[Any]:
+        """Return the cached value for a key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Any, value: Any) -> None:
+        """Store a value, evicting the least recently used entries beyond the size limit."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters and the current number of entries."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+class EmbeddingCache(LRUTTLCache):
+    """Query embedding cache keyed by model and normalized query text."""
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES, ttl_seconds: float = EMBEDDING_CACHE_TTL_SECONDS):
+        super().__init__(max_entries, ttl_seconds)
+
+    def get(self, query: str, model: str = EMBEDDING_MODEL) -> Optional[List[float]]:
+        """Return the cached embedding for a query, or None if missing or expired."""
+        return super().get((model, normalize_query(query)))
+
+    def put(self, query: str, embedding: List[float], model: str = EMBEDDING_MODEL) -> None:
+        """Store the embedding for a query."""
+        super().put((model, normalize_query(query)), embedding)
+
+@shared_resource
+def get_embedding_cache() -> EmbeddingCache:
+    """Return the process-wide query embedding cache."""
+    return EmbeddingCache()
+
+@shared_resource
+def get_embedding_store() -> Optional[EmbeddingStore]:
+    """Return the on-disk embedding store, or None if disabled or unavailable."""
+    if not USE_EMBEDDING_STORE:
+        return None
+    try:
+        store = EmbeddingStore()
+        logger.info(f"Embedding store opened with {store.stats()['entries']} entries.")
+        return store
+    except Exception as e:
+        logger.warning(f"Embedding store unavailable, continuing without it: {e}")
+        return None
+
+class RetrievalCache(LRUTTLCache):
+    """Caches retrieve_context results per quantized query embedding and knowledge base version."""
+
+    def __init__(self, max_entries: int = RETRIEVAL_CACHE_MAX_ENTRIES, ttl_seconds: float = RETRIEVAL_CACHE_TTL_SECONDS):
+        super().__init__(max_entries, ttl_seconds)
+        self._stamp: Optional[Tuple[Tuple[str, str], ...]] = None
+
+    def key(self, embedding: List[float], seed_ids: Tuple[Any, ...] = (),
+            stamp: Optional[Tuple[Tuple[str, str], ...]] = None) -> Tuple[Any, ...]:
+        """Build a cache key for an embedding, clearing the cache if a new knowledge base version was published.
+
+        seed_ids are the ids of chunks the question cites (see seed_matches), which change the result.
+        stamp is knowledge_base_stamp(), if the caller has already read it.
+        """
+        if stamp is None:
+            stamp = knowledge_base_stamp()
+        if stamp != self._stamp:
+            if self._stamp is not None:
+                logger.info("Knowledge base version changed; clearing the retrieval cache.")
+            self.clear()
+            self._stamp = stamp
+        quantized = np.round(np.asarray(embedding, dtype=np.float32) / RETRIEVAL_CACHE_QUANTUM).astype(np.int32)
+        digest = hashlib.blake2b(quantized.tobytes(), digest_size=16).hexdigest()
+        return (digest, stamp, TOP_K, VECTOR_BACKEND, seed_ids)
+
+@shared_resource
+def get_retrieval_cache() -> RetrievalCache:
+    """Return the process-wide retrieval result cache."""
+    return RetrievalCache()
+
+class ChunkCache:
+    """Segmented-LRU cache of MongoDB chunks keyed by (collection, _id), bounded by entries and bytes.
+
+    New chunks enter a probationary segment and are promoted to a protected segment
+    on their second hit, so frequently used chunks (e.g. Division 7A) survive bursts
+    of one-off lookups. Eviction takes from the probationary segment first.
+    """
+
+    PROTECTED_SHARE = 0.8
+
+    def __init__(self, max_entries: int = CHUNK_CACHE_MAX_ENTRIES, max_bytes: int = CHUNK_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._probation: "OrderedDict[Tuple[str, Any], Tuple[int, Dict[str, Any]]]" = OrderedDict()
+        self._protected: "OrderedDict[Tuple[str, Any], Tuple[int, Dict[str, Any]]]" = OrderedDict()
+        self._protected_bytes = 0
+        self._stamp: Optional[Tuple[Tuple[str, str], ...]] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(doc: Dict[str, Any]) -> int:
+        """Return the UTF-8 size of the chunk's text fields, which is what max_bytes budgets."""
+        return sum(len(value.encode("utf-8")) for value in doc.values() if isinstance(value, str))
+
+    def _check_version(self, stamp: Tuple[Tuple[str, str], ...]) -> None:
+        """Drop everything when a new knowledge base version is published (caller holds the lock)."""
+        if stamp != self._stamp:
+            self._probation.clear()
+            self._protected.clear()
+            self.bytes = self._protected_bytes = 0
+            self._stamp = stamp
+
+    def get_many(self, collection_name: str, ids: List[Any],
+                 stamp: Optional[Tuple[Tuple[str, str], ...]] = None) -> Dict[Any, Dict[str, Any]]:
+        """Return the cached chunks among ids, keyed by _id."""
+        found = {}
+        # The version check reads a file; keep it out of the lock every session's fetch goes through
+        if stamp is None:
+            stamp = knowledge_base_stamp()
+        with self._lock:
+            self._check_version(stamp)
+            for doc_id in ids:
+                key = (collection_name, doc_id)
+                if key in self._protected:
+                    self._protected.move_to_end(key)
+                    found[doc_id] = self._protected[key][1]
+                elif key in self._probation:
+                    size, doc = self._probation.pop(key)
+                    self._protected[key] = (size, doc)
+                    self._protected_bytes += size
+                    found[doc_id] = doc
+                    self._demote_protected_overflow()
+                else:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+        return found
+
+    def put_many(self, collection_name: str, docs: List[Dict[str, Any]],
+                 stamp: Optional[Tuple[Tuple[str, str], ...]] = None) -> None:
+        """Add freshly fetched chunks to the probationary segment."""
+        if stamp is None:
+            stamp = knowledge_base_stamp()
+        sizes = [self._size(doc) for doc in docs]
+        with self._lock:
+            self._check_version(stamp)
+            for doc, size in zip(docs, sizes):
+                key = (collection_name, doc['_id'])
+                # A chunk over a quarter of the byte budget would flush too much of the cache to be worth keeping
+                if size > self.max_bytes // 4 or key in self._protected or key in self._probation:
+                    continue
+                self._probation[key] = (size, doc)
+                self.bytes += size
+            self._evict()
+
+    def _demote_protected_overflow(self) -> None:
+        while self._protected and (len(self._protected) > self.max_entries * self.PROTECTED_SHARE
+                                   or self._protected_bytes > self.max_bytes * self.PROTECTED_SHARE):
+            key, (size, doc) = self._protected.popitem(last=False)
+            self._protected_bytes -= size
+            self._probation[key] = (size, doc)
+
+    def _evict(self) -> None:
+        while len(self._probation) + len(self._protected) > self.max_entries or self.bytes > self.max_bytes:
+            if self._probation:
+                _, (size, _) = self._probation.popitem(last=False)
+            else:
+                _, (size, _) = self._protected.popitem(last=False)
+                self._protected_bytes -= size
+            self.bytes -= size
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._probation) + len(self._protected), "bytes": self.bytes}
+
+@shared_resource
+def get_chunk_cache() -> ChunkCache:
+    """Return the process-wide MongoDB chunk cache."""
+    return ChunkCache()
+
+def fetch_chunks(collection: Any, collection_name: str, ids: List[Any],
+                 stamp: Optional[Tuple[Tuple[str, str], ...]] = None) -> List[Dict[str, Any]]:
+    """Return the chunks for ids, fetching only those missing from the chunk cache from MongoDB."""
+    if not ids:
+        return []
+    cache = get_chunk_cache()
+    cached = cache.get_many(collection_name, ids, stamp)
+    missing_ids = [doc_id for doc_id in ids if doc_id not in cached]
+    fetched = []
+    if missing_ids:
+        # One batch sized to the request, so the whole result arrives in a single round trip
+        cursor = collection.find({"_id": {"$in": missing_ids}}, projection=CHUNK_PROJECTION, batch_size=len(missing_ids))
+        fetched = list(cursor)
+    cache.put_many(collection_name, fetched, stamp)
+    return list(cached.values()) + fetched
+
+class SemanticAnswerCache:
+    """Stores sanitized answers by question embedding and returns them for near-duplicate questions.
+
+    A cached answer is reused only when the cosine similarity clears the threshold, the
+    new retrieval returned the same set of source ids, and the entry was written for the
+    current knowledge base versions and LLM model.
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_SIMILARITY, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._vectors: Optional[np.ndarray] = None  # Ring buffer of unit-normalised question embeddings
+        self._entries: List[Optional[Dict[str, Any]]] = [None] * max_entries
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def _unit(self, embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, embedding: List[float], source_ids: List[str],
+               stamp: Optional[Tuple[Tuple[str, str], ...]] = None) -> Optional[str]:
+        """Return a cached answer for this question and retrieval, or None."""
+        version = (knowledge_base_stamp() if stamp is None else stamp, LLM_MODEL)
+        with self._lock:
+            if self._vectors is None:
+                self.misses += 1
+                return None
+            similarities = self._vectors @ self._unit(embedding)
+            now = time.monotonic()
+            for slot in np.argsort(-similarities):
+                if similarities[slot] < self.threshold:
+                    break
+                entry = self._entries[slot]
+                if entry is None:
+                    continue
+                if entry["version"] != version or now - entry["created"] > self.ttl_seconds:
+                    self._entries[slot] = None
+                    self._vectors[slot] = 0.0
+                    continue
+                if entry["source_ids"] == frozenset(source_ids):
+                    self.hits += 1
+                    return entry["answer"]
+            self.misses += 1
+            return None
+
+    def store(self, embedding: List[float], source_ids: List[str], answer: str,
+              stamp: Optional[Tuple[Tuple[str, str], ...]] = None) -> None:
+        """Remember an answer, overwriting the oldest entry once the cache is full."""
+        vector = self._unit(embedding)
+        version = (knowledge_base_stamp() if stamp is None else stamp, LLM_MODEL)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            slot = self._next_slot
+            self._vectors[slot] = vector
+            self._entries[slot] = {
+                "source_ids": frozenset(source_ids),
+                "answer": answer,
+                "version": version,
+                "created": time.monotonic(),
+            }
+            self._next_slot = (slot + 1) % self.max_entries
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters and the current number of entries."""
+        with self._lock:
+            size = sum(entry is not None for entry in self._entries)
+            return {"hits": self.hits, "misses": self.misses, "size": size}
+
+@shared_resource
+def get_answer_cache() -> SemanticAnswerCache:
+    """Return the process-wide semantic answer cache."""
+    return SemanticAnswerCache()
+
+class InFlightAnswer:
+    """The shared state of one question being answered: its retrieval result and the streamed deltas so far."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._sources: Optional[Tuple[str, List[Dict[str, Any]]]] = None
+        self._deltas: List[str] = []
+        self._done = False
+        self._error: Optional[BaseException] = None
+
+    def set_sources(self, context: str, raw_context: List[Dict[str, Any]]) -> None:
+        with self._cond:
+            self._sources = (context, raw_context)
+            self._cond.notify_all()
+
+    def relay(self, deltas: Any) -> Any:
+        """Yield the leader's non-empty deltas while publishing each one to followers."""
+        for delta in deltas:
+            if delta is None:
+                continue
+            with self._cond:
+                self._deltas.append(delta)
+                self._cond.notify_all()
+            yield delta
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """Mark the answer complete (or failed); only the first call has any effect."""
+        with self._cond:
+            if not self._done:
+                self._done = True
+                self._error = error
+                self._cond.notify_all()
+
+    def wait_sources(self, timeout: float = SINGLE_FLIGHT_WAIT_SECONDS) -> Tuple[str, List[Dict[str, Any]]]:
+        """Block until the leader's retrieval result is available, re-raising the leader's error if it failed first."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._sources is not None or self._done, timeout):
+                raise TimeoutError("Timed out waiting for an identical in-flight question.")
+            if self._sources is None and self._error is not None:
+                raise self._error
+            return self._sources or ("", [])
+
+    def follow(self, timeout: float = SINGLE_FLIGHT_WAIT_SECONDS) -> Any:
+        """Yield the leader's deltas as they arrive, re-raising the leader's error if it failed."""
+        position = 0
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(lambda: len(self._deltas) > position or self._done, timeout):
+                    raise TimeoutError("Timed out waiting for an identical in-flight question.")
+                new_deltas = self._deltas[position:]
+                done, error = self._done, self._error
+            position += len(new_deltas)
+            yield from new_deltas
+            if done and position == len(self._deltas):
+                if error is not None:
+                    raise error
+                return
+
+class SingleFlight:
+    """Registry of in-flight questions keyed by normalized question text."""
+
+    def __init__(self):
+        self._flights: Dict[str, InFlightAnswer] = {}
+        self._lock = threading.Lock()
+        self.followers = 0
+
+    def join(self, question: str) -> Tuple[InFlightAnswer, bool]:
+        """Return the in-flight answer for a question and whether the caller is its leader."""
+        key = normalize_query(question)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.followers += 1
+                return flight, False
+            flight = InFlightAnswer()
+            self._flights[key] = flight
+            return flight, True
+
+    def release(self, question: str, flight: InFlightAnswer) -> None:
+        """Finish a leader's flight and stop new sessions from joining it."""
+        flight.finish()
+        key = normalize_query(question)
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+@shared_resource
+def get_single_flight() -> SingleFlight:
+    """Return the process-wide registry of in-flight questions."""
+    return SingleFlight()
+
+class EmbeddingBatcher:
+    """Collects embedding requests from concurrent sessions and sends them as one batched API call.
+
+    A background thread sends a query at once when nothing else is queued. When other
+    queries are already waiting, it keeps collecting for up to window_ms (or until
+    max_batch are waiting), embeds the distinct texts in a single request and hands each
+    caller its own vector. Up to max_in_flight requests run at once, each with its own
+    timeout, so a stalled request only fails its own batch. Only the synchronous path
+    (embed_query) uses it; the async pipeline calls the AsyncOpenAI client directly.
+    """
+
+    def __init__(self, openai_client: OpenAI, window_ms: int = EMBEDDING_BATCH_WINDOW_MS,
+                 max_batch: int = EMBEDDING_BATCH_MAX_SIZE, max_in_flight: int = EMBEDDING_BATCH_MAX_IN_FLIGHT,
+                 request_timeout: float = EMBEDDING_REQUEST_TIMEOUT_SECONDS):
+        self.openai_client = openai_client
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.request_timeout = request_timeout
+        self.batches = 0
+        self.queries = 0
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._lock = threading.Lock()
+        # Queries keep gathering in the queue while every slot is busy
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="embedding-batch")
+        threading.Thread(target=self._run, name="embedding-batcher", daemon=True).start()
+
+    def embed(self, query: str, timeout: Optional[float] = 30) -> List[float]:
+        """Return the embedding for one query, waiting for the batch it joins."""
+        future: Future = Future()
+        self._queue.put((query, future))
+        return future.result(timeout=timeout)
+
+    def _collect(self) -> List[Tuple[str, Future]]:
+        """Block for the next query, then gather the queries queued behind it."""
+        batch = [self._queue.get()]
+        if self._queue.empty():
+            return batch  # Idle: waiting for company would only add latency
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            self._slots.acquire()
+            self._executor.submit(self._send, self._collect())
+
+    def _send(self, batch: List[Tuple[str, Future]]) -> None:
+        # Any failure must reach every caller in the batch, and must not leak the slot
+        try:
+            texts = list(dict.fromkeys(query for query, _ in batch))
+            response = self.openai_client.embeddings.create(input=texts, model=EMBEDDING_MODEL, timeout=self.request_timeout)
+            vectors = {texts[item.index]: item.embedding for item in response.data}
+            with self._lock:
+                self.batches += 1
+                self.queries += len(batch)
+            for query, future in batch:
+                future.set_result(vectors[query])
+        except Exception as e:
+            logger.error(f"Embedding batch of {len(batch)} failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._slots.release()
+
+@shared_resource
+def get_embedding_batcher(_openai_client: OpenAI) -> EmbeddingBatcher:
+    """Return the process-wide embedding batcher (the client argument is not part of the cache key)."""
+    return EmbeddingBatcher(_openai_client)
+
+def embed_query(query: str, openai_client: OpenAI) -> List[float]:
+    """Return the embedding for a query, checking the memory cache and disk store before calling OpenAI."""
+    cache = get_embedding_cache()
+    embedding = cache.get(query)
+    if embedding is not None:
+        return embedding
+
+    store = get_embedding_store()
+    key = normalize_query(query)
+    if store is not None:
+        try:
+            embedding = store.get(key, EMBEDDING_MODEL)
+        except Exception as e:
+            logger.warning(f"Embedding store read failed: {e}")
+
+    if embedding is None:
+        with time_stage("embed"):
+            if EMBEDDING_BATCH_WINDOW_MS > 0:
+                embedding = get_embedding_batcher(openai_client).embed(query)
+            else:
+                embedding = openai_client.embeddings.create(input=[query], model=EMBEDDING_MODEL,
+                                                            timeout=EMBEDDING_REQUEST_TIMEOUT_SECONDS).data[0].embedding
+        if store is not None:
+            try:
+                store.put(key, embedding, EMBEDDING_MODEL)
+            except Exception as e:
+                logger.warning(f"Embedding store write failed: {e}")
+
+    cache.put(query, embedding)
+    return embedding
+
+# --- Core Logic ---
+
+def sanitize_response(text: str) -> str:
+    """Cleans the AI's response to fix common formatting and concatenation issues."""
+    # Remove markdown code blocks and backticks
+    text = re.sub(r'```[\s\S]*?```', '', text) # Remove entire code blocks
+    text = text.replace('`', '') # Remove inline code backticks
+
+    # Add space between numbers/commas and letters (e.g., "1000dollars" -> "1000 dollars")
+    text = re.sub(r'([,\d]+)([a-zA-Z])', r'\1 \2', text)
+    # Add space between numbers/commas and parentheses (e.g., "100(a)" -> "100 (a)")
+    text = re.sub(r'([,\d]+)([\(\)])', r'\1 \2', text)
+    return text
+
+_NUMBER_BEFORE_LETTER_OR_PAREN = re.compile(r'([,\d])(?=[a-zA-Z\(\)])')
+_NUMERIC_CHAR = re.compile(r'[,\d]')
+_LETTER_OR_PAREN = re.compile(r'[a-zA-Z\(\)]')
+
+class StreamingSanitizer:
+    """Incremental equivalent of sanitize_response for streamed text.
+
+    feed() only processes the new delta (plus any still-open code block), and
+    text() always equals sanitize_response() of everything fed so far.
+    """
+
+    def __init__(self):
+        self._stable = ""       # Sanitized output that later deltas can no longer change
+        self._last_char = ""    # Last character of the backtick-free text, for number spacing across deltas
+        self._pending = ""      # Raw text of an unclosed code block, or trailing backticks that may open one
+        self._in_block = False
+        self._scan_from = 3     # Where to resume looking for the closing fence inside _pending
+
+    def _space(self, clean: str) -> str:
+        """Apply sanitize_response's number spacing to backtick-free text following _last_char."""
+        if not clean:
+            return ""
+        spaced = _NUMBER_BEFORE_LETTER_OR_PAREN.sub(r'\1 ', clean)
+        if _NUMERIC_CHAR.match(self._last_char) and _LETTER_OR_PAREN.match(clean):
+            spaced = " " + spaced
+        return spaced
+
+    def _emit(self, raw: str) -> None:
+        clean = raw.replace('`', '')
+        if clean:
+            self._stable += self._space(clean)
+            self._last_char = clean[-1]
+
+    def feed(self, delta: str) -> None:
+        """Consume the next chunk of raw model output."""
+        buf = self._pending + delta
+        self._pending = ""
+        while buf:
+            if self._in_block:
+                close = buf.find("```", self._scan_from)
+                if close == -1:
+                    self._pending = buf
+                    self._scan_from = max(3, len(buf) - 2)
+                    return
+                # The whole block, fences included, is dropped
+                buf = buf[close + 3:]
+                self._in_block = False
+                continue
+            start = buf.find("```")
+            if start == -1:
+                # Up to two trailing backticks may become a fence with the next delta
+                held = len(buf) - len(buf.rstrip('`'))
+                self._emit(buf[:len(buf) - held])
+                self._pending = buf[len(buf) - held:]
+                return
+            self._emit(buf[:start])
+            buf = buf[start:]
+            self._in_block = True
+            self._scan_from = 3
+
+    def stable_text(self) -> str:
+        """Return the part of the sanitized response that later deltas cannot change (it only ever grows)."""
+        return self._stable
+
+    def text(self) -> str:
+        """Return the sanitized response so far."""
+        if self._in_block:
+            # sanitize_response leaves an unclosed block in place, minus its backticks
+            return self._stable + self._space(self._pending.replace('`', ''))
+        return self._stable
+
+def merge_matches(results_docs: Any, results_legis: Any) -> List[Dict[str, Any]]:
+    """Merge both indexes' matches by score and return up to TOP_K unique {'id', 'source_type', 'score'} items."""
+    combined_matches = []
+    if results_docs and results_docs.get('matches'):
+        for match in results_docs['matches']:
+            match['source_type'] = 'document' 
+            combined_matches.append(match)
+    if results_legis and results_legis.get('matches'):
+        for match in results_legis['matches']:
+            match['source_type'] = 'legislation' 
+            combined_matches.append(match)
+    
+    # Sort by score in descending order and take top_k overall
+    combined_matches.sort(key=lambda x: x['score'], reverse=True)
+    
+    # Get unique IDs from the top_k combined matches
+    unique_result_ids = []
+    seen_ids = set()
+    for match in combined_matches:
+        if match['id'] not in seen_ids:
+            item = {'id': match['id'], 'source_type': match['source_type'], 'score': match['score']}
+            if INLINE_CHUNK_METADATA:
+                item['doc'] = decode_chunk_metadata(match.get('metadata'))
+            unique_result_ids.append(item)
+            seen_ids.add(match['id'])
+        if len(unique_result_ids) >= TOP_K: 
+            break
+    return unique_result_ids
+
+def is_weak_retrieval(unique_result_ids: List[Dict[str, Any]]) -> bool:
+    """Return True if even the best match scores below RELEVANCE_THRESHOLD, so the knowledge base has nothing useful."""
+    return RELEVANCE_THRESHOLD > 0 and all(item['score'] < RELEVANCE_THRESHOLD for item in unique_result_ids)
+
+@shared_resource
+def get_identifier_index() -> Optional[IdentifierIndex]:
+    """Return the identifier index, or None if disabled or not built."""
+    if not IDENTIFIER_LOOKUP_ENABLED:
+        return None
+    try:
+        index = IdentifierIndex.load(IDENTIFIER_INDEX_FILE)
+        logger.info(f"Identifier index loaded with {len(index.identifiers)} identifiers.")
+        return index
+    except FileNotFoundError:
+        logger.info(f"No identifier index at {IDENTIFIER_INDEX_FILE}; cited rulings and sections go through vector search.")
+        return None
+    except Exception as e:
+        logger.warning(f"Identifier index unavailable, continuing without it: {e}")
+        return None
+
+def identifier_matches(query: str) -> List[Dict[str, Any]]:
+    """Return {'id', 'source_type', 'score'} items for the chunks of the rulings and sections a query cites."""
+    index = get_identifier_index()
+    if index is None:
+        return []
+    identifiers = extract_identifiers(query)
+    if not identifiers:
+        return []
+    if not index.is_current(MONGO_COLLECTION_NAME_DOCS, MONGO_COLLECTION_NAME_LEGIS):
+        logger.warning("Identifier index was built from older collections; rebuild it with 'python identifiers.py build'.")
+        return []
+    # An exact citation is as relevant as a match can be
+    return [dict(item, score=1.0) for item in index.lookup(identifiers)]
+
+def is_direct_lookup(identified: List[Dict[str, Any]]) -> bool:
+    """Return True if the cited chunks are few enough to fetch directly, without embedding the question."""
+    return bool(identified) and len(identified) <= IDENTIFIER_DIRECT_MAX_CHUNKS
+
+def seed_matches(identified: List[Dict[str, Any]], unique_result_ids: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Put cited chunks ahead of the vector results and return up to TOP_K items.
+
+    Cited chunks that vector search also found come first, topped up with the
+    leading cited chunks to IDENTIFIER_SEED_CHUNKS, then the other vector results.
+    """
+    identified_ids = {item['id'] for item in identified}
+    seeded = [item for item in unique_result_ids if item['id'] in identified_ids]
+    seeded_ids = {item['id'] for item in seeded}
+    for item in identified:
+        if len(seeded) >= IDENTIFIER_SEED_CHUNKS:
+            break
+        if item['id'] not in seeded_ids:
+            seeded.append(item)
+            seeded_ids.add(item['id'])
+    return (seeded + [item for item in unique_result_ids if item['id'] not in seeded_ids])[:TOP_K]
+
+@shared_resource
+def get_lexical_index() -> Optional[LexicalIndex]:
+    """Return the BM25 index, or None if disabled or not built."""
+    if not LEXICAL_SEARCH_ENABLED:
+        return None
+    try:
+        index = LexicalIndex(LEXICAL_INDEX_DIR)
+        logger.info(f"BM25 index loaded with {len(index.ids)} chunks and {len(index.term_ids)} terms.")
+        return index
+    except FileNotFoundError:
+        logger.info(f"No BM25 index at {LEXICAL_INDEX_DIR}; searching the vector indexes only.")
+        return None
+    except Exception as e:
+        logger.warning(f"BM25 index unavailable, continuing without it: {e}")
+        return None
+
+def current_lexical_index() -> Optional[LexicalIndex]:
+    """Return the BM25 index if it was built from the published collections."""
+    index = get_lexical_index()
+    if index is not None and not index.is_current(MONGO_COLLECTION_NAME_DOCS, MONGO_COLLECTION_NAME_LEGIS):
+        logger.warning("BM25 index was built from older collections; rebuild it with 'python lexical_index.py build'.")
+        return None
+    return index
+
+def fuse_matches(unique_result_ids: List[Dict[str, Any]], lexical_matches: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Fuse the merged vector results with the BM25 results by reciprocal rank and return up to TOP_K items.
+
+    A chunk scores the sum of 1 / (RRF_K + rank) over the rankings it appears in. Items keep
+    their vector 'score' (0.0 for chunks only BM25 found), so RELEVANCE_THRESHOLD still judges
+    dense similarity.
+    """
+    fused: Dict[Any, List[Any]] = {}
+    for ranking, is_dense in ((unique_result_ids, True), (lexical_matches, False)):
+        for rank, item in enumerate(ranking, start=1):
+            if item['id'] not in fused:
+                fused[item['id']] = [0.0, item if is_dense else dict(item, score=0.0)]
+            fused[item['id']][0] += 1.0 / (RRF_K + rank)
+    ranked = sorted(fused.values(), key=lambda entry: entry[0], reverse=True)
+    return [item for _, item in ranked[:TOP_K]]
+
+def split_fetch_ids(unique_result_ids: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Any], List[Any]]:
+    """Return the chunks already read from vector metadata, and the document and legislation ids still to fetch."""
+    # Chunks whose text came back with the vector need no MongoDB round trip
+    inline_docs = [dict(item['doc'], _id=item['id']) for item in unique_result_ids if item.get('doc')]
+
+    # Separate IDs by source type to fetch efficiently
+    doc_ids_to_fetch = [item['id'] for item in unique_result_ids if item['source_type'] == 'document' and not item.get('doc')]
+    legis_ids_to_fetch = [item['id'] for item in unique_result_ids if item['source_type'] == 'legislation' and not item.get('doc')]
+    return inline_docs, doc_ids_to_fetch, legis_ids_to_fetch
+
+@shared_resource
+def get_token_encoder() -> Optional[Any]:
+    """Return the tiktoken encoding used to count prompt tokens, or None to estimate them."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning(f"tiktoken encoding {TOKENIZER_ENCODING} unavailable ({e}); estimating token counts.")
+        return None
+
+def count_tokens(text: str) -> int:
+    """Count the prompt tokens in text."""
+    encoder = get_token_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    # Without tiktoken: a token per short word or punctuation mark, and more for long words
+    return sum(1 + len(piece) // 6 for piece in re.findall(r"\w+|[^\w\s]", text))
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Return the longest run of whole sentences from the start of text that fits in max_tokens.
+
+    Line breaks also count as boundaries, since legislation is laid out as
+    numbered subsections. Returns "" if not even the first sentence fits.
+    """
+    end = 0
+    used = 0
+    start = 0
+    for boundary in list(SENTENCE_BOUNDARY.finditer(text)) + [None]:
+        sentence_end = boundary.start() if boundary else len(text)
+        used += count_tokens(text[start:boundary.end() if boundary else len(text)])
+        if used > max_tokens:
+            break
+        end = sentence_end
+        start = boundary.end() if boundary else len(text)
+    return text[:end].rstrip()
+
+def build_context(unique_result_ids: List[Dict[str, Any]], mongo_results: List[Dict[str, Any]],
+                  token_budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[str, List[Dict[str, Any]]]:
+    """Format fetched chunks, in relevance order, into the LLM context and the sources list for display.
+
+    Chunks are added until token_budget is reached; the chunk that crosses it is cut
+    at the last sentence that fits, and less relevant chunks are left out.
+    """
+    formatted_context = ""
+    raw_context_for_display = []
+    tokens_used = 0
+    budget_reached = False
+
+    # Create a dictionary for faster lookup by _id
+    mongo_docs_map = {doc['_id']: doc for doc in mongo_results}
+
+    # Reconstruct context in order of relevance (from unique_result_ids)
+    for item in unique_result_ids:
+        doc = mongo_docs_map.get(item['id'])
+        if doc:
+            title = doc.get('title', 'Untitled')
+            text_snippet = doc.get('text', 'No text available')
+            
+            # Determine URL/Source Identifier based on type
+            if item['source_type'] == 'document':
+                url_or_source = doc.get('url', 'No URL available')
+                source_display_name = "Document"
+            elif item['source_type'] == 'legislation':
+                url_or_source = doc.get('title', 'No Title') 
+                source_display_name = "Legislation"
+            else:
+                url_or_source = 'N/A'
+                source_display_name = "Unknown"
+
+            header = f"---\nSource Type: {source_display_name}\nTitle: {title}\nLink/ID: {url_or_source}\nText: "
+            footer = "\n---\n\n"
+            overhead = count_tokens(header + footer)
+            text_tokens = count_tokens(text_snippet)
+            if token_budget and tokens_used + overhead + text_tokens > token_budget:
+                budget_reached = True
+                text_snippet = truncate_to_tokens(text_snippet, token_budget - tokens_used - overhead)
+                if not text_snippet:
+                    break
+                text_tokens = count_tokens(text_snippet)
+
+            formatted_context += header + text_snippet + footer
+            tokens_used += overhead + text_tokens
+            raw_context_for_display.append({
+                "id": item['id'],
+                "title": title,
+                "link_or_id": url_or_source,
+                "source_type": source_display_name
+            })
+            if budget_reached:
+                break
+
+    CONTEXT_TOKENS.observe(tokens_used)
+    logger.info(f"Context: {tokens_used} tokens from {len(raw_context_for_display)} of {len(unique_result_ids)} chunks"
+                + (f" (budget {token_budget} reached)" if budget_reached else ""))
+    return formatted_context, raw_context_for_display
+
+class RetrievalError(RuntimeError):
+    """Retrieval failed, as opposed to finding nothing relevant; the question should be retried, not answered."""
+
+
+def check_search_results(index_results: Dict[str, Any], unique_result_ids: List[Dict[str, Any]]) -> None:
+    """Raise if the search failed rather than found nothing: every vector index failed, or one did and nothing was found.
+
+    BM25 results alone don't count, since an empty vector search is not the same as an outage.
+    """
+    failed = [name for name in (PINECONE_INDEX_NAME_DOCS, PINECONE_INDEX_NAME_LEGIS) if index_results.get(name) is None]
+    if len(failed) == 2:
+        raise RuntimeError("No vector index returned results.")
+    if failed and not unique_result_ids:
+        raise RuntimeError(f"{failed[0]} failed and the other indexes found nothing.")
+
+
+def check_fetch_results(fetch_ids: Dict[str, List[Any]], fetch_results: Dict[str, Any], mongo_results: List[Dict[str, Any]]) -> None:
+    """Raise if a collection that had chunks to fetch failed and no chunk text came back at all."""
+    failed = [name for name, ids in fetch_ids.items() if ids and fetch_results.get(name) is None]
+    if failed and not mongo_results:
+        raise RuntimeError(f"Could not fetch chunks from {', '.join(failed)}.")
+
+
+def register_cache_metrics() -> None:
+    """Report the process-wide caches' hit/miss counters in the metrics export."""
+    REGISTRY.register_cache("embedding", lambda: get_embedding_cache().stats())
+    REGISTRY.register_cache("retrieval", lambda: get_retrieval_cache().stats())
+    REGISTRY.register_cache("chunk", lambda: get_chunk_cache().stats())
+    REGISTRY.register_cache("answer", lambda: get_answer_cache().stats())
+
+NOT_FOUND_MESSAGE = ("I could not find specific information about this in my knowledge base. "
+                     "For the most accurate details, please refer to the official ATO website.")
+
+SYSTEM_PROMPT = f"""
+You are TaxAUmate, an expert AI assistant specializing in Australian Taxation Office (ATO) matters and Australian Legal Database. Your primary function is to provide accurate, factual, and helpful information based *only* on the provided context documents. You must operate under the following strict guidelines:
+
+**Guideline 1: Scope of Knowledge & Disclaimers**
+- Your knowledge is strictly limited to the information contained in the provided context.
+- If the user asks a question that requires information not present in the context, you MUST state: "{NOT_FOUND_MESSAGE}"
+- You are an information provider, NOT a financial advisor. For any query that asks for advice, opinions, recommendations, or "should I" type questions, you MUST respond with the following disclaimer and nothing else:
+  "{ADVICE_DISCLAIMER}"
+
+**Guideline 2: Answering and Formatting**
+- When the query is within scope and the context contains relevant information, provide a direct and comprehensive answer.
+- Synthesize information from multiple sources in the context to create a cohesive response.
+- **CRITICAL FORMATTING RULE:** Present ALL information, including step-by-step calculations, as standard text, paragraphs, and bullet points. **DO NOT use Markdown code blocks (```) or inline code backticks (`) for any reason.** All text, especially numbers and calculations, must render in the standard user-facing font.
+- **Improved Tax Rate Handling:** If the user asks for "latest income tax rates" or similar without specifying a financial year, assume they are asking about the **most recently available financial year** in your context documents (e.g., if you have 2024-25 and 2025-26, and 2025-26 is described as "upcoming" or "current," prioritize it; otherwise, use the latest *completed* year). You MUST state this assumption in your response (e.g., "Assuming the 2025-2026 financial year based on the information available to me...").
+- **Crucially, every piece of information or claim you make must be followed by an inline citation**, like this: (Source: [Title of Document](URL/Source Identifier)).
+
+**Guideline 3: Citing Sources**
+- At the end of your entire response, include a "Sources" section.
+- List all the unique documents you cited in your response as a bulleted list, with each item formatted as: `[Title of Document](URL/Source Identifier)`.
+- If the source is legislation, use the Source Identifier (e.g., "TR_2012/5") if a URL is not available.
+
+**Workflow:**
+1.  Analyze the user's query.
+2.  Determine if it's a request for factual information that can be answered from the context.
+3.  If it's a request for advice or is out-of-scope, provide the disclaimer.
+4.  If it's a valid query, synthesize an answer from the provided context, following all formatting rules and citing sources inline.
+5.  Conclude with a list of all sources used.
+"""
+
+@shared_resource
+def get_intent_classifier() -> IntentClassifier:
+    """Return the advice-intent classifier, loaded or trained once per process."""
+    return load_classifier()
+
+@shared_resource
+def get_intent_audit_log() -> AuditLog:
+    return AuditLog()
+
+def is_advice_request(prompt: str) -> bool:
+    """Return True if the question should get the advice disclaimer without retrieval or an LLM call."""
+    if not ADVICE_FAST_PATH_ENABLED:
+        return False
+    try:
+        decision = get_intent_classifier().classify(prompt)
+    except Exception as e:
+        logger.warning(f"Intent classification failed: {e}")
+        return False
+    get_intent_audit_log().record(prompt, decision)
+    INTENT_DECISIONS.inc(decision="advice" if decision["advice"] else "other")
+    return decision["advice"]
+
+@shared_resource
+def get_tax_engine() -> Optional[TaxEngine]:
+    """Return the tax engine loaded from TAX_DATA_DIR, or None if the data cannot be loaded."""
+    try:
+        return TaxEngine.load(TAX_DATA_DIR)
+    except Exception as e:
+        logger.error(f"Failed to load tax data from {TAX_DATA_DIR}: {e}")
+        return None
+
+def answer_from_tax_engine(prompt: str) -> Optional[str]:
+    """Return a calculated, cited answer to a rate or tax calculation question, or None to use the LLM."""
+    if not TAX_ENGINE_ENABLED:
+        return None
+    engine = get_tax_engine()
+    if engine is None:
+        return None
+    try:
+        answer = engine.answer(prompt)
+    except Exception as e:
+        logger.warning(f"Tax engine failed on the question: {e}")
+        return None
+    if answer is not None:
+        TAX_ENGINE_ANSWERS.inc()
+    return answer
+
+def build_messages(prompt: str, context: str) -> List[Dict[str, str]]:
+    """Return the chat messages sent to the LLM for a question and its retrieved context."""
+    return [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": f"CONTEXT:\n{context}\n\nQUESTION:\n{prompt}"}]
+
+
+# --- Question Flow ---
+
+Step = Tuple[Any, ...]
+Steps = Generator[Step, Any, Any]
+
+@contextlib.contextmanager
+def _timed(timings: Optional[Dict[str, float]], stage: str, observe: bool = True) -> Iterator[None]:
+    """Record the duration of a stage in timings if the caller asked for them, and in STAGE_SECONDS if observe.
+
+    Stages that time_stage or a fan-out already export pass observe=False.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if observe:
+            STAGE_SECONDS.observe(elapsed, stage=stage)
+        if timings is not None:
+            timings[stage] = elapsed
+
+def retrieval_args(resources: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the resources as keyword arguments for retrieve_context."""
+    return {key: value for key, value in resources.items() if not key.startswith("_")}
+
+def retrieval_steps(query: str, pinecone_index_docs: Any, pinecone_index_legis: Any,
+                    mongo_collection_docs: Any, mongo_collection_legis: Any, openai_client: Any,
+                    timings: Optional[Dict[str, float]] = None) -> Steps:
+    """Retrieve relevant context from multiple vector indexes and MongoDB collections, as steps.
+
+    Returns (formatted_context, raw_context_for_display). If a timings dict is given,
+    per-stage durations in seconds are recorded into it.
+    """
+    if not query: return "", []
+
+    with _timed(timings, "retrieval"):
+        try:
+            stamp = yield ("call", knowledge_base_stamp)
+            identified = yield ("call", identifier_matches, query)
+            if is_direct_lookup(identified):
+                # --- The question cites a ruling or section: fetch its chunks without embedding or vector search ---
+                logger.info(f"Question cites indexed identifiers; fetching their {len(identified)} chunks directly.")
+                IDENTIFIER_LOOKUPS.inc(mode="direct")
+                unique_result_ids = identified
+                index_results = {}
+                cache_key = None
+            else:
+                with _timed(timings, "embed", observe=False):
+                    query_embedding = yield ("embed", query, openai_client)
+
+                # --- Serve repeat questions from the retrieval cache ---
+                retrieval_cache = get_retrieval_cache()
+                cache_key = retrieval_cache.key(query_embedding, tuple(item['id'] for item in identified), stamp)
+                cached = retrieval_cache.get(cache_key)
+                if cached is not None:
+                    logger.info("Retrieval cache hit; skipping vector and document lookups.")
+                    _, formatted_context, raw_context_for_display = cached
+                    return formatted_context, list(raw_context_for_display)
+
+                # --- Query both vector indexes, and the BM25 index if there is one, concurrently ---
+                logger.info(f"Querying vector indexes: {PINECONE_INDEX_NAME_DOCS}, {PINECONE_INDEX_NAME_LEGIS}")
+                searches = {
+                    PINECONE_INDEX_NAME_DOCS: ("call", functools.partial(pinecone_index_docs.query, vector=query_embedding, top_k=TOP_K, include_metadata=INLINE_CHUNK_METADATA)),
+                    PINECONE_INDEX_NAME_LEGIS: ("call", functools.partial(pinecone_index_legis.query, vector=query_embedding, top_k=TOP_K, include_metadata=INLINE_CHUNK_METADATA)),
+                }
+                lexical_index = yield ("call", current_lexical_index)
+                if lexical_index is not None:
+                    searches[LEXICAL_INDEX_NAME] = ("call", lexical_index.query, query, TOP_K)
+                with _timed(timings, "vector_search", observe=False):
+                    index_results = yield ("fan_out", searches, PINECONE_QUERY_TIMEOUT_SECONDS, "vector_search")
+
+                unique_result_ids = merge_matches(index_results[PINECONE_INDEX_NAME_DOCS], index_results[PINECONE_INDEX_NAME_LEGIS])
+                if index_results.get(LEXICAL_INDEX_NAME):
+                    unique_result_ids = fuse_matches(unique_result_ids, index_results[LEXICAL_INDEX_NAME])
+                if identified:
+                    IDENTIFIER_LOOKUPS.inc(mode="seeded")
+                    unique_result_ids = seed_matches(identified, unique_result_ids)
+                check_search_results(index_results, unique_result_ids)
+                if not unique_result_ids: return "", []
+                if is_weak_retrieval(unique_result_ids):
+                    logger.info(f"Best match scores {max(item['score'] for item in unique_result_ids):.3f}, below {RELEVANCE_THRESHOLD}; skipping document fetch.")
+                    WEAK_RETRIEVALS.inc()
+                    if all(result is not None for result in index_results.values()):
+                        retrieval_cache.put(cache_key, ([], "", []))
+                    return "", []
+
+            # --- Fetch full text from both MongoDB collections concurrently ---
+            inline_docs, doc_ids_to_fetch, legis_ids_to_fetch = split_fetch_ids(unique_result_ids)
+            with _timed(timings, "document_fetch", observe=False):
+                fetch_results = yield ("fan_out", {
+                    MONGO_COLLECTION_NAME_DOCS: ("fetch", mongo_collection_docs, MONGO_COLLECTION_NAME_DOCS, doc_ids_to_fetch, stamp),
+                    MONGO_COLLECTION_NAME_LEGIS: ("fetch", mongo_collection_legis, MONGO_COLLECTION_NAME_LEGIS, legis_ids_to_fetch, stamp),
+                }, MONGO_FETCH_TIMEOUT_SECONDS, "document_fetch")
+
+            mongo_results = inline_docs
+            for fetched in fetch_results.values():
+                mongo_results.extend(fetched or [])
+            check_fetch_results({MONGO_COLLECTION_NAME_DOCS: doc_ids_to_fetch, MONGO_COLLECTION_NAME_LEGIS: legis_ids_to_fetch},
+                                fetch_results, mongo_results)
+
+            formatted_context, raw_context_for_display = yield ("call", build_context, unique_result_ids, mongo_results)
+
+            # Partial results (an index or collection timed out or failed) are not cached
+            if cache_key is not None and all(result is not None for result in list(index_results.values()) + list(fetch_results.values())):
+                ordered_ids = [{'id': item['id'], 'source_type': item['source_type']} for item in unique_result_ids]
+                retrieval_cache.put(cache_key, (ordered_ids, formatted_context, raw_context_for_display))
+
+            return formatted_context, raw_context_for_display
+
+        except Exception as e:
+            logger.error(f"Error during context retrieval: {e}")
+            ERRORS.inc(stage="retrieval", kind="exception")
+            raise RetrievalError(f"Error searching the database: {e}") from e
+
+def answer_steps(question: str, resources: Dict[str, Any], single_flight: bool = False,
+                 timings: Optional[Dict[str, float]] = None) -> Steps:
+    """Answer one question, as steps, and return the answer to keep in the message history.
+
+    The flow main() shows, also run by the load generator, the benchmark and the service:
+    advice check, tax engine, then retrieval and generation, with near-duplicate questions
+    served from the answer cache. With single_flight, it joins any identical question in
+    flight in this process (the followers' steps block, so only threaded drivers ask for it).
+    resources holds retrieve_context's client arguments. Retrieval failures raise
+    RetrievalError, generation failures their own error.
+    """
+    started = time.perf_counter()
+    try:
+        if is_advice_request(question):
+            logger.info("Advice request; answering with the disclaimer.")
+            return (yield ("reply", ADVICE_DISCLAIMER, "advice"))
+        calculated = answer_from_tax_engine(question)
+        if calculated is not None:
+            logger.info("Answered by the tax engine.")
+            return (yield ("reply", calculated, "tax_engine"))
+
+        openai_client = resources["openai_client"]
+        flights = get_single_flight()
+        flight, is_leader = flights.join(question) if single_flight and SINGLE_FLIGHT_ENABLED else (None, True)
+        try:
+            yield ("status", "Searching the ATO knowledge base...")
+            if is_leader:
+                context, raw_context = yield from retrieval_steps(question, **retrieval_args(resources), timings=timings)
+                if flight is not None:
+                    flight.set_sources(context, raw_context)
+            else:
+                logger.info("Identical question already in flight; following its answer.")
+                context, raw_context = yield ("call", flight.wait_sources)
+            yield ("sources", raw_context)
+            yield ("status", None)
+
+            if not raw_context:
+                logger.info("No relevant context; answering with the not-found message.")
+                return (yield ("reply", NOT_FOUND_MESSAGE, "not_found"))
+
+            cached_answer = None
+            query_embedding = None
+            source_ids = [doc['id'] for doc in raw_context]
+            # Questions answered from the identifier index were never embedded; don't embed them just for this cache
+            if is_leader and ANSWER_CACHE_ENABLED and not is_direct_lookup((yield ("call", identifier_matches, question))):
+                try:
+                    stamp = yield ("call", knowledge_base_stamp)
+                    query_embedding = yield ("embed", question, openai_client)
+                    cached_answer = get_answer_cache().lookup(query_embedding, source_ids, stamp)
+                except Exception as e:
+                    logger.warning(f"Answer cache lookup failed: {e}")
+            if cached_answer is not None:
+                logger.info("Answer cache hit; skipping the LLM call.")
+                if flight is not None:
+                    list(flight.relay([cached_answer]))
+                return (yield ("reply", cached_answer, "answer_cache"))
+
+            yield ("status", "Synthesizing information and generating response...")
+            try:
+                with _timed(timings, "generation", observe=False):
+                    if is_leader:
+                        answer = yield ("generate", question, context, openai_client, flight)
+                    else:
+                        answer = yield ("follow", flight)
+            except Exception as e:
+                logger.error(f"Error during OpenAI API call: {e}")
+                ERRORS.inc(stage="generation", kind="exception")
+                raise
+            yield ("status", None)
+            if query_embedding is not None:
+                get_answer_cache().store(query_embedding, source_ids, answer, stamp)
+            return answer
+        except BaseException as e:
+            # Followers must not wait on a failed leader, nor see Streamlit's rerun/stop signals as its error
+            if flight is not None and is_leader:
+                flight.finish(error=e if isinstance(e, Exception) else RuntimeError("The identical in-flight question was interrupted."))
+            raise
+        finally:
+            if flight is not None and is_leader:
+                flights.release(question, flight)
+    finally:
+        if timings is not None:
+            timings["total"] = time.perf_counter() - started
+
+def perform_step(step: Step) -> Any:
+    """Perform one of the steps every driver handles, in the calling thread."""
+    kind = step[0]
+    if kind == "embed":
+        return embed_query(*step[1:])
+    if kind == "fetch":
+        return fetch_chunks(*step[1:])
+    if kind == "call":
+        return step[1](*step[2:])
+    if kind == "fan_out":
+        tasks, timeout, stage = step[1:]
+        return fan_out({name: functools.partial(perform_step, task) for name, task in tasks.items()}, timeout, stage)
+    raise ValueError(f"Unknown step {kind!r}")
+
+def run_steps(steps: Steps, handle: Callable[[Step], Any] = perform_step) -> Any:
+    """Drive a step generator in the calling thread and return its result.
+
+    handle performs each step; errors it raises are thrown back into the generator.
+    """
+    result = error = None
+    while True:
+        try:
+            step = steps.send(result) if error is None else steps.throw(error)
+        except StopIteration as done:
+            return done.value
+        result = error = None
+        try:
+            result = handle(step)
+        except BaseException as e:
+            error = e
+
+def retrieve_context(query: str, pinecone_index_docs: Any, pinecone_index_legis: Any,
+                     mongo_collection_docs: Any, mongo_collection_legis: Any,
+                     openai_client: OpenAI) -> Tuple[str, List[Dict[str, Any]]]:
+    """Retrieve relevant context from multiple Pinecone indexes and MongoDB collections."""
+    return run_steps(retrieval_steps(query, pinecone_index_docs, pinecone_index_legis,
+                                     mongo_collection_docs, mongo_collection_legis, openai_client))
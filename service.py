@@ -0,0 +1,131 @@
+"""Headless HTTP answer service for calling TaxAUmate from other tools.
+
+Endpoints:
+    GET  /healthz         liveness check
+    GET  /metrics         per-stage latency histograms and cache counters (Prometheus text format)
+    POST /answer          {"question": "..."} -> {"answer": "...", "sources": [...]}
+    POST /answer/stream   same request; Server-Sent Events: one "sources" event,
+                          "token" events with sanitized text, then "done"
+
+Each worker process keeps one shared set of async clients (see async_pipeline.py).
+
+Usage:
+    python service.py --port 8000 --workers 4
+    uvicorn service:app --workers 4
+"""
+import argparse
+import contextlib
+import json
+import logging
+from typing import Any, AsyncIterator, Dict
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+from async_pipeline import answer_question_async, create_async_resources, close_async_resources
+from metrics import REGISTRY
+from pipeline import register_cache_metrics
+
+logger = logging.getLogger(__name__)
+
+ERROR_MESSAGE = "I apologize, but I encountered an error. Please try rephrasing your question."
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette) -> AsyncIterator[None]:
+    app.state.resources = await create_async_resources()
+    register_cache_metrics()
+    logger.info("Answer service clients initialized.")
+    try:
+        yield
+    finally:
+        await close_async_resources(app.state.resources)
+
+
+async def _read_question(request: Request) -> str:
+    try:
+        body = await request.json()
+    except ValueError:
+        return ""
+    question = body.get("question") if isinstance(body, dict) else None
+    return question.strip() if isinstance(question, str) else ""
+
+
+async def healthz(request: Request) -> JSONResponse:
+    return JSONResponse({"status": "ok"})
+
+
+async def metrics(request: Request) -> PlainTextResponse:
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+async def answer(request: Request) -> JSONResponse:
+    """Answer a question and return the full response in one JSON body."""
+    question = await _read_question(request)
+    if not question:
+        return JSONResponse({"error": "Request body must be JSON with a non-empty 'question'."}, status_code=400)
+
+    result: Dict[str, Any] = {"answer": "", "sources": []}
+    try:
+        async for event, data in answer_question_async(question, request.app.state.resources):
+            if event == "sources":
+                result["sources"] = data
+            elif event == "answer":
+                result["answer"] = data
+    except Exception as e:
+        logger.error(f"Error while answering question: {e}")
+        return JSONResponse({"error": ERROR_MESSAGE, "sources": result["sources"]}, status_code=502)
+    return JSONResponse(result)
+
+
+def _sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def answer_stream(request: Request) -> Any:
+    """Answer a question as a Server-Sent Events stream."""
+    question = await _read_question(request)
+    if not question:
+        return JSONResponse({"error": "Request body must be JSON with a non-empty 'question'."}, status_code=400)
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            async for event, data in answer_question_async(question, request.app.state.resources):
+                if event == "sources":
+                    yield _sse("sources", data)
+                elif event == "token":
+                    yield _sse("token", {"text": data})
+            yield _sse("done", {})
+        except Exception as e:
+            logger.error(f"Error while streaming answer: {e}")
+            yield _sse("error", {"message": ERROR_MESSAGE})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+app = Starlette(
+    routes=[
+        Route("/healthz", healthz, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/answer", answer, methods=["POST"]),
+        Route("/answer/stream", answer_stream, methods=["POST"]),
+    ],
+    lifespan=lifespan,
+)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the TaxAUmate HTTP answer service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes, each with its own client pool")
+    args = parser.parse_args()
+    uvicorn.run("service:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+"""Deterministic answers to resident income tax rate and calculation questions.
+
+Rate tables, the Medicare levy and tax offsets for each financial year live in
+versioned JSON files (TAX_DATA_DIR/<year>.json, e.g. tax_data/2024-25.json),
+each citing the ATO page it was taken from. Questions the engine can parse
+(rate tables, tax on a taxable income, marginal rates, the Medicare levy, the
+low income tax offset) are answered locally with citations. A question that
+names no year uses the latest year up to the current one that has the figures
+it needs (only the rate table, for rate and marginal rate questions). Anything
+else, including a year or component without data, returns None so the app
+falls through to retrieval and the LLM.
+
+Usage:
+    python tax_engine.py "How much tax will I pay on $85,000 in 2024-25?"
+    python tax_engine.py --years
+"""
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# The data files ship next to this module, so the default does not depend on the working directory
+TAX_DATA_DIR = os.getenv("TAX_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tax_data"))
+
+# Questions about anything the resident tables don't cover go to the LLM
+OUT_OF_SCOPE = re.compile(
+    r"non[- ]?resident|foreign resident|working holiday|backpacker|company|companies|trust|partnership|"
+    r"capital gain|cgt|super|help debt|hecs|study loan|surcharge|dividend|franking|fringe|fbt|gst|"
+    r"spouse|family|dependant|senior|pensioner|sapto|child|minor|bonus|redundancy|eligible termination|lump sum|"
+    r"deduct|claim|expense|refund|withh(?:o|e)ld|payg|instal?ment",
+    re.IGNORECASE)
+
+YEAR_RANGE = re.compile(r"\b(20\d{2})\s*[-/–]\s*(?:20)?(\d{2})\b")
+YEAR_FY = re.compile(r"\bFY\s?(?:20)?(\d{2})\b", re.IGNORECASE)
+YEAR_ENDING = re.compile(r"\byear end(?:ing|ed)?\s+(?:30 june\s+)?(20\d{2})\b", re.IGNORECASE)
+AMOUNT = re.compile(r"(\$\s?)?(\d{1,3}(?:,\d{3})+|\d+)(\.\d{1,2})?\s?(k\b|thousand\b|m\b|million\b)?(\s?%)?", re.IGNORECASE)
+
+RATE_TABLE = re.compile(r"\b(tax|income tax)\s+(rates?|brackets?|thresholds?|scales?|tables?)\b|\bmarginal (tax )?rates\b|\brates of (income )?tax\b",
+                        re.IGNORECASE)
+MARGINAL = re.compile(r"\bmarginal\b|\btax bracket\b", re.IGNORECASE)
+MEDICARE = re.compile(r"\bmedicare levy\b", re.IGNORECASE)
+LITO = re.compile(r"\blow income tax offset\b|\blito\b", re.IGNORECASE)
+TAX_ON_INCOME = re.compile(r"\bhow much (income )?tax\b|\btax (will|would|do|should) i (pay|owe)\b|\btax payable\b|\btake[- ]home\b|\bafter[- ]tax\b|"
+                           r"\btax on (an? |my )?(\$|taxable income|income|salary|wages?|earnings)\b", re.IGNORECASE)
+# Words that may follow an income amount ("$85,000 salary", "$85k a year in 2024-25"); any other word
+# ("a $2,000 prize", "$5,000 gifts") means the amount is not a taxable income
+INCOME_FOLLOWERS = frozenset(
+    "taxable income salary wage wages earnings gross a per pa annually yearly year in for during this last next "
+    "and if with before after i is".split())
+
+
+def financial_year(day: datetime.date) -> str:
+    """Return the financial year ('2024-25') a date falls in."""
+    start = day.year if day.month >= 7 else day.year - 1
+    return f"{start}-{(start + 1) % 100:02d}"
+
+
+def parse_year(question: str) -> Optional[str]:
+    """Return the financial year named in a question, if any."""
+    match = YEAR_RANGE.search(question)
+    if match and (int(match.group(1)) + 1) % 100 == int(match.group(2)):
+        return f"{match.group(1)}-{match.group(2)}"
+    match = YEAR_FY.search(question)
+    if match:
+        end = 2000 + int(match.group(1))
+        return f"{end - 1}-{end % 100:02d}"
+    match = YEAR_ENDING.search(question)
+    if match:
+        end = int(match.group(1))
+        return f"{end - 1}-{end % 100:02d}"
+    return None
+
+
+def _amounts(question: str) -> List[Tuple[float, str]]:
+    """Return (value, following text) for each dollar amount in a question."""
+    text = YEAR_ENDING.sub(" ", YEAR_FY.sub(" ", YEAR_RANGE.sub(" ", question)))
+    amounts = []
+    for match in AMOUNT.finditer(text):
+        dollar, digits, cents, suffix, percent = match.groups(default="")
+        if percent:
+            continue
+        value = float(digits.replace(",", "") + cents)
+        suffix = suffix.lower()
+        if suffix in ("k", "thousand"):
+            value *= 1_000
+        elif suffix in ("m", "million"):
+            value *= 1_000_000
+        # Bare small numbers ("section 8", "2 jobs") are not incomes
+        if dollar or suffix or "," in digits or value >= 1_000:
+            amounts.append((value, text[match.end():]))
+    return amounts
+
+
+def parse_amount(question: str) -> Tuple[Optional[float], bool]:
+    """Return (the dollar amount in a question, whether it was ambiguous)."""
+    amounts = _amounts(question)
+    if len({value for value, _ in amounts}) > 1:
+        return None, True
+    return (amounts[0][0] if amounts else None), False
+
+
+def amount_is_income(question: str) -> bool:
+    """Return False if a dollar amount in a question is followed by a word naming something other than income."""
+    for _, following in _amounts(question):
+        word = re.match(r"\s*([a-z]+)", following, re.IGNORECASE)
+        if word and word.group(1).lower() not in INCOME_FOLLOWERS:
+            return False
+    return True
+
+
+# Components each kind of answer needs beyond the rate table
+REQUIRED_COMPONENTS = {
+    "rate_table": (),
+    "marginal": (),
+    "medicare_info": ("medicare_levy",),
+    "medicare": ("medicare_levy",),
+    "lito": ("low_income_tax_offset",),
+    "calculation": ("medicare_levy", "low_income_tax_offset"),
+}
+
+
+def has_components(data: Dict[str, Any], components: Tuple[str, ...]) -> bool:
+    """Return True if a year's data has every one of the named components."""
+    available = set(data) | set(data.get("offsets", {}))
+    return all(component in available for component in components)
+
+
+def is_complete(data: Dict[str, Any]) -> bool:
+    """Return True if a year's data has every component a full calculation needs."""
+    return has_components(data, REQUIRED_COMPONENTS["calculation"])
+
+
+def _money(value: float) -> str:
+    return f"${value:,.2f}"
+
+
+def _whole(value: float) -> str:
+    return f"${value:,.0f}"
+
+
+def _percent(rate: float) -> str:
+    return f"{rate * 100:g}%"
+
+
+def _cite(source: Dict[str, str]) -> str:
+    return f"(Source: [{source['title']}]({source['url']}))"
+
+
+def income_tax(brackets: List[Dict[str, float]], income: float) -> float:
+    """Tax on a taxable income under progressive brackets ({'threshold', 'rate'}, ascending)."""
+    tax = 0.0
+    for bracket, following in zip(brackets, brackets[1:] + [None]):
+        upper = following["threshold"] if following else float("inf")
+        if income > bracket["threshold"]:
+            tax += (min(income, upper) - bracket["threshold"]) * bracket["rate"]
+    return tax
+
+
+def marginal_rate(brackets: List[Dict[str, float]], income: float) -> float:
+    rate = 0.0
+    for bracket in brackets:
+        if income > bracket["threshold"]:
+            rate = bracket["rate"]
+    return rate
+
+
+def medicare_levy(params: Dict[str, float], income: float) -> float:
+    """Medicare levy for a single taxpayer, phased in above the low-income threshold."""
+    if income <= params["low_income_threshold"]:
+        return 0.0
+    return min(income * params["rate"], (income - params["low_income_threshold"]) * params["phase_in_rate"])
+
+
+def phase_in_upper(params: Dict[str, float]) -> float:
+    """Income above which the full Medicare levy applies."""
+    return params["low_income_threshold"] * params["phase_in_rate"] / (params["phase_in_rate"] - params["rate"])
+
+
+def tax_offset(params: Dict[str, Any], income: float) -> float:
+    """An offset's full amount, reduced by each rate for income above its 'above' point."""
+    reductions = params["reductions"]
+    amount = params["maximum"]
+    for step, following in zip(reductions, reductions[1:] + [None]):
+        upper = following["above"] if following else float("inf")
+        if income > step["above"]:
+            amount -= (min(income, upper) - step["above"]) * step["rate"]
+    return max(amount, 0.0)
+
+
+def question_kind(question: str, income: Optional[float]) -> Optional[str]:
+    """Return which kind of answer a question asks for (a REQUIRED_COMPONENTS key), or None."""
+    if income is None:
+        if MEDICARE.search(question) and not RATE_TABLE.search(question):
+            return "medicare_info"
+        if RATE_TABLE.search(question):
+            return "rate_table"
+        return None
+    if MARGINAL.search(question):
+        return "marginal"
+    if MEDICARE.search(question) and not re.search(r"\btax payable|total tax|take[- ]home|after tax\b", question, re.IGNORECASE):
+        return "medicare"
+    if LITO.search(question):
+        return "lito"
+    if TAX_ON_INCOME.search(question) and amount_is_income(question):
+        return "calculation"
+    return None
+
+
+class TaxEngine:
+    """Answers rate and calculation questions from the loaded financial year data."""
+
+    def __init__(self, years: Dict[str, Dict[str, Any]]):
+        self.years = years
+
+    @classmethod
+    def load(cls, directory: str = TAX_DATA_DIR) -> "TaxEngine":
+        years = {}
+        for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            brackets = data["resident_rates"]["brackets"]
+            if brackets[0]["threshold"] != 0 or any(a["threshold"] >= b["threshold"] for a, b in zip(brackets, brackets[1:])):
+                raise ValueError(f"{path}: brackets must start at 0 and ascend.")
+            years[data["financial_year"]] = data
+        logger.info(f"Tax engine loaded {len(years)} financial years from {directory}.")
+        return cls(years)
+
+    def answer(self, question: str, today: Optional[datetime.date] = None) -> Optional[str]:
+        """Return a cited answer, or None if the question is not one the engine can answer exactly."""
+        if OUT_OF_SCOPE.search(question):
+            return None
+        income, ambiguous = parse_amount(question)
+        if ambiguous:
+            return None
+        kind = question_kind(question, income)
+        if kind is None:
+            return None
+
+        year = parse_year(question)
+        assumed = year is None
+        current = financial_year(today or datetime.date.today())
+        if assumed:
+            year = self.default_year(current, REQUIRED_COMPONENTS[kind])
+            if year is None:
+                return None
+        data = self.years.get(year)
+        if data is None:
+            return None
+
+        if kind == "medicare_info":
+            body = self._medicare_info(data)
+        elif kind == "rate_table":
+            body = self._rate_table(data)
+        elif kind == "marginal":
+            body = self._marginal(data, income)
+        elif kind == "medicare":
+            body = self._medicare(data, income)
+        elif kind == "lito":
+            body = self._lito(data, income)
+        else:
+            body = self._calculation(data, income)
+        if body is None:
+            return None
+
+        text, sources = body
+        if not assumed:
+            preface = f"For the {year} financial year, for an Australian resident for the full year."
+        elif year == current:
+            preface = f"Assuming the {year} financial year (the current one) and an Australian resident for the full year."
+        else:
+            preface = (f"Assuming the {year} financial year, the latest with published figures for this question (the current "
+                       f"year is {current}), and an Australian resident for the full year.")
+        source_list = "\n".join(f"- [{source['title']}]({source['url']})" for source in sources)
+        return (f"{preface}\n\n{text}\n\n"
+                f"Calculated from the published {year} rates (tax data version {data['version']}).\n\n"
+                f"**Sources**\n{source_list}")
+
+    def default_year(self, current: str, components: Tuple[str, ...] = REQUIRED_COMPONENTS["calculation"]) -> Optional[str]:
+        """Return the latest year up to the current one with the given components, for questions that name no year."""
+        candidates = [year for year, data in self.years.items() if year <= current and has_components(data, components)]
+        return max(candidates) if candidates else None
+
+    def _rate_table(self, data: Dict[str, Any]) -> Tuple[str, List[Dict[str, str]]]:
+        rates = data["resident_rates"]
+        brackets = rates["brackets"]
+        lines = []
+        for bracket, following in zip(brackets, brackets[1:] + [None]):
+            low = bracket["threshold"]
+            span = f"{_whole(low + 1 if low else 0)} – {_whole(following['threshold'])}" if following else f"{_whole(low + 1)} and over"
+            if bracket["rate"] == 0:
+                lines.append(f"- {span}: Nil")
+            else:
+                base = income_tax(brackets, low)
+                plus = f"{_whole(base)} plus " if base else ""
+                lines.append(f"- {span}: {plus}{bracket['rate'] * 100:g}c for each $1 over {_whole(low)}")
+        levy = data.get("medicare_levy")
+        note = f"These rates do not include the Medicare levy of {_percent(levy['rate'])}." if levy else "These rates do not include the Medicare levy."
+        return (f"Resident income tax rates on taxable income {_cite(rates['source'])}:\n\n" + "\n".join(lines) + f"\n\n{note}",
+                [rates["source"]])
+
+    def _marginal(self, data: Dict[str, Any], income: float) -> Tuple[str, List[Dict[str, str]]]:
+        rates = data["resident_rates"]
+        rate = marginal_rate(rates["brackets"], income)
+        text = f"At a taxable income of {_money(income)}, the marginal tax rate is {_percent(rate)} {_cite(rates['source'])}"
+        sources = [rates["source"]]
+        levy = data.get("medicare_levy")
+        if levy and income > phase_in_upper(levy):
+            text += f", or {_percent(rate + levy['rate'])} including the Medicare levy {_cite(levy['source'])}"
+            sources.append(levy["source"])
+        return text + ".", sources
+
+    def _medicare_info(self, data: Dict[str, Any]) -> Optional[Tuple[str, List[Dict[str, str]]]]:
+        levy = data.get("medicare_levy")
+        if levy is None:
+            return None
+        return (f"The Medicare levy is {_percent(levy['rate'])} of taxable income. A single taxpayer with taxable income of "
+                f"{_whole(levy['low_income_threshold'])} or less pays no levy, and it is phased in at "
+                f"{levy['phase_in_rate'] * 100:g}c for each $1 above that until the full levy applies at "
+                f"{_whole(phase_in_upper(levy))} {_cite(levy['source'])}.", [levy["source"]])
+
+    def _medicare(self, data: Dict[str, Any], income: float) -> Optional[Tuple[str, List[Dict[str, str]]]]:
+        levy = data.get("medicare_levy")
+        if levy is None:
+            return None
+        return (f"The Medicare levy on a taxable income of {_money(income)} is {_money(medicare_levy(levy, income))} "
+                f"for a single taxpayer {_cite(levy['source'])}.", [levy["source"]])
+
+    def _lito(self, data: Dict[str, Any], income: float) -> Optional[Tuple[str, List[Dict[str, str]]]]:
+        offset = data.get("offsets", {}).get("low_income_tax_offset")
+        if offset is None:
+            return None
+        return (f"The low income tax offset for a taxable income of {_money(income)} is {_money(tax_offset(offset, income))} "
+                f"{_cite(offset['source'])}. It can reduce tax payable to zero but is not refunded beyond that.", [offset["source"]])
+
+    def _calculation(self, data: Dict[str, Any], income: float) -> Optional[Tuple[str, List[Dict[str, str]]]]:
+        levy = data.get("medicare_levy")
+        offset = data.get("offsets", {}).get("low_income_tax_offset")
+        if levy is None or offset is None:
+            return None  # A total that silently leaves out a component would be wrong
+        rates = data["resident_rates"]
+        gross = income_tax(rates["brackets"], income)
+        lito = min(tax_offset(offset, income), gross)
+        medicare = medicare_levy(levy, income)
+        total = gross - lito + medicare
+        lines = [
+            f"- Income tax on {_money(income)}: {_money(gross)} {_cite(rates['source'])}",
+            f"- Less low income tax offset: {_money(lito)} {_cite(offset['source'])}",
+            f"- Plus Medicare levy: {_money(medicare)} {_cite(levy['source'])}",
+            f"- **Estimated tax payable: {_money(total)}**, leaving {_money(income - total)} after tax",
+            f"- Marginal tax rate: {_percent(marginal_rate(rates['brackets'], income))}",
+        ]
+        note = ("This assumes a single taxpayer with no other offsets, no Medicare levy surcharge and no study loan "
+                "repayments, and does not account for tax already withheld.")
+        return "\n".join(lines) + f"\n\n{note}", [rates["source"], offset["source"], levy["source"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer resident tax rate and calculation questions from the local tax data.")
+    parser.add_argument("question", nargs="?")
+    parser.add_argument("--years", action="store_true", help="List the loaded financial years and data versions")
+    parser.add_argument("--dir", default=TAX_DATA_DIR)
+    args = parser.parse_args()
+
+    engine = TaxEngine.load(args.dir)
+    if args.years or not args.question:
+        for year, data in sorted(engine.years.items()):
+            parts = ["rates"] + (["medicare_levy"] if "medicare_levy" in data else []) + sorted(data.get("offsets", {}))
+            print(f"{year}  version {data['version']}  ({', '.join(parts)}){'' if is_complete(data) else '  incomplete'}")
+        return
+    answer = engine.answer(args.question)
+    print(answer if answer is not None else "Not answerable locally; the question would go to retrieval and the LLM.")
+
+
+if __name__ == "__main__":
+    main()
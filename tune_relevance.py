@@ -0,0 +1,118 @@
+"""Tune RELEVANCE_THRESHOLD on a labelled question set.
+
+Each input line is {"question": "...", "answerable": true|false}, saying whether
+the knowledge base holds the answer. Every question goes through the app's own
+embedding, vector search and merge step, and its best merged match score (the
+value retrieve_context compares with RELEVANCE_THRESHOLD) is recorded. For a
+range of thresholds the report then gives:
+
+    false-skip rate   answerable questions that would get the not-found message
+    skip rate         unanswerable questions that would correctly skip the LLM call
+
+It also suggests the highest threshold whose false-skip rate stays within
+--max-false-skip. Lines that already carry a "score" (e.g. a file written with
+--scores) are not searched again, so thresholds can be re-tuned offline.
+
+Usage:
+    python tune_relevance.py labelled.jsonl --max-false-skip 0.01
+    python tune_relevance.py labelled.jsonl --scores scored.jsonl
+"""
+import argparse
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import app
+import pipeline
+
+logger = logging.getLogger(__name__)
+
+
+def best_score(question: str, openai_client: Any, index_docs: Any, index_legis: Any) -> float:
+    """Return the best merged match score for a question, as retrieve_context sees it."""
+    query_embedding = pipeline.embed_query(question, openai_client)
+    index_results = pipeline.fan_out({
+        pipeline.PINECONE_INDEX_NAME_DOCS: lambda: index_docs.query(vector=query_embedding, top_k=pipeline.TOP_K),
+        pipeline.PINECONE_INDEX_NAME_LEGIS: lambda: index_legis.query(vector=query_embedding, top_k=pipeline.TOP_K),
+    }, timeout=pipeline.PINECONE_QUERY_TIMEOUT_SECONDS, stage="vector_search")
+    if any(result is None for result in index_results.values()):
+        raise RuntimeError("A vector index did not answer.")
+    matches = pipeline.merge_matches(index_results[pipeline.PINECONE_INDEX_NAME_DOCS], index_results[pipeline.PINECONE_INDEX_NAME_LEGIS])
+    return matches[0]['score'] if matches else 0.0
+
+
+def score_questions(records: List[Dict[str, Any]], concurrency: int) -> List[Dict[str, Any]]:
+    """Add a "score" to every record that does not have one yet."""
+    pending = [record for record in records if "score" not in record]
+    if not pending:
+        return records
+    openai_client = app.get_openai_client()
+    index_docs = app.get_vector_index(app.PINECONE_INDEX_NAME_DOCS)
+    index_legis = app.get_vector_index(app.PINECONE_INDEX_NAME_LEGIS)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        scores = executor.map(lambda record: best_score(record["question"], openai_client, index_docs, index_legis), pending)
+        for record, score in zip(pending, scores):
+            record["score"] = score
+    return records
+
+
+def skip_rates(records: List[Dict[str, Any]], threshold: float) -> Dict[str, float]:
+    """Return the false-skip and correct-skip rates if questions scoring below threshold were skipped."""
+    answerable = [record["score"] for record in records if record["answerable"]]
+    unanswerable = [record["score"] for record in records if not record["answerable"]]
+    return {
+        "threshold": threshold,
+        "false_skip_rate": sum(score < threshold for score in answerable) / len(answerable) if answerable else 0.0,
+        "skip_rate": sum(score < threshold for score in unanswerable) / len(unanswerable) if unanswerable else 0.0,
+    }
+
+
+def suggest_threshold(records: List[Dict[str, Any]], max_false_skip: float) -> Optional[Dict[str, float]]:
+    """Return the rates at the highest threshold whose false-skip rate is within max_false_skip."""
+    answerable = sorted(record["score"] for record in records if record["answerable"])
+    if not answerable:
+        return None
+    # Skipping is strict (score < threshold), so the k-th lowest answerable score skips at most k of them,
+    # and any higher threshold skips more than k
+    allowed = min(int(max_false_skip * len(answerable)), len(answerable) - 1)
+    return skip_rates(records, answerable[allowed])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report false-skip rates for relevance thresholds on a labelled question set.")
+    parser.add_argument("labelled", help='JSONL lines of {"question": "...", "answerable": true|false}')
+    parser.add_argument("--max-false-skip", type=float, default=0.01,
+                        help="Highest acceptable share of answerable questions skipped (default: %(default)s)")
+    parser.add_argument("--step", type=float, default=0.05, help="Threshold grid step for the report (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Questions scored at once (default: %(default)s)")
+    parser.add_argument("--scores", help="Write the labelled questions with their best scores to this JSONL file")
+    args = parser.parse_args()
+
+    with open(args.labelled, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records = score_questions(records, args.concurrency)
+    if args.scores:
+        with open(args.scores, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    scores = [record["score"] for record in records]
+    low = np.floor(min(scores) / args.step) * args.step
+    print(f"{'threshold':>9} {'false-skip':>10} {'skip':>7}")
+    for threshold in np.arange(low, max(scores) + args.step, args.step):
+        rates = skip_rates(records, round(float(threshold), 4))
+        print(f"{rates['threshold']:>9.3f} {rates['false_skip_rate']:>10.1%} {rates['skip_rate']:>7.1%}")
+
+    suggestion = suggest_threshold(records, args.max_false_skip)
+    if suggestion:
+        print(f"\nSuggested RELEVANCE_THRESHOLD={suggestion['threshold']:.4f}: "
+              f"{suggestion['false_skip_rate']:.1%} false skips, {suggestion['skip_rate']:.1%} of unanswerable questions skipped.")
+    else:
+        print("\nNo answerable questions in the set; cannot suggest a threshold.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""In-process vector index that can stand in for a Pinecone index.
+
+Each index lives in its own directory:
+    vectors.npy     float32 matrix of unit-normalised embeddings (memory-mapped)
+    ids.json        vector ids, one per matrix row
+    metadata.jsonl  optional chunk metadata, one JSON object per matrix row
+    hnsw.bin        optional HNSW graph for approximate search (needs hnswlib)
+
+Usage:
+    python vector_index.py export ato-legal-database     # copy vectors out of Pinecone
+    python vector_index.py build-hnsw ato-legal-database # build the approximate search graph
+    python vector_index.py backfill-metadata ato-legal-database documents
+                                                         # store chunk text alongside the vectors
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import zlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "local_indexes")
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+# Pinecone caps metadata at 40 KB per vector; keep headroom for the other fields.
+MAX_INLINE_TEXT_BYTES = int(os.getenv("MAX_INLINE_TEXT_BYTES", "32000"))
+
+logger = logging.getLogger(__name__)
+
+
+class LocalVectorIndex:
+    """Cosine-similarity search over a memory-mapped matrix, with exact or HNSW modes."""
+
+    def __init__(self, path: str, mode: str = "exact"):
+        if mode not in ("exact", "hnsw"):
+            raise ValueError(f"Unknown local index mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        with open(os.path.join(path, "ids.json"), encoding="utf-8") as f:
+            self.ids: List[str] = json.load(f)
+        if len(self.ids) != self.vectors.shape[0]:
+            raise ValueError(f"{path}: {len(self.ids)} ids but {self.vectors.shape[0]} vectors")
+
+        self.metadata: Optional[List[Dict[str, Any]]] = None
+        metadata_path = os.path.join(path, "metadata.jsonl")
+        if os.path.exists(metadata_path):
+            with open(metadata_path, encoding="utf-8") as f:
+                self.metadata = [json.loads(line) for line in f]
+
+        self._hnsw = None
+        if mode == "hnsw":
+            try:
+                import hnswlib
+            except ImportError as e:
+                raise ImportError("HNSW mode requires the 'hnswlib' package.") from e
+            self._hnsw = hnswlib.Index(space="cosine", dim=self.vectors.shape[1])
+            self._hnsw.load_index(os.path.join(path, "hnsw.bin"), max_elements=self.vectors.shape[0])
+            self._hnsw.set_ef(HNSW_EF_SEARCH)
+
+    def query(self, vector: List[float], top_k: int, include_metadata: bool = False, **kwargs) -> Dict[str, Any]:
+        """Return the top_k matches in the same shape as a Pinecone query response."""
+        top_k = min(top_k, len(self.ids))
+        if top_k <= 0:
+            return {"matches": []}
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        if self._hnsw is not None:
+            labels, distances = self._hnsw.knn_query(query, k=top_k)
+            rows, scores = labels[0], 1.0 - distances[0]
+        else:
+            all_scores = self.vectors @ query
+            rows = np.argpartition(-all_scores, top_k - 1)[:top_k]
+            rows = rows[np.argsort(-all_scores[rows])]
+            scores = all_scores[rows]
+
+        matches = []
+        for row, score in zip(rows, scores):
+            match = {"id": self.ids[row], "score": float(score)}
+            if include_metadata and self.metadata is not None:
+                match["metadata"] = self.metadata[row]
+            matches.append(match)
+        return {"matches": matches}
+
+
+def encode_chunk_metadata(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Pack a chunk's title, url and compressed text into vector metadata.
+
+    Text that is still too large after compression is left out, and readers
+    fall back to fetching the chunk from MongoDB.
+    """
+    metadata = {"title": doc.get("title", "Untitled")}
+    if doc.get("url"):
+        metadata["url"] = doc["url"]
+    text_z = base64.b64encode(zlib.compress(doc.get("text", "").encode("utf-8"), 9)).decode("ascii")
+    if len(text_z) <= MAX_INLINE_TEXT_BYTES:
+        metadata["text_z"] = text_z
+    return metadata
+
+
+def decode_chunk_metadata(metadata: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Rebuild a chunk document from vector metadata, or return None if the text is not stored inline."""
+    if not metadata or ("text_z" not in metadata and "text" not in metadata):
+        return None
+    if "text_z" in metadata:
+        text = zlib.decompress(base64.b64decode(metadata["text_z"])).decode("utf-8")
+    else:
+        text = metadata["text"]
+    doc = {"title": metadata.get("title", "Untitled"), "text": text}
+    if metadata.get("url"):
+        doc["url"] = metadata["url"]
+    return doc
+
+
+def save_index(path: str, ids: List[str], vectors: np.ndarray, metadata: Optional[List[Dict[str, Any]]] = None) -> None:
+    """Write ids, unit-normalised vectors and optional metadata in the layout LocalVectorIndex loads."""
+    os.makedirs(path, exist_ok=True)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    np.save(os.path.join(path, "vectors.npy"), vectors / norms)
+    with open(os.path.join(path, "ids.json"), "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+    if metadata is not None:
+        with open(os.path.join(path, "metadata.jsonl"), "w", encoding="utf-8") as f:
+            for item in metadata:
+                f.write(json.dumps(item) + "\n")
+
+
+def export_from_pinecone(index_name: str, path: str, batch_size: int = 100) -> int:
+    """Copy every vector of a Pinecone index into a local index directory."""
+    from dotenv import load_dotenv
+    from pinecone import Pinecone
+
+    load_dotenv()
+    index = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(index_name)
+    ids: List[str] = []
+    vectors: List[List[float]] = []
+    metadata: List[Dict[str, Any]] = []
+    for id_batch in index.list():
+        for start in range(0, len(id_batch), batch_size):
+            fetched = index.fetch(ids=id_batch[start:start + batch_size]).vectors
+            for vector_id, vector in fetched.items():
+                ids.append(vector_id)
+                vectors.append(vector.values)
+                metadata.append(dict(vector.metadata or {}))
+        logger.info(f"Exported {len(ids)} vectors from {index_name}...")
+    save_index(path, ids, np.array(vectors, dtype=np.float32), metadata if any(metadata) else None)
+    return len(ids)
+
+
+def backfill_metadata(index_name: str, collection_name: str) -> int:
+    """Attach encoded chunk metadata from a MongoDB collection to the matching Pinecone vectors."""
+    from dotenv import load_dotenv
+    from pinecone import Pinecone
+    from pymongo import MongoClient
+
+    load_dotenv()
+    index = Pinecone(api_key=os.getenv("PINECONE_API_KEY")).Index(index_name)
+    collection = MongoClient(os.getenv("MONGO_URI"))[os.getenv("MONGO_DB_NAME", "ato_data")][collection_name]
+    updated = 0
+    for doc in collection.find({}, {"title": 1, "text": 1, "url": 1}):
+        index.update(id=str(doc["_id"]), set_metadata=encode_chunk_metadata(doc))
+        updated += 1
+        if updated % 1000 == 0:
+            logger.info(f"Updated metadata for {updated} vectors in {index_name}...")
+    return updated
+
+
+def build_hnsw(path: str, m: int = 16, ef_construction: int = 200) -> None:
+    """Build and save the HNSW graph used by 'hnsw' mode."""
+    import hnswlib
+
+    vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+    graph = hnswlib.Index(space="cosine", dim=vectors.shape[1])
+    graph.init_index(max_elements=vectors.shape[0], M=m, ef_construction=ef_construction)
+    graph.add_items(np.asarray(vectors), np.arange(vectors.shape[0]))
+    graph.save_index(os.path.join(path, "hnsw.bin"))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Build local vector indexes for offline retrieval.")
+    parser.add_argument("--dir", default=LOCAL_INDEX_DIR, help="Root directory for local indexes (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Copy a Pinecone index to local files")
+    export_parser.add_argument("index_name")
+    hnsw_parser = subparsers.add_parser("build-hnsw", help="Build the HNSW graph for an exported index")
+    hnsw_parser.add_argument("index_name")
+    backfill_parser = subparsers.add_parser("backfill-metadata", help="Store chunk text from MongoDB in Pinecone metadata")
+    backfill_parser.add_argument("index_name")
+    backfill_parser.add_argument("collection_name")
+    args = parser.parse_args()
+
+    path = os.path.join(args.dir, args.index_name)
+    if args.command == "export":
+        count = export_from_pinecone(args.index_name, path)
+        logger.info(f"Saved {count} vectors to {path}.")
+    elif args.command == "build-hnsw":
+        build_hnsw(path)
+        logger.info(f"Saved HNSW graph to {path}.")
+    elif args.command == "backfill-metadata":
+        count = backfill_metadata(args.index_name, args.collection_name)
+        logger.info(f"Stored chunk metadata for {count} vectors in {args.index_name}.")
+
+
+if __name__ == "__main__":
+    main()